@@ -0,0 +1,2 @@
+# Shared helpers for the serverless functions in api/.
+# Vercel does not expose files or folders prefixed with "_" as routes.
@@ -0,0 +1,335 @@
+import heapq
+import itertools
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+
+from .compression import send_json
+from .metrics import inc, observe
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"
+ADMISSION_STORE = os.getenv("ADMISSION_STORE", "memory").lower()  # memory | file | supabase
+ADMISSION_STATE_DIR = os.getenv("ADMISSION_STATE_DIR", os.path.join(tempfile.gettempdir(), "studious-admission"))
+ADMISSION_RPC = os.getenv("ADMISSION_RPC", "admission_take")
+ADMISSION_CAPACITY = float(os.getenv("ADMISSION_CAPACITY", "40"))             # 버킷 최대치 (비용 단위)
+ADMISSION_REFILL_PER_MINUTE = float(os.getenv("ADMISSION_REFILL_PER_MINUTE", "4"))
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "4"))          # 프로세스당 동시 모델 호출 요청 수
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "20"))   # 대기열에서 기다리는 최대 시간
+# 요청자를 식별하는 Clerk 토큰 검증 키. 프런트엔드는 getToken({ template: 'supabase' })로 받은
+# HS256 토큰을 보내고, Clerk 기본 세션 토큰(RS256)은 CLERK_JWT_KEY(PEM 공개 키)로 검증합니다.
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+CLERK_JWT_KEY = os.getenv("CLERK_JWT_KEY")
+
+# Flash 기준 요청 한 번의 비용입니다. Pro로 라우팅되면 PRO_COST_MULTIPLIER배를 청구합니다.
+ENDPOINT_COSTS = {
+    "chat": 1,
+    "assignment_helper": 3,
+    "create_review_note": 6,
+    "create_textbook": 8,
+}
+DEFAULT_COST = 2
+PRO_COST_MULTIPLIER = 4
+# 대기열 가중치: 토큰이 검증된 사용자보다 IP로만 식별되는 요청에 낮은 몫을 줍니다.
+KEY_WEIGHTS = {"user": 1.0, "ip": 0.5}
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is over its rate limit or could not get a slot in time."""
+
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def endpoint_cost(endpoint: str) -> float:
+    return float(os.getenv(f"ADMISSION_COST_{endpoint.upper()}", ENDPOINT_COSTS.get(endpoint, DEFAULT_COST)))
+
+
+def verified_user_id(handler):
+    """Subject of the request's Clerk bearer token, or None when it is missing or fails verification."""
+    authorization = handler.headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+    import jwt
+    token = authorization[len('Bearer '):].strip()
+    for key, algorithm in ((CLERK_JWT_KEY, "RS256"), (SUPABASE_JWT_SECRET, "HS256")):
+        if not key:
+            continue
+        try:
+            # 환경 변수에 한 줄로 넣은 PEM 키의 \n을 줄바꿈으로 되돌립니다.
+            claims = jwt.decode(token, key.replace('\\n', '\n'), algorithms=[algorithm],
+                                options={"require": ["exp", "sub"], "verify_aud": False})
+        except jwt.PyJWTError:
+            continue
+        return claims["sub"]
+    return None
+
+
+def client_ip(handler) -> str:
+    """Client address as set by the platform; X-Forwarded-For from the client is not trusted."""
+    for header in ('X-Vercel-Forwarded-For', 'X-Real-IP'):
+        value = handler.headers.get(header, '').split(',')[0].strip()
+        if value:
+            return value
+    return handler.client_address[0] if handler.client_address else "unknown"
+
+
+def admission_key(handler) -> str:
+    """Identifies who a request is charged to: the verified Clerk user, else the client IP.
+
+    Identifiers in the body or in self-declared headers are ignored, so a
+    client cannot get a fresh bucket by sending a new userId.
+    """
+    user_id = verified_user_id(handler)
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{client_ip(handler)}"
+
+# ==============================================================================
+# STATE STORES
+# ==============================================================================
+# 모든 저장소는 take(key, cost, rate, capacity, force) -> (granted, wait_seconds)를 원자적으로 수행합니다.
+# force=True는 잔량이 모자라도 차감(음수 허용)하며, Pro 추가 비용과 환불(cost < 0)에 씁니다.
+
+def _refill(state, rate, capacity, now):
+    tokens, updated = state if state else (capacity, now)
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+def _take(tokens, cost, rate, force):
+    if force or tokens >= cost:
+        return True, tokens - cost, 0.0
+    return False, tokens, (cost - tokens) / rate if rate > 0 else math.inf
+
+
+class MemoryStore:
+    """Buckets in this process only. Enough for tests and single-instance deployments."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, rate, capacity, force=False):
+        now = time.time()
+        with self._lock:
+            tokens = _refill(self._buckets.get(key), rate, capacity, now)
+            granted, tokens, wait = _take(tokens, cost, rate, force)
+            self._buckets[key] = (tokens, now)
+        return granted, wait
+
+
+class FileStore:
+    """Buckets as small JSON files under an flock, shared by every process that sees the directory."""
+
+    def __init__(self, directory=ADMISSION_STATE_DIR):
+        self.directory = directory
+
+    def take(self, key, cost, rate, capacity, force=False):
+        import fcntl
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, re.sub(r"[^A-Za-z0-9_.-]", "_", key) + ".json")
+        now = time.time()
+        with open(path, 'a+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                saved = json.loads(f.read() or "null")
+            except ValueError:
+                saved = None
+            tokens = _refill((saved["tokens"], saved["updated"]) if saved else None, rate, capacity, now)
+            granted, tokens, wait = _take(tokens, cost, rate, force)
+            f.seek(0)
+            f.truncate()
+            json.dump({"tokens": tokens, "updated": now}, f)
+        return granted, wait
+
+
+class SupabaseStore:
+    """Buckets in Postgres through an RPC, shared by all serverless instances.
+
+    Expects a function with the same semantics as MemoryStore.take:
+
+        create table admission_buckets (key text primary key, tokens double precision, updated_at timestamptz);
+        create function admission_take(p_key text, p_cost double precision, p_rate double precision,
+                                       p_capacity double precision, p_force boolean)
+        returns table (granted boolean, wait double precision) ...
+    """
+
+    def __init__(self):
+        from supabase import create_client
+        self.client = create_client(os.environ['VITE_PUBLICSUPABASE_URL'], os.environ['SUPABASE_SERVICE_ROLE_KEY'])
+
+    def take(self, key, cost, rate, capacity, force=False):
+        from .breaker import guard
+        with guard('supabase'):
+            rows = self.client.rpc(ADMISSION_RPC, {
+                "p_key": key, "p_cost": cost, "p_rate": rate, "p_capacity": capacity, "p_force": force,
+            }).execute().data
+        row = rows[0] if isinstance(rows, list) else rows
+        return bool(row["granted"]), float(row.get("wait") or 0.0)
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        if ADMISSION_STORE == "supabase":
+            _store = SupabaseStore()
+        elif ADMISSION_STORE == "file":
+            _store = FileStore()
+        else:
+            _store = MemoryStore()
+    return _store
+
+
+def set_store(store):
+    """Replaces the bucket store, e.g. with a fresh MemoryStore in scripts."""
+    global _store
+    _store = store
+
+# ==============================================================================
+# FAIR QUEUE
+# ==============================================================================
+
+class FairQueue:
+    """Weighted fair queuing over a fixed number of concurrent slots.
+
+    Each waiting request gets a virtual finish tag of
+    max(virtual_time, previous tag of the same key) + cost / weight, and free
+    slots go to the smallest tag. A user with many queued textbook requests
+    therefore cannot starve another user's single chat turn.
+    """
+
+    def __init__(self, slots=ADMISSION_CONCURRENCY):
+        self.slots = slots
+        self.active = 0
+        self.virtual_time = 0.0
+        self.last_tags = {}
+        self.waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, key, cost, weight=1.0, timeout=ADMISSION_QUEUE_TIMEOUT) -> bool:
+        with self._condition:
+            tag = max(self.virtual_time, self.last_tags.get(key, 0.0)) + cost / weight
+            self.last_tags[key] = tag
+            entry = (tag, next(self._sequence), key)
+            heapq.heappush(self.waiting, entry)
+            expires_at = time.monotonic() + timeout
+            while not (self.waiting[0] is entry and self.active < self.slots):
+                remaining = expires_at - time.monotonic()
+                if remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self._condition.notify_all()
+                    return False
+                self._condition.wait(remaining)
+            heapq.heappop(self.waiting)
+            self.active += 1
+            self.virtual_time = max(self.virtual_time, tag - cost / weight)
+            if len(self.last_tags) > 10_000:
+                self.last_tags = {k: t for k, t in self.last_tags.items() if t > self.virtual_time}
+            self._condition.notify_all()
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def depth(self) -> int:
+        with self._condition:
+            return len(self.waiting)
+
+
+_queue = FairQueue()
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+class Ticket:
+    """An admitted request. release() frees its queue slot; charge_model() bills a Pro surcharge."""
+
+    def __init__(self, endpoint, key, cost, queued):
+        self.endpoint = endpoint
+        self.key = key
+        self.cost = cost
+        self.queued = queued
+        self.released = not queued
+
+    def charge_model(self, model_name: str):
+        if not ADMISSION_ENABLED or 'pro' not in model_name:
+            return
+        surcharge = self.cost * (PRO_COST_MULTIPLIER - 1)
+        try:
+            get_store().take(self.key, surcharge, ADMISSION_REFILL_PER_MINUTE / 60, ADMISSION_CAPACITY, force=True)
+            self.cost += surcharge
+        except Exception as e:
+            print(f"WARN: Pro 추가 비용 청구 실패 ({self.key}): {e}")
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            _queue.release()
+
+    def describe(self) -> dict:
+        return {"key": self.key.split(':', 1)[0], "cost": self.cost}
+
+
+def admit(endpoint: str, key: str, deadline=None) -> Ticket:
+    """Charges the endpoint's cost to key's bucket and waits for a fair-queue slot.
+
+    Raises AdmissionRejected with a Retry-After estimate when the bucket is
+    empty or no slot frees up within the queue timeout (or the deadline).
+    A failing store admits the request rather than blocking every user.
+    """
+    if not ADMISSION_ENABLED:
+        return Ticket(endpoint, key, 0, queued=False)
+    cost = endpoint_cost(endpoint)
+    rate = ADMISSION_REFILL_PER_MINUTE / 60
+    try:
+        granted, wait = get_store().take(key, cost, rate, ADMISSION_CAPACITY)
+    except Exception as e:
+        print(f"WARN: 요청 허용량 저장소 오류, 제한 없이 진행합니다: {e}")
+        granted, wait = True, 0.0
+    if not granted:
+        inc("admission_decisions_total", endpoint=endpoint, result="rejected_rate")
+        raise AdmissionRejected(f"요청 허용량을 모두 사용했습니다. 약 {math.ceil(wait)}초 후 다시 시도해 주세요.",
+                                wait, "rate")
+
+    timeout = ADMISSION_QUEUE_TIMEOUT
+    if deadline is not None:
+        timeout = min(timeout, deadline.remaining())
+    started = time.monotonic()
+    weight = KEY_WEIGHTS.get(key.split(':', 1)[0], 1.0)
+    if not _queue.acquire(key, cost, weight, timeout):
+        try:
+            get_store().take(key, -cost, rate, ADMISSION_CAPACITY, force=True)  # 처리하지 못한 요청은 환불합니다.
+        except Exception as e:
+            print(f"WARN: 대기 시간 초과 요청 환불 실패 ({key}): {e}")
+        inc("admission_decisions_total", endpoint=endpoint, result="rejected_queue")
+        retry_after = max(1.0, timeout * _queue.depth() / max(1, _queue.slots))
+        raise AdmissionRejected("요청이 많아 대기 시간이 초과되었습니다. 잠시 후 다시 시도해 주세요.",
+                                retry_after, "queue")
+    waited = time.monotonic() - started
+    observe("admission_queue_wait_seconds", waited, endpoint=endpoint)
+    inc("admission_decisions_total", endpoint=endpoint, result="queued" if waited > 0.01 else "admitted")
+    return Ticket(endpoint, key, cost, queued=True)
+
+
+def send_rejection(handler, error: AdmissionRejected):
+    """Answers 429 with Retry-After for a rejected request."""
+    print(f"WARN: 요청 거부 ({error.reason}): {error}")
+    send_json(handler, 429, {"error": str(error), "reason": error.reason, "retryAfter": math.ceil(error.retry_after)},
+              headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))})
@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .metrics import classify_error, inc, set_gauge
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "1") != "0"
+BREAKER_WINDOW_SECONDS = float(os.getenv("CIRCUIT_BREAKER_WINDOW", "60"))    # 오류율을 계산하는 최근 구간
+BREAKER_MIN_CALLS = int(os.getenv("CIRCUIT_BREAKER_MIN_CALLS", "4"))         # 오류율 판단에 필요한 최소 호출 수
+BREAKER_ERROR_RATE = float(os.getenv("CIRCUIT_BREAKER_ERROR_RATE", "0.5"))   # 구간 내 실패(느린 호출 포함) 비율
+BREAKER_CONSECUTIVE_FAILURES = int(os.getenv("CIRCUIT_BREAKER_CONSECUTIVE", "3"))  # 트래픽이 적어도 연속 실패면 차단
+BREAKER_OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "30"))  # 차단 후 반개방 시험까지 대기
+BREAKER_MAX_OPEN_SECONDS = 300.0   # 시험 호출이 계속 실패하면 대기 시간을 두 배씩 늘리는 상한
+BREAKER_HALF_OPEN_PROBES = 1       # 반개방 상태에서 동시에 허용하는 시험 호출 수
+# 이보다 오래 걸린 호출은 성공했더라도 실패로 셉니다. 스트리밍은 첫 응답까지의 시간입니다.
+SLOW_CALL_SECONDS = {
+    "openrouter": 20.0,
+    "gemini": 60.0,
+    "apify": 60.0,       # get_apify_run은 최대 APIFY_POLL_WAIT초 동안 롱 폴링합니다.
+    "apify_sync": 200.0,  # 동기 엔드포인트는 스크래핑이 끝날 때까지 응답하지 않습니다.
+    "supabase": 10.0,
+    "supabase_storage": 30.0,
+}
+DEFAULT_SLOW_CALL_SECONDS = 30.0
+# 키 하나의 문제(한도 초과, 인증 실패)는 해당 키 차단기에만 반영하고 업스트림 전체에는 반영하지 않습니다.
+KEY_ONLY_ERRORS = {"rate_limit", "auth"}
+# 잘못된 요청은 업스트림 상태와 무관하므로 어느 차단기에도 반영하지 않습니다.
+IGNORED_ERRORS = {"client"}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(ConnectionError):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+    def __init__(self, upstream, key=None, retry_after=0.0):
+        label = f"{upstream} 키 #{key}" if key is not None else upstream
+        super().__init__(f"'{label}' 업스트림이 차단된 상태입니다. 약 {retry_after:.0f}초 후 다시 시도합니다.")
+        self.upstream = upstream
+        self.key = key
+        self.retry_after = retry_after
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+class CircuitBreaker:
+    """Per-process breaker for one upstream, or one API key of an upstream.
+
+    Closed: calls pass and outcomes are kept for BREAKER_WINDOW_SECONDS. The
+    breaker opens when the window's failure rate (errors plus slow calls)
+    reaches BREAKER_ERROR_RATE over at least BREAKER_MIN_CALLS calls, or after
+    BREAKER_CONSECUTIVE_FAILURES failures in a row. Open: calls are rejected
+    until the cooldown passes. Half-open: BREAKER_HALF_OPEN_PROBES probe
+    calls go through; a success closes the breaker, a failure reopens it with
+    a doubled cooldown.
+    """
+
+    def __init__(self, upstream: str, key=None):
+        self.upstream = upstream
+        self.key = key
+        self.slow_call_seconds = float(os.getenv(f"CIRCUIT_BREAKER_SLOW_{upstream.upper()}",
+                                                 SLOW_CALL_SECONDS.get(upstream, DEFAULT_SLOW_CALL_SECONDS)))
+        self.state = CLOSED
+        self.outcomes = []  # (timestamp, failed)
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.cooldown = BREAKER_OPEN_SECONDS
+        self.probes = 0
+        self.probe_started = 0.0
+        self._lock = threading.Lock()
+        self._publish()
+
+    def _labels(self):
+        return {"upstream": self.upstream, "key": self.key if self.key is not None else "all"}
+
+    def _publish(self):
+        set_gauge("circuit_breaker_state", STATE_VALUES[self.state], **self._labels())
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        inc("circuit_breaker_transitions_total", to=state, **self._labels())
+        self._publish()
+        label = f"{self.upstream} 키 #{self.key}" if self.key is not None else self.upstream
+        print(f"INFO: 서킷 브레이커 '{label}' 상태 변경 -> {state}")
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        """True if a call may go out now; moves an open breaker to half-open once cooled down."""
+        if not BREAKER_ENABLED:
+            return True
+        with self._lock:
+            if self.state == OPEN:
+                if self.retry_after() > 0:
+                    inc("circuit_breaker_rejections_total", **self._labels())
+                    return False
+                self._transition(HALF_OPEN)
+                self.probes = 0
+            if self.state == HALF_OPEN:
+                # 결과가 기록되지 않은 시험 호출이 슬롯을 영원히 잡고 있지 않도록 합니다.
+                probe_expired = time.monotonic() - self.probe_started > self.slow_call_seconds
+                if self.probes >= BREAKER_HALF_OPEN_PROBES and not probe_expired:
+                    inc("circuit_breaker_rejections_total", **self._labels())
+                    return False
+                self.probes = 1 if probe_expired else self.probes + 1
+                self.probe_started = time.monotonic()
+            return True
+
+    def release(self):
+        """Gives back a half-open probe slot claimed by allow() when the call never went out."""
+        with self._lock:
+            if self.state == HALF_OPEN and self.probes:
+                self.probes -= 1
+
+    def record(self, latency: float, failed: bool):
+        """Records one call outcome; latency above the slow threshold counts as a failure."""
+        failed = failed or latency > self.slow_call_seconds
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self.cooldown = min(self.cooldown * 2, BREAKER_MAX_OPEN_SECONDS)
+                    self._open(now)
+                else:
+                    self.cooldown = BREAKER_OPEN_SECONDS
+                    self.outcomes, self.consecutive_failures = [], 0
+                    self._transition(CLOSED)
+                return
+            self.outcomes = [o for o in self.outcomes if now - o[0] <= BREAKER_WINDOW_SECONDS]
+            self.outcomes.append((now, failed))
+            self.consecutive_failures = self.consecutive_failures + 1 if failed else 0
+            failures = sum(1 for _, f in self.outcomes if f)
+            if self.state == CLOSED and (
+                self.consecutive_failures >= BREAKER_CONSECUTIVE_FAILURES
+                or (len(self.outcomes) >= BREAKER_MIN_CALLS and failures / len(self.outcomes) >= BREAKER_ERROR_RATE)
+            ):
+                self._open(now)
+
+    def _open(self, now):
+        self.opened_at = now
+        self.probes = 0
+        self._transition(OPEN)
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {**self._labels(), "state": self.state, "retry_after": round(self.retry_after(), 1),
+                    "window_calls": len(self.outcomes), "consecutive_failures": self.consecutive_failures}
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(upstream: str, key=None) -> CircuitBreaker:
+    with _registry_lock:
+        breaker = _registry.get((upstream, key))
+        if breaker is None:
+            breaker = _registry[(upstream, key)] = CircuitBreaker(upstream, key)
+        return breaker
+
+
+def is_available(upstream: str, key=None) -> bool:
+    """Checks (and, when cooled down, claims a probe slot of) the upstream and key breakers."""
+    upstream_breaker = get_breaker(upstream)
+    if not upstream_breaker.allow():
+        return False
+    if key is not None and not get_breaker(upstream, key).allow():
+        upstream_breaker.release()
+        return False
+    return True
+
+
+def record_outcome(upstream: str, key=None, started: float = None, error=None):
+    """Feeds one call outcome to the upstream breaker and, if given, the key's breaker.
+
+    started is a time.monotonic() value taken before the call.
+    """
+    latency = time.monotonic() - started if started is not None else 0.0
+    error_class = classify_error(error) if error is not None else None
+    if error_class in IGNORED_ERRORS:
+        failed = False
+    else:
+        failed = error is not None
+    if key is not None:
+        get_breaker(upstream, key).record(latency, failed)
+    if error_class not in KEY_ONLY_ERRORS or key is None:
+        get_breaker(upstream).record(latency, failed)
+
+
+@contextmanager
+def guard(upstream: str, key=None):
+    """Wraps one upstream call: raises CircuitOpen when blocked, otherwise records the outcome."""
+    if not is_available(upstream, key):
+        retry_after = max(get_breaker(upstream).retry_after(), get_breaker(upstream, key).retry_after())
+        raise CircuitOpen(upstream, key, retry_after)
+    started = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        record_outcome(upstream, key, started, e)
+        raise
+    record_outcome(upstream, key, started)
@@ -0,0 +1,221 @@
+import hashlib
+import io
+import math
+import os
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+GEMINI_TOKENS_PER_PAGE = 258  # Gemini는 PDF 페이지/이미지 타일 하나를 약 258 토큰으로 계산합니다.
+IMAGE_TILE_SIZE = 768
+MODEL_INPUT_TOKEN_LIMITS = {
+    "gemini-2.5-pro": 1_048_576,
+    "gemini-2.5-flash": 1_048_576,
+}
+DEFAULT_INPUT_TOKEN_LIMIT = 1_048_576
+# 출력 토큰과 추정 오차를 위한 여유분을 남겨 둡니다.
+INPUT_BUDGET_RATIO = float(os.getenv("GEMINI_INPUT_BUDGET_RATIO", "0.8"))
+MIN_TRUNCATED_TEXT_CHARS = 2000
+TRUNCATION_NOTICE = "\n\n...(입력 한도를 맞추기 위해 이하 내용이 생략되었습니다)..."
+
+
+class TokenBudgetExceeded(ValueError):
+    """Raised when a request cannot be reduced below the model's input budget."""
+
+# ==============================================================================
+# ESTIMATION
+# ==============================================================================
+
+def estimate_text_tokens(text: str) -> int:
+    """Rough token estimate: ~4 ASCII chars or ~1.5 CJK chars per token."""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    other_chars = len(text) - ascii_chars
+    return int(ascii_chars / 4 + other_chars / 1.5) + 1
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Gemini bills small images as one tile and larger ones per 768px tile."""
+    if width <= 384 and height <= 384:
+        return GEMINI_TOKENS_PER_PAGE
+    return math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE) * GEMINI_TOKENS_PER_PAGE
+
+
+def _count_pdf_pages(data: bytes) -> int:
+    try:
+        from pypdf import PdfReader
+        return len(PdfReader(io.BytesIO(data)).pages)
+    except Exception:
+        # 페이지 수를 알 수 없으면 페이지당 약 100KB로 가정합니다.
+        return max(1, len(data) // 100_000)
+
+
+def _inline_data(part):
+    inline_data = getattr(part, 'inline_data', None)
+    if inline_data is not None and getattr(inline_data, 'mime_type', ''):
+        return inline_data
+    return None
+
+
+def classify_part(part):
+    """Returns (category, tokens) for a single generate_content part."""
+    if isinstance(part, str):
+        return "text", estimate_text_tokens(part)
+    if hasattr(part, 'size') and hasattr(part, 'mode'):  # PIL.Image
+        width, height = part.size
+        return "image", estimate_image_tokens(width, height)
+    inline_data = _inline_data(part)
+    if inline_data is not None:
+        if inline_data.mime_type == 'application/pdf':
+            return "pdf", _count_pdf_pages(inline_data.data) * GEMINI_TOKENS_PER_PAGE
+        if inline_data.mime_type.startswith('image/'):
+            try:
+                from PIL import Image
+                with Image.open(io.BytesIO(inline_data.data)) as img:
+                    return "image", estimate_image_tokens(*img.size)
+            except Exception:
+                return "image", GEMINI_TOKENS_PER_PAGE
+    return "other", 0
+
+
+def estimate_request(contents, instruction_tokens: int = 0):
+    """Estimates the input tokens of a request, broken down by part category.
+
+    The first part is always the instruction prompt; instruction_tokens covers
+    a system instruction sent outside contents.
+    """
+    breakdown = {"prompt": instruction_tokens, "text": 0, "image": 0, "pdf": 0, "other": 0}
+    for index, part in enumerate(contents):
+        category, tokens = classify_part(part)
+        if index == 0 and category == "text":
+            category = "prompt"
+        breakdown[category] += tokens
+    breakdown["total"] = sum(breakdown.values())
+    return breakdown
+
+
+def input_token_budget(model_name: str) -> int:
+    limit = MODEL_INPUT_TOKEN_LIMITS.get(model_name.replace('models/', ''), DEFAULT_INPUT_TOKEN_LIMIT)
+    return int(limit * INPUT_BUDGET_RATIO)
+
+# ==============================================================================
+# REDUCTION POLICY
+# ==============================================================================
+
+def _part_fingerprint(part):
+    if isinstance(part, str):
+        return hashlib.sha1(part.strip().encode('utf-8')).hexdigest()
+    if hasattr(part, 'tobytes') and hasattr(part, 'size'):
+        return hashlib.sha1(part.tobytes()).hexdigest()
+    inline_data = _inline_data(part)
+    if inline_data is not None:
+        return hashlib.sha1(inline_data.data).hexdigest()
+    return None
+
+
+def _drop_duplicates(contents, actions):
+    seen = set()
+    result = []
+    for index, part in enumerate(contents):
+        fingerprint = _part_fingerprint(part)
+        # 짧은 구분용 문자열("--- 이미지 #1 ---" 등)은 중복이어도 남겨 둡니다.
+        is_marker = isinstance(part, str) and len(part) < 200
+        if index > 0 and fingerprint and not is_marker and fingerprint in seen:
+            actions.append({"action": "drop_duplicate", "index": index})
+            continue
+        if fingerprint:
+            seen.add(fingerprint)
+        result.append(part)
+    return result
+
+
+def _downscale_inline_image(inline_data):
+    import google.ai.generativelanguage as glm
+    from PIL import Image
+    with Image.open(io.BytesIO(inline_data.data)) as img:
+        width, height = img.size
+        if max(width, height) <= IMAGE_TILE_SIZE:
+            return None, (width, height), (width, height)
+        img.draft('RGB', (IMAGE_TILE_SIZE, IMAGE_TILE_SIZE))
+        small = img.convert('RGB')
+    small.thumbnail((IMAGE_TILE_SIZE, IMAGE_TILE_SIZE))
+    buffer = io.BytesIO()
+    small.save(buffer, format='JPEG', quality=90)
+    return glm.Part(inline_data=glm.Blob(mime_type='image/jpeg', data=buffer.getvalue())), (width, height), small.size
+
+
+def _downscale_images(contents, actions):
+    result = []
+    for index, part in enumerate(contents):
+        if hasattr(part, 'size') and hasattr(part, 'thumbnail'):
+            width, height = part.size
+            if max(width, height) > IMAGE_TILE_SIZE:
+                part = part.copy()
+                part.thumbnail((IMAGE_TILE_SIZE, IMAGE_TILE_SIZE))
+                actions.append({"action": "downscale_image", "index": index, "from": [width, height], "to": list(part.size)})
+        else:
+            inline_data = _inline_data(part)
+            if inline_data is not None and inline_data.mime_type.startswith('image/'):
+                try:
+                    smaller, before, after = _downscale_inline_image(inline_data)
+                except Exception:
+                    smaller = None
+                if smaller is not None:
+                    part = smaller
+                    actions.append({"action": "downscale_image", "index": index, "from": list(before), "to": list(after)})
+        result.append(part)
+    return result
+
+
+def _truncate_text(contents, overflow, actions):
+    # 프롬프트(0번)를 제외한 긴 텍스트 파트를, 길이에 비례하여 잘라냅니다.
+    candidates = [
+        (index, part) for index, part in enumerate(contents)
+        if index > 0 and isinstance(part, str) and len(part) > MIN_TRUNCATED_TEXT_CHARS
+    ]
+    total_tokens = sum(estimate_text_tokens(part) for _, part in candidates)
+    if not candidates or total_tokens == 0:
+        return contents
+    # 생략 안내 문구와 반올림 오차만큼 여유를 더 둡니다.
+    overflow += len(candidates) * (estimate_text_tokens(TRUNCATION_NOTICE) + 1)
+    keep_ratio = max(0.0, 1 - overflow / total_tokens)
+    result = list(contents)
+    for index, part in candidates:
+        keep_chars = max(MIN_TRUNCATED_TEXT_CHARS, int(len(part) * keep_ratio))
+        if keep_chars < len(part):
+            result[index] = part[:keep_chars] + TRUNCATION_NOTICE
+            actions.append({"action": "truncate_text", "index": index, "from_chars": len(part), "to_chars": keep_chars})
+    return result
+
+
+def govern_request(contents, model_name: str, budget: int = None, instruction_tokens: int = 0):
+    """Applies a deterministic reduction policy until the request fits the input budget.
+
+    Steps run in order and stop as soon as the estimate fits: drop duplicate
+    parts, downscale large images to a single tile, truncate long text parts.
+    Returns (contents, report); raises TokenBudgetExceeded if it still does not fit.
+    """
+    budget = budget or input_token_budget(model_name)
+    before = estimate_request(contents, instruction_tokens)
+    actions = []
+    report = {"model": model_name, "budget": budget, "before": before, "after": before, "actions": actions}
+    if before["total"] <= budget:
+        return contents, report
+
+    print(f"WARN: 입력 토큰 추정치 {before['total']}이(가) 예산 {budget}을(를) 초과하여 축소 정책을 적용합니다.")
+    contents = _drop_duplicates(contents, actions)
+    estimate = estimate_request(contents, instruction_tokens)
+    if estimate["total"] > budget:
+        contents = _downscale_images(contents, actions)
+        estimate = estimate_request(contents, instruction_tokens)
+    if estimate["total"] > budget:
+        contents = _truncate_text(contents, estimate["total"] - budget, actions)
+        estimate = estimate_request(contents, instruction_tokens)
+
+    report["after"] = estimate
+    if estimate["total"] > budget:
+        raise TokenBudgetExceeded(
+            f"자료가 너무 많아 모델 입력 한도를 초과합니다. (추정 {estimate['total']} 토큰 / 예산 {budget} 토큰)"
+        )
+    return contents, report
@@ -0,0 +1,156 @@
+import gzip
+import json
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # 11은 너무 느리므로 응답 지연과 압축률 사이에서 타협합니다.
+ZSTD_LEVEL = 6
+
+# ==============================================================================
+# NEGOTIATION
+# ==============================================================================
+
+def available_encodings():
+    """Encodings this server can produce, in order of preference."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def negotiate_encoding(accept_encoding: str):
+    """Picks the best encoding from an Accept-Encoding header, or None for identity."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        token, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    candidates = [
+        encoding for encoding in available_encodings()
+        if accepted.get(encoding, accepted.get('*', 0)) > 0
+    ]
+    if not candidates:
+        return None
+    # q 값이 같으면 available_encodings()의 선호 순서를 따릅니다.
+    return max(candidates, key=lambda e: (accepted.get(e, accepted.get('*', 0)), -candidates.index(e)))
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return body
+
+# ==============================================================================
+# RESPONSE HELPERS
+# ==============================================================================
+
+def send_json(handler, status_code: int, payload, ensure_ascii: bool = False, headers=None):
+    """Writes a JSON response, compressed per Accept-Encoding when it is large enough."""
+    body = json.dumps(payload, ensure_ascii=ensure_ascii).encode('utf-8')
+    encoding = None
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        encoding = negotiate_encoding(handler.headers.get('Accept-Encoding', ''))
+    if encoding:
+        body = compress(body, encoding)
+    handler.send_response(status_code)
+    handler.send_header('Content-type', 'application/json; charset=utf-8')
+    handler.send_header('Vary', 'Accept-Encoding')
+    if encoding:
+        handler.send_header('Content-Encoding', encoding)
+    handler.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class StreamCompressor:
+    """File-like wrapper that compresses an event stream and sync-flushes on every flush().
+
+    Each flush() emits a complete compressed block so the browser can decode
+    frames as they arrive.
+    """
+
+    def __init__(self, wfile, encoding: str):
+        self.wfile = wfile
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            raise ValueError(f"지원하지 않는 인코딩: {encoding}")
+
+    def write(self, data: bytes):
+        if self.encoding == "br":
+            chunk = self._compressor.process(data)
+        else:
+            chunk = self._compressor.compress(data)
+        if chunk:
+            self.wfile.write(chunk)
+
+    def flush(self):
+        if self.encoding == "gzip":
+            chunk = self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        elif self.encoding == "br":
+            chunk = self._compressor.flush()
+        else:
+            chunk = self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if chunk:
+            self.wfile.write(chunk)
+        self.wfile.flush()
+
+    def finish(self):
+        """Ends the compressed stream; the underlying wfile stays open."""
+        if self.encoding == "br":
+            chunk = self._compressor.finish()
+        else:
+            chunk = self._compressor.flush()
+        if chunk:
+            self.wfile.write(chunk)
+        self.wfile.flush()
+
+
+def start_event_stream(handler):
+    """Sends SSE headers and returns the (possibly compressing) stream to write frames to."""
+    encoding = negotiate_encoding(handler.headers.get('Accept-Encoding', ''))
+    handler.send_response(200)
+    handler.send_header('Content-type', 'text/event-stream; charset=utf-8')
+    handler.send_header('Cache-Control', 'no-cache')
+    handler.send_header('Vary', 'Accept-Encoding')
+    if encoding:
+        handler.send_header('Content-Encoding', encoding)
+    handler.end_headers()
+    return StreamCompressor(handler.wfile, encoding) if encoding else handler.wfile
@@ -0,0 +1,82 @@
+import os
+import time
+
+from .metrics import inc
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+# vercel.json의 maxDuration과 맞춰 둡니다. 지정이 없는 함수는 플랫폼 기본값을 따릅니다.
+FUNCTION_MAX_DURATION = {
+    "summarize_youtube": 300,
+    "create_textbook": 300,
+    "process_calendar": 300,
+    "add_synced_media": 60,  # api/add-synced-media.py (환경 변수 이름에 '-'를 쓸 수 없어 '_'로 씁니다)
+}
+DEFAULT_MAX_DURATION = float(os.getenv("REQUEST_DEADLINE_SECONDS", "60"))
+# 플랫폼이 함수를 끊기 전에 타임아웃/부분 응답을 보낼 시간을 남겨 둡니다.
+RESPONSE_RESERVE_SECONDS = float(os.getenv("REQUEST_DEADLINE_RESERVE", "4"))
+MIN_ATTEMPT_SECONDS = 3.0    # 남은 시간이 이보다 짧으면 새 키 시도를 시작하지 않습니다.
+DOWNLOAD_TIMEOUT = 30.0      # 파일 하나를 받는 데 쓰는 최대 시간
+STREAM_READ_TIMEOUT = 60.0   # 스트림에서 다음 청크를 기다리는 최대 시간
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a request has used up its time budget."""
+
+
+def request_budget(endpoint: str) -> float:
+    override = os.getenv(f"REQUEST_DEADLINE_{endpoint.upper()}")
+    if override:
+        return float(override)
+    return float(FUNCTION_MAX_DURATION.get(endpoint, DEFAULT_MAX_DURATION))
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+class Deadline:
+    """Request-scoped time budget, created at handler entry and passed to every stage.
+
+    Stages ask for timeout(cap) before each download, key attempt or stream
+    read; it returns the smaller of cap and the remaining budget, or raises
+    DeadlineExceeded once too little is left to be useful.
+    """
+
+    def __init__(self, endpoint: str, budget: float = None):
+        self.endpoint = endpoint
+        self.budget = budget or request_budget(endpoint)
+        self.started = time.monotonic()
+        self.expires_at = self.started + max(1.0, self.budget - RESPONSE_RESERVE_SECONDS)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str, need: float = 0.0):
+        """Raises DeadlineExceeded if less than `need` seconds remain before `stage`."""
+        if self.remaining() <= need:
+            inc("request_deadline_exceeded_total", endpoint=self.endpoint, stage=stage)
+            raise DeadlineExceeded(
+                f"요청 시간 예산 {self.budget:.0f}초를 모두 사용하여 '{stage}' 단계를 진행할 수 없습니다. "
+                f"(경과 {self.elapsed():.1f}초)"
+            )
+
+    def timeout(self, stage: str, cap: float = None, need: float = 0.0) -> float:
+        """Seconds the next operation may take: min(cap, remaining), after check(stage, need)."""
+        self.check(stage, need)
+        remaining = self.remaining()
+        return min(cap, remaining) if cap else remaining
+
+    def request_options(self, stage: str = "model", cap: float = None) -> dict:
+        """request_options for generate_content, bounded by the remaining budget."""
+        return {"timeout": self.timeout(stage, cap, MIN_ATTEMPT_SECONDS)}
+
+    def describe(self) -> dict:
+        return {"budget": self.budget, "elapsed": round(self.elapsed(), 2), "remaining": round(self.remaining(), 2)}
@@ -0,0 +1,205 @@
+import hashlib
+import io
+import os
+import re
+
+from .budget import classify_part, estimate_text_tokens, _inline_data
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+DEDUP_ENABLED = os.getenv("MATERIAL_DEDUP_ENABLED", "1") != "0"
+# 64비트 dHash 기준 해밍 거리. 애니메이션 빌드 슬라이드처럼 거의 같은 페이지를 묶습니다.
+DEDUP_HASH_DISTANCE = int(os.getenv("MATERIAL_DEDUP_HASH_DISTANCE", "6"))
+DEDUP_MIN_TEXT_CHARS = 40  # 이보다 짧은 페이지 텍스트는 중복 판정에서 제외
+DEDUP_NOTICE = " (앞의 자료와 거의 동일하여 생략됨)"
+
+# prepare_pdf_parts가 붙이는 페이지 머리글: "--- {label} p.{n} ---"
+_PAGE_HEADER = re.compile(r"^--- .+ p\.\d+ ---$", re.MULTILINE)
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+# 같은 템플릿 페이지끼리 달라지는 쪽 번호와 날짜만 지웁니다. 본문의 숫자(문제 값, 표, 수식)는 남깁니다.
+# 쪽 번호는 페이지의 첫 줄/마지막 줄에서만 찾습니다: "12", "- 12 -", "12 / 30", "p. 12", "Page 12 of 30"
+_PAGE_NUMBER = re.compile(
+    r"(?:^|\s)(?:-\s*\d+\s*-|\d+\s*/\s*\d+|(?:p\.|page)\s*\d+(?:\s*(?:/|of)\s*\d+)?)\s*$|^\s*\d+\s*$",
+    re.IGNORECASE,
+)
+_DATE = re.compile(
+    r"\b\d{4}\s*[-./]\s*\d{1,2}\s*[-./]\s*\d{1,2}\b"
+    r"|\b\d{1,2}\s*[-./]\s*\d{1,2}\s*[-./]\s*\d{4}\b"
+    r"|(?:\d{4}\s*년\s*)?\d{1,2}\s*월\s*\d{1,2}\s*일"
+)
+
+# ==============================================================================
+# HASHING
+# ==============================================================================
+
+def _part_image(part):
+    if hasattr(part, 'size') and hasattr(part, 'mode'):  # PIL.Image
+        return part
+    inline_data = _inline_data(part)
+    if inline_data is not None and inline_data.mime_type.startswith('image/'):
+        from PIL import Image
+        image = Image.open(io.BytesIO(inline_data.data))
+        # 해시는 9x8 흑백이면 충분하므로, JPEG는 1/8 크기 흑백으로만 디코딩합니다.
+        image.draft('L', (64, 64))
+        return image
+    return None
+
+
+def image_hash(image, hash_size: int = 8) -> int:
+    """Difference hash (dHash) of an image, hash_size * hash_size bits (64 by default)."""
+    from PIL import Image
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def text_hash(text: str):
+    """Hash of text with case, punctuation, whitespace, page numbers and dates removed.
+
+    Page numbers and dates differ between otherwise identical template pages,
+    so they are ignored; other digits are kept, since pages that differ only
+    in numbers (exercise values, tables, formulas) are different material.
+    Returns None for text too short to judge.
+    """
+    lines = text.strip().splitlines() or [""]
+    lines[0] = _PAGE_NUMBER.sub("", lines[0])
+    lines[-1] = _PAGE_NUMBER.sub("", lines[-1])
+    text = _DATE.sub("", "\n".join(lines))
+    normalized = _NON_WORD.sub("", text).lower()
+    if len(normalized) < DEDUP_MIN_TEXT_CHARS:
+        return None
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def _part_bytes(part) -> int:
+    if isinstance(part, str):
+        return len(part.encode('utf-8'))
+    inline_data = _inline_data(part)
+    if inline_data is not None:
+        return len(inline_data.data)
+    if hasattr(part, 'save'):
+        # genai는 PIL 이미지를 무손실 WebP로 인코딩해 보냅니다.
+        buffer = io.BytesIO()
+        try:
+            part.save(buffer, format='webp', lossless=True)
+        except Exception:
+            return 0
+        return buffer.tell()
+    return 0
+
+
+def _split_pages(text: str):
+    """Splits a text part into (header, body) segments on prepare_pdf_parts page headers."""
+    headers = list(_PAGE_HEADER.finditer(text))
+    if not headers:
+        return [("", text)]
+    segments = []
+    if text[:headers[0].start()].strip():
+        segments.append(("", text[:headers[0].start()]))
+    for index, match in enumerate(headers):
+        end = headers[index + 1].start() if index + 1 < len(headers) else len(text)
+        segments.append((match.group(0), text[match.end():end]))
+    return segments
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def _is_marker(part) -> bool:
+    return isinstance(part, str) and len(part) < 200 and part.lstrip().startswith("---")
+
+
+def dedup_materials(contents, max_distance: int = None):
+    """Collapses near-duplicate slides and pages before they are sent to the model.
+
+    Images (uploaded or rasterized pages) are compared by perceptual hash within
+    max_distance bits; text pages are compared by normalized-text hash. The first
+    occurrence is kept. The prompt (index 0) and short marker strings are never
+    removed; a marker right before a dropped image is annotated instead.
+    Returns (contents, report).
+    """
+    max_distance = DEDUP_HASH_DISTANCE if max_distance is None else max_distance
+    report = {"enabled": DEDUP_ENABLED, "images_checked": 0, "text_pages_checked": 0,
+              "removed": [], "saved_bytes": 0, "saved_tokens": 0}
+    if not DEDUP_ENABLED:
+        return contents, report
+
+    image_hashes = []
+    text_hashes = set()
+    result = []
+
+    def record(index, kind, saved_bytes, saved_tokens, **extra):
+        report["removed"].append({"index": index, "kind": kind, "bytes": saved_bytes, "tokens": saved_tokens, **extra})
+        report["saved_bytes"] += saved_bytes
+        report["saved_tokens"] += saved_tokens
+
+    for index, part in enumerate(contents):
+        if index == 0 or _is_marker(part):
+            result.append(part)
+            continue
+
+        if isinstance(part, str):
+            kept = []
+            dropped = False
+            for header, body in _split_pages(part):
+                digest = text_hash(body)
+                if digest is None:
+                    kept.append(header + body)
+                    continue
+                report["text_pages_checked"] += 1
+                if digest in text_hashes:
+                    segment = header + body
+                    record(index, "text", len(segment.encode('utf-8')), estimate_text_tokens(segment), page=header.strip("- ") or None)
+                    dropped = True
+                    continue
+                text_hashes.add(digest)
+                kept.append(header + body)
+            if not dropped:
+                result.append(part)
+            elif kept:
+                result.append("".join(kept))
+            continue
+
+        try:
+            image = _part_image(part)
+        except Exception:
+            image = None
+        if image is None:
+            result.append(part)
+            continue
+
+        report["images_checked"] += 1
+        digest = image_hash(image)
+        match = next((h for h in image_hashes if hamming_distance(h, digest) <= max_distance), None)
+        if match is None:
+            image_hashes.append(digest)
+            result.append(part)
+            continue
+
+        _, tokens = classify_part(part)
+        record(index, "image", _part_bytes(part), tokens, distance=hamming_distance(match, digest))
+        if len(result) > 1 and _is_marker(result[-1]):
+            result[-1] = result[-1] + DEDUP_NOTICE
+
+    return result, report
+
+
+def format_dedup_report(report) -> str:
+    """Formats a one-line summary of dedup_materials for logging."""
+    images = sum(1 for r in report["removed"] if r["kind"] == "image")
+    texts = len(report["removed"]) - images
+    return (
+        f"INFO: 중복 자료 제거: 이미지 {images}/{report['images_checked']}개, 텍스트 페이지 {texts}/{report['text_pages_checked']}개 "
+        f"(절감 {report['saved_bytes']}B, {report['saved_tokens']}tok)"
+    )
@@ -0,0 +1,162 @@
+import json
+import os
+import re
+import tempfile
+import time
+
+from .breaker import guard
+from .budget import estimate_text_tokens
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+DIGEST_DIR = os.getenv("REVIEW_DIGEST_DIR", os.path.join(tempfile.gettempdir(), "studious-digests"))
+DIGEST_TABLE = os.getenv("REVIEW_DIGEST_TABLE", "review_note_digests")
+DIGEST_MAX_OUTLINE = 20  # 다이제스트에 남길 최대 제목 수
+DIGEST_MAX_SUMMARY_CHARS = 800
+
+_SUMMARY_HEADING = re.compile(r"^#{1,4}\s*.*(Summary|요약).*$", re.IGNORECASE | re.MULTILINE)
+_HEADING = re.compile(r"^(#{2,4})\s+(.+)$", re.MULTILINE)
+_WEEK_NUMBER = re.compile(r"(\d+)")
+
+# ==============================================================================
+# DIGEST BUILDING
+# ==============================================================================
+
+def week_number(week):
+    """Returns the leading number of a week label such as "3주차", or None."""
+    match = _WEEK_NUMBER.search(str(week or ""))
+    return int(match.group(1)) if match else None
+
+
+def _summary_section(content: str) -> str:
+    match = _SUMMARY_HEADING.search(content or "")
+    if not match:
+        return ""
+    rest = content[match.end():]
+    next_heading = re.search(r"^#{1,4}\s", rest, re.MULTILINE)
+    summary = rest[:next_heading.start()] if next_heading else rest
+    return summary.strip()[:DIGEST_MAX_SUMMARY_CHARS]
+
+
+def build_digest(note, week):
+    """Builds a compact digest of a generated review note.
+
+    Keeps the title, section headings, key insights and the Summary section,
+    which is enough context for later weeks without re-sending the materials.
+    """
+    content = note.get("content", "") or ""
+    outline = [f"{'  ' * (len(level) - 2)}- {title.strip()}" for level, title in _HEADING.findall(content)]
+    digest = {
+        "week": week,
+        "title": note.get("title", ""),
+        "outline": outline[:DIGEST_MAX_OUTLINE],
+        "key_insights": list(note.get("key_insights", []) or []),
+        "summary": _summary_section(content),
+        "created_at": int(time.time()),
+    }
+    digest["tokens"] = estimate_text_tokens(format_digests([digest]))
+    return digest
+
+
+def format_digests(digests) -> str:
+    """Renders digests as one text part for the request contents."""
+    sections = []
+    for digest in digests:
+        lines = [f"--- 이전 주차 요약: {digest.get('week')} ({digest.get('title', '')}) ---"]
+        if digest.get("outline"):
+            lines.append("[목차]\n" + "\n".join(digest["outline"]))
+        if digest.get("key_insights"):
+            lines.append("[핵심 인사이트]\n" + "\n".join(f"- {insight}" for insight in digest["key_insights"]))
+        if digest.get("summary"):
+            lines.append("[요약]\n" + digest["summary"])
+        sections.append("\n".join(lines))
+    return "\n\n".join(sections)
+
+# ==============================================================================
+# STORAGE
+# ==============================================================================
+
+def _supabase_client():
+    url = os.environ.get('VITE_PUBLICSUPABASE_URL')
+    key = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
+    if not url or not key:
+        return None
+    from supabase import create_client
+    return create_client(url, key)
+
+
+def _local_path(user_id, subject_id):
+    safe_user = re.sub(r"[^A-Za-z0-9_-]", "_", str(user_id))
+    safe_subject = re.sub(r"[^A-Za-z0-9_-]", "_", str(subject_id))
+    return os.path.join(DIGEST_DIR, safe_user, f"{safe_subject}.json")
+
+
+def _load_local(user_id, subject_id):
+    try:
+        with open(_local_path(user_id, subject_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_digest(user_id, subject_id, week, digest):
+    """Stores a digest under (user_id, subject_id, week), replacing any previous one.
+
+    user_id must be the verified caller (admission.verified_user_id); subject
+    ids come from the client and are only unique per user. Uses the Supabase
+    table DIGEST_TABLE when credentials are configured and falls back to a JSON
+    file per user and subject in DIGEST_DIR.
+    """
+    try:
+        supabase = _supabase_client()
+        if supabase is not None:
+            with guard('supabase'):
+                supabase.table(DIGEST_TABLE).upsert(
+                    {"user_id": str(user_id), "subject_id": str(subject_id), "week": str(week), "digest": digest},
+                    on_conflict="user_id,subject_id,week",
+                ).execute()
+            return
+    except Exception as e:
+        print(f"WARN: 다이제스트 Supabase 저장 실패, 로컬 파일에 저장합니다: {e}")
+
+    entries = _load_local(user_id, subject_id)
+    entries[str(week)] = digest
+    path = _local_path(user_id, subject_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_digests(user_id, subject_id, current_week=None):
+    """Returns the user's stored digests of a subject that precede current_week, oldest first.
+
+    A current_week without a number (e.g. an exam review) gets every stored week;
+    the current week's own digest is never included.
+    """
+    entries = None
+    try:
+        supabase = _supabase_client()
+        if supabase is not None:
+            with guard('supabase'):
+                rows = (supabase.table(DIGEST_TABLE).select("week, digest")
+                        .eq("user_id", str(user_id)).eq("subject_id", str(subject_id)).execute().data)
+            entries = {row["week"]: row["digest"] for row in rows or []}
+    except Exception as e:
+        print(f"WARN: 다이제스트 Supabase 조회 실패, 로컬 파일을 사용합니다: {e}")
+    if entries is None:
+        entries = _load_local(user_id, subject_id)
+
+    current_number = week_number(current_week)
+    selected = []
+    for week, digest in entries.items():
+        if str(week) == str(current_week):
+            continue
+        number = week_number(week)
+        if current_number is not None and (number is None or number >= current_number):
+            continue
+        selected.append(digest)
+    selected.sort(key=lambda d: (week_number(d.get("week")) is None, week_number(d.get("week")) or 0))
+    return selected
@@ -0,0 +1,172 @@
+import io
+import os
+import tempfile
+
+import requests
+
+from .pdf_text import format_pdf_report, prepare_pdf_parts
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+# 요청 하나가 강의 자료를 위해 붙잡아 두는 메모리 상한입니다. 인코딩된 파트는 요청 직렬화 때
+# 한 번 더 복사되므로 두 배로 계산하고, 디코딩 중인 이미지/PDF는 그 순간에만 더합니다.
+MATERIALS_MEMORY_CEILING = int(float(os.getenv("MATERIALS_MEMORY_CEILING_MB", "384")) * 1024 * 1024)
+MATERIALS_MAX_FILE_BYTES = int(float(os.getenv("MATERIALS_MAX_FILE_MB", "150")) * 1024 * 1024)
+MATERIALS_SPOOL_MEMORY = 4 * 1024 * 1024    # 이보다 큰 다운로드는 /tmp 임시 파일로 넘깁니다.
+MATERIALS_CHUNK_SIZE = 256 * 1024
+# Gemini는 큰 이미지를 768px 타일로 나누어 처리하므로, 이보다 큰 원본은 줄여서 보냅니다.
+MATERIAL_IMAGE_MAX_SIDE = int(os.getenv("MATERIAL_IMAGE_MAX_SIDE", "3072"))
+MATERIAL_IMAGE_JPEG_QUALITY = 90
+# 크기가 상한 이내이면 디코딩 없이 원본 바이트를 그대로 보내는 형식
+PASSTHROUGH_IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"}
+
+
+class MaterialsTooLarge(ValueError):
+    """Raised when a request's materials would exceed the memory ceiling or the per-file limit."""
+
+
+def part_nbytes(part) -> int:
+    """Bytes a request part occupies once built: text as UTF-8, inline data as its payload."""
+    if isinstance(part, str):
+        return len(part.encode('utf-8'))
+    inline_data = getattr(part, 'inline_data', None)
+    if inline_data is not None and getattr(inline_data, 'mime_type', ''):
+        return len(inline_data.data)
+    return 0
+
+
+def spool_size(spool) -> int:
+    """Size of a spooled download; leaves the position at the start."""
+    spool.seek(0, os.SEEK_END)
+    size = spool.tell()
+    spool.seek(0)
+    return size
+
+
+def _inline_part(mime_type: str, data: bytes):
+    import google.ai.generativelanguage as glm
+    return glm.Part(inline_data=glm.Blob(mime_type=mime_type, data=data))
+
+# ==============================================================================
+# MEMORY ACCOUNTING
+# ==============================================================================
+
+class MemoryCeiling:
+    """Accounts the memory one request holds for its materials.
+
+    hold() registers bytes that stay alive until the model call (built parts);
+    they count twice because generate_content serializes them into one more
+    copy. reserve() checks a short-lived buffer (a decoded bitmap, a PDF being
+    split) on top of that. Both raise MaterialsTooLarge instead of letting the
+    function run out of memory.
+    """
+
+    def __init__(self, ceiling: int = MATERIALS_MEMORY_CEILING):
+        self.ceiling = ceiling
+        self.held = 0
+        self.peak = 0
+
+    def _check(self, projected: int, label: str):
+        self.peak = max(self.peak, projected)
+        if projected > self.ceiling:
+            raise MaterialsTooLarge(
+                f"자료 '{label}'을(를) 처리하면 메모리 상한 {self.ceiling / 1e6:.0f}MB를 넘습니다. "
+                f"(예상 {projected / 1e6:.0f}MB) 파일 수나 크기를 줄여 주세요."
+            )
+
+    def reserve(self, nbytes: int, label: str):
+        self._check(2 * self.held + nbytes, label)
+
+    def hold(self, nbytes: int, label: str):
+        self._check(2 * (self.held + nbytes), label)
+        self.held += nbytes
+
+    def describe(self) -> dict:
+        return {"ceiling": self.ceiling, "held": self.held, "peak": self.peak}
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def download_material(url: str, timeout: float, max_bytes: int = MATERIALS_MAX_FILE_BYTES):
+    """Streams a blob into a spooled buffer instead of keeping response.content.
+
+    Small files stay in memory; larger ones spill to a temporary file, so a
+    download never holds more than MATERIALS_SPOOL_MEMORY bytes in RAM.
+    Returns (spool, content_type, size); the caller closes the spool.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=MATERIALS_SPOOL_MEMORY)
+    size = 0
+    try:
+        with requests.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('content-type', 'application/octet-stream')
+            for chunk in response.iter_content(chunk_size=MATERIALS_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise MaterialsTooLarge(f"파일이 너무 큽니다 (최대 {max_bytes / 1e6:.0f}MB): {url}")
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, content_type, size
+
+
+def image_part(spool, content_type: str, ceiling: MemoryCeiling, label: str = "image"):
+    """Builds one inline image part, decoding only when the image must be resized or converted.
+
+    Images within MATERIAL_IMAGE_MAX_SIDE in a format Gemini accepts are sent
+    as their original bytes. Others are decoded lazily from the spool (JPEGs
+    at reduced scale), re-encoded as JPEG, and the bitmap is released at once.
+    """
+    from PIL import Image, ImageOps
+    mime_type = content_type.split(';')[0].strip().lower()
+    with Image.open(spool) as source:  # 여기서는 헤더만 읽습니다.
+        if mime_type in PASSTHROUGH_IMAGE_TYPES and max(source.size) <= MATERIAL_IMAGE_MAX_SIDE:
+            ceiling.hold(spool_size(spool), label)
+            return _inline_part(mime_type, spool.read())
+
+        source.draft('RGB', (MATERIAL_IMAGE_MAX_SIDE, MATERIAL_IMAGE_MAX_SIDE))
+        ceiling.reserve(source.size[0] * source.size[1] * max(len(source.getbands()), 3), label)
+        ImageOps.exif_transpose(source, in_place=True)  # 회전용 비트맵 사본을 만들지 않습니다.
+        image = source
+        if image.mode != 'RGB':
+            if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+                rgba = image.convert('RGBA')
+                image = Image.new('RGB', rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel('A'))
+            else:
+                image = image.convert('RGB')
+        image.thumbnail((MATERIAL_IMAGE_MAX_SIDE, MATERIAL_IMAGE_MAX_SIDE), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=MATERIAL_IMAGE_JPEG_QUALITY, optimize=True)
+        image.close()
+    data = buffer.getvalue()
+    ceiling.hold(len(data), label)
+    return _inline_part('image/jpeg', data)
+
+
+def decode_material(spool, content_type: str, ceiling: MemoryCeiling, label: str):
+    """Turns one downloaded file into request parts under the memory ceiling.
+
+    Returns (kind, parts) with kind 'image', 'pdf' or 'text'. The raw bytes
+    are dropped as soon as the parts are built.
+    """
+    if 'image/' in content_type:
+        return "image", [image_part(spool, content_type, ceiling, label)]
+
+    size = spool_size(spool)
+    if 'application/pdf' in content_type:
+        # PDF 원본과 래스터화 중인 페이지 한 장이 잠시 함께 올라갑니다.
+        ceiling.reserve(2 * size, label)
+        pdf_parts, pdf_report = prepare_pdf_parts(spool.read(), label=label)
+        print(format_pdf_report(pdf_report))
+        ceiling.hold(sum(part_nbytes(part) for part in pdf_parts), label)
+        return "pdf", pdf_parts
+
+    ceiling.reserve(2 * size, label)
+    text = spool.read().decode('utf-8', errors='ignore')
+    ceiling.hold(part_nbytes(text), label)
+    return "text", [text]
@@ -0,0 +1,332 @@
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+METRICS_SNAPSHOT_DIR = os.getenv("METRICS_SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "studious-metrics"))
+# file: 같은 파일 시스템을 보는 프로세스끼리만 합산됩니다 (로컬 vercel dev, 단일 서버).
+# supabase: 인스턴스마다 metrics_snapshots 테이블의 한 행을 갱신하므로 Vercel처럼 인스턴스마다
+#           /tmp가 따로인 배포에서도 /api/metrics가 모든 인스턴스를 합산합니다.
+METRICS_SINK = os.getenv("METRICS_SINK", "file").lower()
+METRICS_TABLE = os.getenv("METRICS_TABLE", "metrics_snapshots")
+METRICS_GAUGE_TTL = float(os.getenv("METRICS_GAUGE_TTL", "900"))  # 이보다 오래된 인스턴스의 게이지는 무시
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 300)
+
+METRIC_HELP = {
+    "llm_requests_total": ("counter", "Model calls per endpoint/model/key and outcome."),
+    "llm_input_tokens_total": ("counter", "Prompt tokens reported by the provider."),
+    "llm_output_tokens_total": ("counter", "Output tokens reported by the provider."),
+    "llm_cached_tokens_total": ("counter", "Prompt tokens served from the provider's context cache."),
+    "llm_fallbacks_total": ("counter", "Failed key attempts that fell through to the next key."),
+    "llm_request_latency_seconds": ("histogram", "Latency of a single model call attempt."),
+    "upstream_errors_total": ("counter", "Upstream failures by upstream and error class."),
+    "cache_requests_total": ("counter", "Local and provider cache lookups by result."),
+    "model_routing_decisions_total": ("counter", "Flash/Pro routing decisions by endpoint and reason."),
+    "request_deadline_exceeded_total": ("counter", "Requests stopped by their deadline, by endpoint and stage."),
+    "circuit_breaker_state": ("gauge", "Breaker state per upstream/key: 0 closed, 1 half-open, 2 open (worst across processes)."),
+    "circuit_breaker_transitions_total": ("counter", "Breaker state changes by upstream, key and new state."),
+    "circuit_breaker_rejections_total": ("counter", "Calls skipped because the breaker was open."),
+    "admission_decisions_total": ("counter", "Admission results per endpoint: admitted, queued, rejected_rate, rejected_queue."),
+    "admission_queue_wait_seconds": ("histogram", "Time an admitted request waited for a fair-queue slot."),
+    "circuit_breaker_failovers_total": ("counter", "Requests moved to another provider after a breaker-open or exhausted upstream."),
+    "thumbnail_jobs_total": ("counter", "Synced-media thumbnail jobs by media kind and result: ok, skipped, error."),
+    "thumbnail_generation_seconds": ("histogram", "Time to render, upload and record one file's thumbnail variants."),
+}
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> {"buckets": [...], "sum": float, "count": int}
+_gauges = {}  # (name, labels) -> value
+_write_lock = threading.Lock()  # 같은 프로세스의 요청들이 동시에 flush해도 한 번에 하나만 씁니다.
+_dirty = False
+_sink_client = None
+# pid는 서버리스 인스턴스 사이에서 겹칠 수 있으므로 인스턴스마다 고유한 id를 씁니다.
+INSTANCE_ID = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+
+# ==============================================================================
+# RECORDING
+# ==============================================================================
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def inc(metric: str, value: float = 1, **labels):
+    key = (metric, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _mark_dirty()
+
+
+def set_gauge(metric: str, value: float, **labels):
+    key = (metric, _labels(labels))
+    with _lock:
+        _gauges[key] = value
+    _mark_dirty()
+
+
+def observe(metric: str, value: float, **labels):
+    key = (metric, _labels(labels))
+    with _lock:
+        histogram = _histograms.setdefault(key, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+    _mark_dirty()
+
+
+def classify_error(error) -> str:
+    """Maps an exception to a coarse error class for the upstream_errors_total label."""
+    status = getattr(getattr(error, 'response', None), 'status_code', None) or getattr(error, 'code', None)
+    name = type(error).__name__
+    text = str(error)
+    if isinstance(error, TimeoutError) or 'Timeout' in name or 'DeadlineExceeded' in name:
+        return "timeout"
+    if status == 429 or 'ResourceExhausted' in name or '429' in text:
+        return "rate_limit"
+    if status in (401, 403) or 'PermissionDenied' in name or 'Unauthenticated' in name:
+        return "auth"
+    if (isinstance(status, int) and status >= 500) or 'ServiceUnavailable' in name or 'InternalServerError' in name:
+        return "server"
+    if isinstance(status, int) and 400 <= status < 500 or 'InvalidArgument' in name:
+        return "client"
+    if isinstance(error, ConnectionError) or 'Connection' in name:
+        return "connection"
+    return "other"
+
+
+def usage_from_gemini(response):
+    """Returns (input, output, cached) token counts from a generate_content response."""
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return 0, 0, 0
+    return (
+        getattr(usage, 'prompt_token_count', 0) or 0,
+        getattr(usage, 'candidates_token_count', 0) or 0,
+        getattr(usage, 'cached_content_token_count', 0) or 0,
+    )
+
+
+def record_llm_call(endpoint: str, model: str, key_index: int, started: float,
+                    usage=(0, 0, 0), error=None, upstream: str = "gemini"):
+    """Records one model call attempt: latency, token usage, and failures/fallbacks.
+
+    key_index is 1-based to match the "API 키 #N" log lines.
+    """
+    labels = {"endpoint": endpoint, "model": model.replace('models/', ''), "key": key_index}
+    observe("llm_request_latency_seconds", time.monotonic() - started, **labels)
+    if error is not None:
+        error_class = classify_error(error)
+        inc("llm_requests_total", outcome="error", **labels)
+        inc("llm_fallbacks_total", **labels)
+        inc("upstream_errors_total", upstream=upstream, endpoint=endpoint, error_class=error_class)
+        return
+    input_tokens, output_tokens, cached_tokens = usage
+    inc("llm_requests_total", outcome="success", **labels)
+    if input_tokens:
+        inc("llm_input_tokens_total", input_tokens, **labels)
+    if output_tokens:
+        inc("llm_output_tokens_total", output_tokens, **labels)
+    if cached_tokens:
+        inc("llm_cached_tokens_total", cached_tokens, **labels)
+
+
+def record_cache(cache: str, hit: bool, **labels):
+    inc("cache_requests_total", cache=cache, result="hit" if hit else "miss", **labels)
+
+# ==============================================================================
+# EXPORT
+# ==============================================================================
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "instance": INSTANCE_ID,
+            "written_at": time.time(),
+            "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in _counters.items()],
+            "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in _gauges.items()],
+            "histograms": [
+                {"name": n, "labels": dict(l), "buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                for (n, l), h in _histograms.items()
+            ],
+        }
+
+
+def _mark_dirty():
+    # 여기서는 표시만 합니다. 기록 지점(브레이커 잠금 안 등)에서 파일/네트워크 I/O를 하지 않도록
+    # 실제 쓰기는 요청이 끝날 때 flush()가 합니다.
+    global _dirty
+    _dirty = True
+
+
+def _get_sink_client():
+    global _sink_client
+    if _sink_client is None:
+        from supabase import create_client
+        _sink_client = create_client(os.environ['VITE_PUBLICSUPABASE_URL'], os.environ['SUPABASE_SERVICE_ROLE_KEY'])
+    return _sink_client
+
+
+def _write_file(data):
+    os.makedirs(METRICS_SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(METRICS_SNAPSHOT_DIR, f"metrics-{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _write_supabase(data):
+    """Upserts this instance's cumulative snapshot. Expects:
+
+        create table metrics_snapshots (instance text primary key, written_at timestamptz, snapshot jsonb);
+
+    Rows are cumulative per instance, so counters keep adding up after an
+    instance is recycled. Deleting old rows resets those counters.
+    """
+    _get_sink_client().table(METRICS_TABLE).upsert({
+        "instance": INSTANCE_ID,
+        "written_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(data["written_at"])),
+        "snapshot": data,
+    }).execute()
+
+
+def flush():
+    """Writes this process's metrics to the sink if anything changed since the last write.
+
+    The only place metrics are written; called once at the end of every
+    request by flushes_metrics or the Flask teardown hook.
+    """
+    global _dirty
+    if not _dirty:
+        return
+    with _write_lock:
+        if not _dirty:
+            return
+        _dirty = False
+        try:
+            data = snapshot()
+            if METRICS_SINK == "supabase":
+                _write_supabase(data)
+            else:
+                _write_file(data)
+        except Exception as e:
+            _dirty = True
+            print(f"WARN: 메트릭 스냅샷 저장 실패 ({METRICS_SINK}): {e}")
+
+
+def flushes_metrics(method):
+    """Decorates a do_GET/do_POST handler so its metrics are flushed when it returns.
+
+    Serverless instances can be frozen or recycled right after a response, so
+    waiting for the next interval would lose the last requests' counts.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        finally:
+            flush()
+    return wrapper
+
+
+def _load_file_snapshots():
+    snapshots = []
+    try:
+        names = os.listdir(METRICS_SNAPSHOT_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith('.json') or name == f"metrics-{os.getpid()}.json":
+            continue
+        try:
+            with open(os.path.join(METRICS_SNAPSHOT_DIR, name), encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except Exception as e:
+            print(f"WARN: 메트릭 스냅샷 읽기 실패 ('{name}'): {e}")
+    return snapshots
+
+
+def _load_supabase_snapshots():
+    rows = _get_sink_client().table(METRICS_TABLE).select("instance, snapshot").execute().data or []
+    return [row["snapshot"] for row in rows if row.get("instance") != INSTANCE_ID and row.get("snapshot")]
+
+
+def load_snapshots(include_self: bool = True) -> list:
+    """Loads every instance's snapshot from the sink, with live data for this process.
+
+    Gauges of instances that have not written for METRICS_GAUGE_TTL seconds
+    are dropped, since their breakers and queues no longer exist.
+    """
+    snapshots = [snapshot()] if include_self else []
+    try:
+        others = _load_supabase_snapshots() if METRICS_SINK == "supabase" else _load_file_snapshots()
+    except Exception as e:
+        print(f"WARN: 메트릭 스냅샷 읽기 실패 ({METRICS_SINK}): {e}")
+        others = []
+    now = time.time()
+    for snap in others:
+        if now - snap.get("written_at", 0) > METRICS_GAUGE_TTL:
+            snap = dict(snap, gauges=[])
+        snapshots.append(snap)
+    return snapshots
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+def render_prometheus(snapshots=None) -> str:
+    """Renders merged snapshots in the Prometheus text exposition format."""
+    snapshots = snapshots if snapshots is not None else load_snapshots()
+    counters, gauges, histograms = {}, {}, {}
+    for snap in snapshots:
+        for g in snap.get("gauges", []):
+            # 프로세스마다 값이 다르므로 가장 나쁜(큰) 값을 보여 줍니다.
+            key = (g["name"], _labels(g["labels"]))
+            gauges[key] = max(gauges.get(key, g["value"]), g["value"])
+        for c in snap.get("counters", []):
+            key = (c["name"], _labels(c["labels"]))
+            counters[key] = counters.get(key, 0) + c["value"]
+        for h in snap.get("histograms", []):
+            key = (h["name"], _labels(h["labels"]))
+            merged = histograms.setdefault(key, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+            merged["buckets"] = [a + b for a, b in zip(merged["buckets"], h["buckets"])]
+            merged["sum"] += h["sum"]
+            merged["count"] += h["count"]
+
+    lines = []
+    for name in sorted({n for n, _ in counters} | {n for n, _ in gauges} | {n for n, _ in histograms}):
+        kind, help_text = METRIC_HELP.get(name, ("counter" if any(n == name for n, _ in counters) else "histogram", ""))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f"{name}{_format_labels(dict(labels))} {value:g}")
+        for (n, labels), value in sorted(gauges.items()):
+            if n == name:
+                lines.append(f"{name}{_format_labels(dict(labels))} {value:g}")
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            for bound, count in zip(LATENCY_BUCKETS, h["buckets"]):
+                lines.append(f"{name}_bucket{_format_labels({**dict(labels), 'le': f'{bound:g}'})} {count}")
+            lines.append(f"{name}_bucket{_format_labels({**dict(labels), 'le': '+Inf'})} {h['count']}")
+            lines.append(f"{name}_sum{_format_labels(dict(labels))} {h['sum']:.6f}")
+            lines.append(f"{name}_count{_format_labels(dict(labels))} {h['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,213 @@
+import io
+import os
+
+from .budget import GEMINI_TOKENS_PER_PAGE, estimate_text_tokens
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+PDF_TEXT_MIN_CHARS = int(os.getenv("PDF_TEXT_MIN_CHARS", "200"))  # 이보다 짧은 텍스트 레이어는 이미지 페이지로 취급
+# 이미지가 페이지 면적의 이 비율 이상을 덮으면 그림 위주 페이지로 보고 래스터화합니다. 로고나 작은 아이콘은 넘어갑니다.
+PDF_IMAGE_MAX_COVERAGE = float(os.getenv("PDF_IMAGE_MAX_COVERAGE", "0.15"))
+# 텍스트가 이만큼 빽빽하면 전면 배경 이미지(슬라이드 템플릿 등)가 있어도 텍스트 페이지로 보냅니다.
+PDF_TEXT_DENSE_CHARS = int(os.getenv("PDF_TEXT_DENSE_CHARS", "1200"))
+PDF_FORM_MAX_DEPTH = 3  # 이미지를 찾아 들어갈 Form XObject 중첩 깊이
+PDF_RASTER_DPI = min(int(os.getenv("PDF_RASTER_DPI", "110")), 150)  # 래스터화 DPI 상한
+PDF_RASTER_JPEG_QUALITY = 80
+
+# ==============================================================================
+# HELPER FUNCTIONS
+# ==============================================================================
+
+def _multiply(a, b):
+    """Product a x b of two PDF matrices [a b c d e f]."""
+    return [
+        a[0] * b[0] + a[1] * b[2], a[0] * b[1] + a[1] * b[3],
+        a[2] * b[0] + a[3] * b[2], a[2] * b[1] + a[3] * b[3],
+        a[4] * b[0] + a[5] * b[2] + b[4], a[4] * b[1] + a[5] * b[3] + b[5],
+    ]
+
+
+def _painted_images(contents, resources, ctm, pdf, depth=0):
+    """Yields the page-space area of every image painted by a content stream.
+
+    Follows q/Q/cm to track the transformation matrix; an image fills the unit
+    square, so its area is |det(CTM)|. Form XObjects are entered with their
+    own /Matrix and /Resources.
+    """
+    from pypdf.generic import ContentStream
+    xobjects = resources.get('/XObject') if resources else None
+    xobjects = xobjects.get_object() if xobjects else {}
+    stack = []
+    for operands, operator in ContentStream(contents, pdf).operations:
+        if operator == b'q':
+            stack.append(ctm)
+        elif operator == b'Q':
+            ctm = stack.pop() if stack else ctm
+        elif operator == b'cm' and len(operands) == 6:
+            ctm = _multiply([float(v) for v in operands], ctm)
+        elif operator == b'INLINE IMAGE':
+            yield abs(ctm[0] * ctm[3] - ctm[1] * ctm[2])
+        elif operator == b'Do' and operands and operands[0] in xobjects:
+            xobject = xobjects[operands[0]].get_object()
+            subtype = xobject.get('/Subtype')
+            if subtype == '/Image':
+                yield abs(ctm[0] * ctm[3] - ctm[1] * ctm[2])
+            elif subtype == '/Form' and depth < PDF_FORM_MAX_DEPTH:
+                matrix = [float(v) for v in xobject.get('/Matrix', [1, 0, 0, 1, 0, 0])]
+                form_resources = xobject.get('/Resources')
+                form_resources = form_resources.get_object() if form_resources else resources
+                yield from _painted_images(xobject, form_resources, _multiply(matrix, ctm), pdf, depth + 1)
+
+
+def _image_coverage(page):
+    """(image count, fraction of the page area covered by images) of one page.
+
+    Overlapping images are counted twice, so the fraction is capped at 1.
+    Returns (0, 0.0) when the content stream cannot be read.
+    """
+    try:
+        contents = page.get_contents()
+        if contents is None:
+            return 0, 0.0
+        resources = page.get('/Resources')
+        resources = resources.get_object() if resources else None
+        areas = list(_painted_images(contents, resources, [1.0, 0.0, 0.0, 1.0, 0.0, 0.0], page.pdf))
+        box = page.mediabox
+        page_area = abs(float(box.width) * float(box.height))
+    except Exception:
+        return 0, 0.0
+    if not areas or page_area <= 0:
+        return len(areas), 0.0
+    return len(areas), min(1.0, sum(areas) / page_area)
+
+
+def _single_page_pdf(page) -> bytes:
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    writer.add_page(page)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def _rasterize_page(pdf_bytes: bytes, page_number: int) -> bytes:
+    from pdf2image import convert_from_bytes
+    images = convert_from_bytes(pdf_bytes, dpi=PDF_RASTER_DPI, first_page=page_number, last_page=page_number)
+    if not images:
+        raise ValueError(f"페이지 {page_number} 래스터화 결과가 비어 있습니다.")
+    buffer = io.BytesIO()
+    images[0].convert('RGB').save(buffer, format='JPEG', quality=PDF_RASTER_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def _pdf_part(pdf_bytes: bytes):
+    import google.ai.generativelanguage as glm
+    return glm.Part(inline_data=glm.Blob(mime_type='application/pdf', data=pdf_bytes))
+
+
+def _jpeg_part(jpeg_bytes: bytes):
+    import google.ai.generativelanguage as glm
+    return glm.Part(inline_data=glm.Blob(mime_type='image/jpeg', data=jpeg_bytes))
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def prepare_pdf_parts(pdf_bytes: bytes, label: str = "PDF"):
+    """Splits a PDF into compact request parts using its text layer where possible.
+
+    Text-heavy pages are sent as plain text; image-only or figure-heavy pages are
+    rasterized at a capped DPI, or forwarded as single-page PDFs if rasterization
+    is unavailable. A page counts as figure-heavy when images cover at least
+    PDF_IMAGE_MAX_COVERAGE of it, unless its text layer is dense enough that the
+    image is likely a background. Returns (parts, report).
+    """
+    report = {
+        "label": label,
+        "original_bytes": len(pdf_bytes),
+        "original_tokens": 0,
+        "sent_bytes": 0,
+        "sent_tokens": 0,
+        "pages": [],
+    }
+
+    try:
+        from pypdf import PdfReader
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        pages = list(reader.pages)
+    except Exception as e:
+        print(f"WARN: PDF 텍스트 레이어 분석 실패, 원본 PDF를 그대로 전송합니다 ('{label}'): {e}")
+        report.update(sent_bytes=len(pdf_bytes), pages=[{"page": None, "mode": "forward", "reason": str(e)}])
+        return [_pdf_part(pdf_bytes)], report
+
+    report["original_tokens"] = len(pages) * GEMINI_TOKENS_PER_PAGE
+    decisions = []
+    for index, page in enumerate(pages):
+        try:
+            text = (page.extract_text() or "").strip()
+        except Exception:
+            text = ""
+        image_count, coverage = _image_coverage(page)
+        is_text_page = len(text) >= PDF_TEXT_MIN_CHARS and (
+            coverage < PDF_IMAGE_MAX_COVERAGE or len(text) >= PDF_TEXT_DENSE_CHARS
+        )
+        decisions.append((index + 1, page, text, image_count, coverage, is_text_page))
+
+    # 텍스트 레이어를 쓸 수 있는 페이지가 하나도 없으면 원본을 그대로 보내는 편이 가장 작습니다.
+    if not any(d[5] for d in decisions):
+        report["sent_bytes"] = len(pdf_bytes)
+        report["sent_tokens"] = report["original_tokens"]
+        report["pages"] = [{"page": n, "mode": "forward", "chars": len(t), "images": c, "coverage": round(f, 2)}
+                           for n, _, t, c, f, _ in decisions]
+        return [_pdf_part(pdf_bytes)], report
+
+    parts = []
+    pending_text = []
+
+    def flush_text():
+        if pending_text:
+            parts.append("\n\n".join(pending_text))
+            pending_text.clear()
+
+    for page_number, page, text, image_count, coverage, is_text_page in decisions:
+        entry = {"page": page_number, "chars": len(text), "images": image_count, "coverage": round(coverage, 2)}
+        if is_text_page:
+            chunk = f"--- {label} p.{page_number} ---\n{text}"
+            pending_text.append(chunk)
+            entry.update(mode="text", bytes=len(chunk.encode('utf-8')), tokens=estimate_text_tokens(chunk))
+        else:
+            flush_text()
+            try:
+                jpeg_bytes = _rasterize_page(pdf_bytes, page_number)
+                parts.append(f"--- {label} p.{page_number} (이미지) ---")
+                parts.append(_jpeg_part(jpeg_bytes))
+                entry.update(mode="raster", bytes=len(jpeg_bytes), tokens=GEMINI_TOKENS_PER_PAGE)
+            except Exception as e:
+                print(f"WARN: 페이지 {page_number} 래스터화 실패, 단일 페이지 PDF로 전송합니다: {e}")
+                page_pdf = _single_page_pdf(page)
+                parts.append(_pdf_part(page_pdf))
+                entry.update(mode="forward", bytes=len(page_pdf), tokens=GEMINI_TOKENS_PER_PAGE)
+        report["sent_bytes"] += entry["bytes"]
+        report["sent_tokens"] += entry["tokens"]
+        report["pages"].append(entry)
+    flush_text()
+
+    return parts, report
+
+
+def format_pdf_report(report) -> str:
+    """Formats a one-line-per-page summary of prepare_pdf_parts decisions for logging."""
+    saved_bytes = report["original_bytes"] - report["sent_bytes"]
+    saved_tokens = report["original_tokens"] - report["sent_tokens"]
+    lines = [
+        f"INFO: PDF 전처리 '{report['label']}': {report['original_bytes']}B/{report['original_tokens']}tok -> "
+        f"{report['sent_bytes']}B/{report['sent_tokens']}tok (절감 {saved_bytes}B, {saved_tokens}tok)"
+    ]
+    for entry in report["pages"]:
+        lines.append(
+            f"      p.{entry.get('page')}: {entry.get('mode')} "
+            f"(chars={entry.get('chars', 0)}, images={entry.get('images', 0)}, coverage={entry.get('coverage', 0)}, "
+            f"bytes={entry.get('bytes', '-')}, tokens={entry.get('tokens', '-')})"
+        )
+    return "\n".join(lines)
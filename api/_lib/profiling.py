@@ -0,0 +1,184 @@
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")                               # X-Profile 헤더로 켜려면 필요
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))       # 0~1, 무작위로 프로파일링할 요청 비율
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "studious-profiles"))
+PROFILE_TRACE_FRAMES = int(os.getenv("PROFILE_TRACE_FRAMES", "10"))      # 할당마다 보관할 스택 깊이
+PROFILE_TOP_ALLOCATIONS = 15   # 단계마다 보고서에 남기는 할당 증가량 상위 항목 수
+PROFILE_TOP_FUNCTIONS = 40     # 요약 텍스트에 남기는 누적 시간 상위 함수 수
+PROFILE_HEADER = "X-Profile"
+
+_cpu_lock = threading.Lock()  # cProfile은 프로세스에서 한 번에 하나만 켤 수 있습니다.
+_tracing_lock = threading.Lock()
+_tracing_users = 0  # tracemalloc을 쓰는 진행 중 프로파일 수. 마지막 프로파일이 끝날 때 멈춥니다.
+
+
+def _start_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0:
+            tracemalloc.stop()
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+class NullProfile:
+    """Stand-in when profiling is off, so handlers can call mark()/finish() unconditionally."""
+
+    enabled = False
+    report_id = None
+
+    def mark(self, stage: str, **details):
+        pass
+
+    def headers(self) -> dict:
+        return {}
+
+    def finish(self, status: str = "ok"):
+        return None
+
+
+class RequestProfile:
+    """CPU profile plus tracemalloc snapshots for one request.
+
+    mark(stage) records wall time, traced current/peak memory and the
+    allocation sites that grew most since the previous mark. finish() writes
+    <id>.prof (load with pstats or snakeviz), <id>.txt (top functions by
+    cumulative time) and <id>.json (stages) to PROFILE_DIR.
+
+    tracemalloc is process-wide, so memory of concurrent requests in the same
+    instance is included. If another request already holds the CPU profiler,
+    only memory is recorded.
+    """
+
+    enabled = True
+
+    def __init__(self, endpoint: str, reason: str):
+        self.endpoint = endpoint
+        self.reason = reason
+        self.report_id = f"{endpoint}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.stages = []
+        self.started = time.monotonic()
+        self.last_mark = self.started
+        _start_tracing()
+        tracemalloc.reset_peak()
+        self.last_snapshot = tracemalloc.take_snapshot()
+        self.cpu = None
+        if _cpu_lock.acquire(blocking=False):
+            try:
+                self.cpu = cProfile.Profile()
+                self.cpu.enable()
+            except ValueError as e:  # 다른 도구가 이미 프로파일러를 켜 둔 경우
+                print(f"WARN: CPU 프로파일러를 켜지 못해 메모리만 기록합니다: {e}")
+                self.cpu = None
+                _cpu_lock.release()
+        print(f"INFO: 요청 프로파일링 시작 ({self.report_id}, {reason})")
+
+    def mark(self, stage: str, **details):
+        """Records a stage boundary, e.g. mark("download", url=url) after a file has arrived."""
+        now = time.monotonic()
+        # 스냅샷 비교 자체가 CPU 프로파일을 차지하지 않도록 잠시 멈춥니다.
+        if self.cpu is not None:
+            self.cpu.disable()
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        growth = [stat for stat in snapshot.compare_to(self.last_snapshot, "lineno")
+                  if stat.size_diff > 0 and stat.traceback[0].filename != tracemalloc.__file__][:PROFILE_TOP_ALLOCATIONS]
+        self.stages.append({
+            "stage": stage,
+            **details,
+            "seconds": round(now - self.last_mark, 4),
+            "elapsed": round(now - self.started, 4),
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "top_growth": [
+                {"site": str(stat.traceback[0]), "size_diff": stat.size_diff, "size": stat.size, "count_diff": stat.count_diff}
+                for stat in growth
+            ],
+        })
+        self.last_snapshot = snapshot
+        tracemalloc.reset_peak()  # 다음 단계의 최고치를 따로 봅니다.
+        self.last_mark = time.monotonic()
+        if self.cpu is not None:
+            self.cpu.enable()
+
+    def headers(self) -> dict:
+        """Response header telling the caller which report belongs to their request."""
+        return {"X-Profile-Id": self.report_id}
+
+    def finish(self, status: str = "ok"):
+        """Stops both profilers and writes the reports; returns the report path prefix."""
+        self.mark("end")
+        self.last_snapshot = None
+        if self.cpu is not None:
+            self.cpu.disable()
+            _cpu_lock.release()
+        _stop_tracing()
+
+        prefix = os.path.join(PROFILE_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", self.report_id))
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            report = {
+                "id": self.report_id,
+                "endpoint": self.endpoint,
+                "reason": self.reason,
+                "status": status,
+                "seconds": round(time.monotonic() - self.started, 4),
+                "peak_bytes": max((s["peak_bytes"] for s in self.stages), default=0),
+                "cpu_profile": self.cpu is not None,
+                "stages": self.stages,
+            }
+            with open(prefix + ".json", "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            if self.cpu is not None:
+                self.cpu.dump_stats(prefix + ".prof")
+                summary = io.StringIO()
+                pstats.Stats(self.cpu, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+                with open(prefix + ".txt", "w", encoding="utf-8") as f:
+                    f.write(summary.getvalue())
+        except Exception as e:
+            print(f"WARN: 프로파일 보고서 저장 실패 ({self.report_id}): {e}")
+            return None
+        print(f"INFO: 프로파일 저장 완료: {prefix}.* ({report['seconds']:.2f}초, 최고 {report['peak_bytes'] / 1e6:.1f}MB)")
+        return prefix
+
+
+def start_profile(endpoint: str, handler=None):
+    """Returns a RequestProfile when this request opted in, otherwise a NullProfile.
+
+    A request opts in with an `X-Profile: <PROFILE_TOKEN>` header, or when it
+    is sampled at PROFILE_SAMPLE_RATE (also settable per endpoint with
+    PROFILE_SAMPLE_RATE_<ENDPOINT>). Without PROFILE_TOKEN the header is ignored.
+    """
+    header = handler.headers.get(PROFILE_HEADER) if handler is not None else None
+    if PROFILE_TOKEN and header and hmac.compare_digest(header.encode('utf-8'), PROFILE_TOKEN.encode('utf-8')):
+        return RequestProfile(endpoint, "header")
+    rate = float(os.getenv(f"PROFILE_SAMPLE_RATE_{endpoint.upper()}", PROFILE_SAMPLE_RATE))
+    if rate > 0 and random.random() < rate:
+        return RequestProfile(endpoint, "sampled")
+    return NullProfile()
@@ -0,0 +1,130 @@
+import datetime
+import hashlib
+import os
+import time
+
+from .budget import estimate_text_tokens
+from .metrics import record_cache
+from .transport import recorded
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+PROMPT_CACHE_ENABLED = os.getenv("GEMINI_PROMPT_CACHE", "1") == "1"
+PROMPT_CACHE_TTL = int(os.getenv("GEMINI_PROMPT_CACHE_TTL", "3600"))
+# Gemini 명시적 캐시의 최소 토큰 수. 이보다 짧은 지시문은 system_instruction으로만 보냅니다.
+PROMPT_CACHE_MIN_TOKENS = {
+    "gemini-2.5-pro": 4096,
+    "gemini-2.5-flash": 1024,
+}
+
+
+class PromptSpec:
+    """A static instruction prefix, built once at import and identified by its fingerprint."""
+
+    def __init__(self, name, version, text):
+        self.name = name
+        self.version = version
+        self.text = text
+        self.fingerprint = hashlib.sha256(f"{name}:{version}:{text}".encode('utf-8')).hexdigest()[:12]
+        self.tokens = estimate_text_tokens(text)
+
+    def describe(self):
+        return {"name": self.name, "version": self.version, "fingerprint": self.fingerprint}
+
+
+_REGISTRY = {}
+_CLIENTS = {}  # (클라이언트 클래스, api key) -> GenerativeServiceClient / CacheServiceClient
+_CACHED_CONTENTS = {}  # (api key 해시, 모델, fingerprint) -> (CachedContent 이름, 만료 시각)
+
+
+def register_prompt(name: str, version: str, text: str) -> PromptSpec:
+    """Registers a static instruction prefix under name; re-registering a name replaces it."""
+    spec = PromptSpec(name, version, text.strip())
+    _REGISTRY[name] = spec
+    return spec
+
+
+def get_prompt(name: str) -> PromptSpec:
+    return _REGISTRY[name]
+
+
+def _cache_display_name(spec):
+    return f"{spec.name}-{spec.version}-{spec.fingerprint}"
+
+
+def _get_or_create_cached_content(model_name, spec, api_key):
+    # CachedContent.create/list/get은 genai.configure로 정한 전역 클라이언트를 쓰므로,
+    # 동시에 다른 키로 configure한 요청과 섞이지 않게 키별 CacheServiceClient로 직접 호출합니다.
+    import google.ai.generativelanguage as glm
+    from google.generativeai import caching
+
+    client = _client_for_key(api_key, glm.CacheServiceClient)
+    cache_key = (hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12], model_name, spec.fingerprint)
+    cached = _CACHED_CONTENTS.get(cache_key)
+    if cached and cached[1] > time.time() + 60:
+        record_cache("gemini_prompt", True, prompt=spec.name)
+        return caching.CachedContent._from_obj(client.get_cached_content(name=cached[0]))
+
+    display_name = _cache_display_name(spec)
+    model_path = model_name if model_name.startswith('models/') else f"models/{model_name}"
+    cached_content = None
+    # 콜드 스타트 후에도 같은 지시문의 캐시가 남아 있으면 재사용합니다.
+    for existing in client.list_cached_contents(glm.ListCachedContentsRequest(page_size=100)):
+        if existing.display_name == display_name and existing.model == model_path:
+            cached_content = existing
+            break
+    record_cache("gemini_prompt", cached_content is not None, prompt=spec.name)
+    if cached_content is None:
+        cached_content = client.create_cached_content(cached_content=glm.CachedContent(
+            model=model_path,
+            display_name=display_name,
+            system_instruction=glm.Content(parts=[glm.Part(text=spec.text)]),
+            ttl=datetime.timedelta(seconds=PROMPT_CACHE_TTL),
+        ))
+        print(f"INFO: 프롬프트 캐시 생성: {display_name}")
+    cached_content = caching.CachedContent._from_obj(cached_content)
+    expire_time = cached_content.expire_time
+    expires_at = expire_time.timestamp() if expire_time else time.time() + PROMPT_CACHE_TTL
+    _CACHED_CONTENTS[cache_key] = (cached_content.name, expires_at)
+    return cached_content
+
+
+def _client_for_key(api_key, client_class=None):
+    if client_class is None:
+        import google.ai.generativelanguage as glm
+        client_class = glm.GenerativeServiceClient
+    client = _CLIENTS.get((client_class, api_key))
+    if client is None:
+        client = client_class(client_options={"api_key": api_key})
+        _CLIENTS[(client_class, api_key)] = client
+    return client
+
+
+def build_model(model_name: str, spec: PromptSpec, api_key: str = None, **model_kwargs):
+    """Returns a GenerativeModel carrying spec as its system instruction.
+
+    When the instruction is long enough for Gemini context caching, it is
+    registered once per key as cached content and reused. The model is wrapped
+    by transport.recorded so its calls can be recorded and replayed. spec may be
+    None for callers that send their prompt inline and only need the per-key
+    client. Call after genai.configure(api_key=...).
+    """
+    import google.generativeai as genai
+
+    clean_name = model_name.replace('models/', '')
+    min_tokens = PROMPT_CACHE_MIN_TOKENS.get(clean_name)
+    model = None
+    if PROMPT_CACHE_ENABLED and spec and api_key and min_tokens and spec.tokens >= min_tokens:
+        try:
+            cached_content = _get_or_create_cached_content(clean_name, spec, api_key)
+            model = genai.GenerativeModel.from_cached_content(cached_content=cached_content, **model_kwargs)
+        except Exception as e:
+            print(f"WARN: 프롬프트 캐시 사용 실패, system_instruction으로 전송합니다 ('{spec.name}'): {e}")
+    if model is None:
+        model = genai.GenerativeModel(model_name, system_instruction=spec.text if spec else None, **model_kwargs)
+    if api_key:
+        # genai.configure는 전역 설정이므로, 여러 스레드가 서로 다른 키로 동시에 호출해도
+        # 섞이지 않도록 모델을 키별 클라이언트에 고정합니다.
+        model._client = _client_for_key(api_key)
+    return recorded(model, clean_name, spec.text if spec else None)
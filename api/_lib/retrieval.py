@@ -0,0 +1,183 @@
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from .budget import estimate_text_tokens
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+RETRIEVAL_ENABLED = os.getenv("CHAT_RETRIEVAL_ENABLED", "1") != "0"
+RETRIEVAL_MIN_NOTE_TOKENS = int(os.getenv("CHAT_RETRIEVAL_MIN_NOTE_TOKENS", "3000"))  # 이보다 짧은 노트는 전체를 보냅니다.
+RETRIEVAL_TOP_K = int(os.getenv("CHAT_RETRIEVAL_TOP_K", "6"))
+RETRIEVAL_CHUNK_CHARS = 900
+# 최고 점수 대비 이 비율 미만인 청크는 top-k 안이어도 버립니다. 흔한 단어 하나만 겹친 청크를 거르기 위함입니다.
+RETRIEVAL_MIN_SCORE_RATIO = float(os.getenv("CHAT_RETRIEVAL_MIN_SCORE_RATIO", "0.3"))
+RETRIEVAL_INDEX_CACHE_SIZE = 32
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_LATIN_WORD = re.compile(r"[A-Za-z0-9_]+")
+_HANGUL_RUN = re.compile(r"[가-힣]+")
+
+# ==============================================================================
+# TOKENIZATION & CHUNKING
+# ==============================================================================
+
+def tokenize(text: str):
+    """Lowercased Latin words plus Hangul character unigrams and bigrams.
+
+    Korean attaches particles to nouns, so bigrams match "전도는"/"전도를" to "전도"
+    without a morphological analyzer; unigrams cover one-syllable terms ("핀의").
+    """
+    tokens = [word.lower() for word in _LATIN_WORD.findall(text)]
+    for run in _HANGUL_RUN.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def chunk_note(note: str):
+    """Splits a markdown note into chunks of at most ~RETRIEVAL_CHUNK_CHARS.
+
+    Chunks never cross a heading and keep the heading path they belong to.
+    Fenced code blocks (mermaid, visual, suggestion...) are kept whole.
+    Returns a list of {"id", "headings", "text"} in document order.
+    """
+    chunks = []
+    path = []
+    buffer = []
+    in_fence = False
+
+    def flush():
+        text = "\n".join(buffer).strip()
+        buffer.clear()
+        if text:
+            chunks.append({"id": len(chunks), "headings": [title for _, title in path], "text": text})
+
+    for line in note.splitlines():
+        if line.strip().startswith("```"):
+            in_fence = not in_fence
+        heading = None if in_fence else _HEADING.match(line)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            path = [(lvl, title) for lvl, title in path if lvl < level] + [(level, heading.group(2))]
+            buffer.append(line)
+            continue
+        buffer.append(line)
+        # 문단 경계에서만 자릅니다.
+        if not in_fence and not line.strip() and sum(len(b) + 1 for b in buffer) >= RETRIEVAL_CHUNK_CHARS:
+            flush()
+    flush()
+    return chunks
+
+# ==============================================================================
+# INDEX
+# ==============================================================================
+
+class NoteIndex:
+    """BM25 index over the chunks of one note."""
+
+    def __init__(self, note: str):
+        self.note = note
+        self.chunks = chunk_note(note)
+        self.term_freqs = []
+        document_freq = Counter()
+        for chunk in self.chunks:
+            # 제목도 검색 대상에 포함해 섹션 이름으로 묻는 질문을 잡습니다.
+            freqs = Counter(tokenize(" ".join(chunk["headings"]) + "\n" + chunk["text"]))
+            self.term_freqs.append(freqs)
+            document_freq.update(freqs.keys())
+        self.lengths = [sum(freqs.values()) for freqs in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        total = len(self.chunks)
+        self.idf = {term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in document_freq.items()}
+
+    def score(self, query: str):
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        scores = []
+        for freqs, length in zip(self.term_freqs, self.lengths):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (self.avg_length or 1))
+            score = 0.0
+            for term in terms:
+                tf = freqs.get(term, 0)
+                if tf:
+                    score += self.idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def top_k(self, query: str, k: int):
+        """Returns the ids of the k best-scoring chunks, in document order.
+
+        Chunks scoring below RETRIEVAL_MIN_SCORE_RATIO of the best score are dropped.
+        """
+        scores = self.score(query)
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        if not ranked or scores[ranked[0]] <= 0:
+            return []
+        threshold = scores[ranked[0]] * RETRIEVAL_MIN_SCORE_RATIO
+        return sorted(i for i in ranked[:k] if scores[i] >= threshold)
+
+    def outline(self):
+        seen = []
+        for chunk in self.chunks:
+            if chunk["headings"] and chunk["headings"] not in seen:
+                seen.append(chunk["headings"])
+        return ["  " * (len(headings) - 1) + "- " + headings[-1] for headings in seen]
+
+
+_INDEX_CACHE = OrderedDict()  # sha256(note) -> NoteIndex
+_INDEX_LOCK = threading.Lock()
+
+
+def get_index(note: str) -> NoteIndex:
+    """Returns the cached index for a note, building it on first use (LRU)."""
+    key = hashlib.sha256(note.encode('utf-8')).hexdigest()
+    with _INDEX_LOCK:
+        index = _INDEX_CACHE.get(key)
+        if index is not None:
+            _INDEX_CACHE.move_to_end(key)
+            return index
+    index = NoteIndex(note)
+    with _INDEX_LOCK:
+        _INDEX_CACHE[key] = index
+        while len(_INDEX_CACHE) > RETRIEVAL_INDEX_CACHE_SIZE:
+            _INDEX_CACHE.popitem(last=False)
+    return index
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def select_context(note: str, query: str, top_k: int = None):
+    """Returns (context, report) with only the note chunks relevant to query.
+
+    Short notes, empty queries and queries that match nothing fall back to the
+    full note. Otherwise the context is the note's heading outline followed by
+    the top_k chunks in document order.
+    """
+    top_k = top_k or RETRIEVAL_TOP_K
+    note_tokens = estimate_text_tokens(note)
+    report = {"mode": "full", "note_tokens": note_tokens, "context_tokens": note_tokens}
+    if not RETRIEVAL_ENABLED or not note or not query or note_tokens < RETRIEVAL_MIN_NOTE_TOKENS:
+        return note, report
+
+    index = get_index(note)
+    selected = index.top_k(query, top_k)
+    if not selected:
+        return note, report
+
+    parts = ["[노트 목차]\n" + "\n".join(index.outline())]
+    for chunk_id in selected:
+        chunk = index.chunks[chunk_id]
+        location = " > ".join(chunk["headings"]) or "(머리말)"
+        parts.append(f"[발췌: {location}]\n{chunk['text']}")
+    context = "\n\n".join(parts)
+    report.update(mode="retrieval", chunks=len(index.chunks), selected=selected,
+                  context_tokens=estimate_text_tokens(context))
+    return context, report
@@ -0,0 +1,92 @@
+import json
+import os
+
+from .budget import GEMINI_TOKENS_PER_PAGE, classify_part
+from .metrics import inc
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+FLASH_MODEL = "gemini-2.5-flash"
+PRO_MODEL = "gemini-2.5-pro"
+
+# 엔드포인트별 기본 정책. 입력이 flash_max_* 이하면 Flash, 그보다 크면 Pro를 사용합니다.
+# pro_min_tokens가 있으면 Flash가 기본인 엔드포인트도 그 이상에서는 Pro로 올립니다.
+ROUTING_POLICIES = {
+    "create_review_note": {"task": "synthesis", "default": PRO_MODEL,
+                           "flash_max_tokens": 12_000, "flash_max_pages": 4, "flash_max_images": 3},
+    "create_textbook": {"task": "long_generation", "default": PRO_MODEL,
+                        "flash_max_tokens": 6_000, "flash_max_pages": 2, "flash_max_images": 1},
+    "assignment_helper": {"task": "reasoning", "default": FLASH_MODEL, "pro_min_tokens": 60_000},
+    # 기존 GENAI_MODEL 설정과의 호환을 위해 시간표 추출의 기본값은 그대로 둡니다.
+    "process_calendar": {"task": "extraction", "default": os.getenv("GENAI_MODEL", FLASH_MODEL)},
+}
+
+
+def _load_overrides():
+    """Per-endpoint overrides from MODEL_ROUTING_CONFIG (JSON) and MODEL_ROUTE_<ENDPOINT>."""
+    overrides = {}
+    raw = os.getenv("MODEL_ROUTING_CONFIG")
+    if raw:
+        try:
+            overrides = json.loads(raw)
+        except json.JSONDecodeError as e:
+            print(f"WARN: MODEL_ROUTING_CONFIG 파싱 실패, 기본 정책을 사용합니다: {e}")
+    return overrides
+
+
+ROUTING_OVERRIDES = _load_overrides()
+
+# ==============================================================================
+# ROUTING
+# ==============================================================================
+
+def describe_materials(contents, instruction_tokens: int = 0):
+    """Summarizes request contents into the size signals the routing policy uses."""
+    stats = {"tokens": instruction_tokens, "pages": 0, "images": 0, "text_tokens": 0}
+    for part in contents:
+        category, tokens = classify_part(part)
+        stats["tokens"] += tokens
+        if category == "pdf":
+            stats["pages"] += max(1, tokens // GEMINI_TOKENS_PER_PAGE)
+        elif category == "image":
+            stats["images"] += 1
+        elif category == "text":
+            stats["text_tokens"] += tokens
+    return stats
+
+
+def choose_model(endpoint: str, stats: dict, task: str = None):
+    """Picks Flash or Pro for a request and returns a decision dict with the reason.
+
+    An explicit model in MODEL_ROUTE_<ENDPOINT> or MODEL_ROUTING_CONFIG[endpoint]["model"]
+    always wins; other keys in MODEL_ROUTING_CONFIG[endpoint] override the thresholds.
+    """
+    policy = {**ROUTING_POLICIES.get(endpoint, {"task": "generic", "default": FLASH_MODEL}),
+              **ROUTING_OVERRIDES.get(endpoint, {})}
+    task = task or policy["task"]
+    forced = os.getenv(f"MODEL_ROUTE_{endpoint.upper()}") or policy.get("model")
+
+    if forced:
+        model, reason = forced, "override"
+    elif "flash_max_tokens" in policy:
+        limits = [
+            ("tokens", policy["flash_max_tokens"]),
+            ("pages", policy.get("flash_max_pages")),
+            ("images", policy.get("flash_max_images")),
+        ]
+        exceeded = [f"{name}>{limit}" for name, limit in limits if limit is not None and stats.get(name, 0) > limit]
+        if exceeded:
+            model, reason = policy["default"], "large_input:" + ",".join(exceeded)
+        else:
+            model, reason = FLASH_MODEL, "small_input"
+    elif policy.get("pro_min_tokens") and stats.get("tokens", 0) >= policy["pro_min_tokens"]:
+        model, reason = PRO_MODEL, f"large_input:tokens>={policy['pro_min_tokens']}"
+    else:
+        model, reason = policy["default"], "default"
+
+    decision = {"endpoint": endpoint, "task": task, "model": model, "reason": reason, "inputs": stats}
+    print(f"INFO: 모델 라우팅 [{endpoint}/{task}] -> {model} ({reason}) "
+          f"tokens={stats.get('tokens', 0)} pages={stats.get('pages', 0)} images={stats.get('images', 0)}")
+    inc("model_routing_decisions_total", endpoint=endpoint, model=model, reason=reason.split(':')[0])
+    return decision
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL_MS", "20")) / 1000
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", "256"))
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15"))
+
+
+class ClientDisconnected(ConnectionError):
+    """Raised when the browser has closed the event stream."""
+
+
+class SSEWriter:
+    """Coalesces streamed tokens into fewer SSE frames.
+
+    Tokens are buffered and written as one frame once SSE_FLUSH_BYTES have
+    accumulated or SSE_FLUSH_INTERVAL has passed since the first buffered token.
+    A background ticker handles the time-based flush and sends comment
+    heartbeats while the upstream model is silent. A failed write marks the
+    writer closed so the caller can cancel the upstream stream.
+    """
+
+    def __init__(self, wfile, token_frame, flush_interval=SSE_FLUSH_INTERVAL,
+                 flush_bytes=SSE_FLUSH_BYTES, heartbeat_interval=SSE_HEARTBEAT_INTERVAL):
+        self.wfile = wfile
+        self.token_frame = token_frame  # 합쳐진 토큰 문자열 -> 전송할 dict
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.heartbeat_interval = heartbeat_interval
+        self.closed = False
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._last_write = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._ticker = threading.Thread(target=self._tick, daemon=True)
+        self._ticker.start()
+
+    def _write(self, payload: bytes):
+        if self.closed:
+            raise ClientDisconnected("클라이언트 연결이 이미 종료되었습니다.")
+        try:
+            self.wfile.write(payload)
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError, ValueError) as e:
+            self.closed = True
+            raise ClientDisconnected(f"클라이언트 연결이 끊어졌습니다: {e}") from e
+        self.frames_sent += 1
+        self.bytes_sent += len(payload)
+        self._last_write = time.monotonic()
+
+    def _flush_pending(self):
+        if not self._pending:
+            return
+        text = "".join(self._pending)
+        self._pending.clear()
+        self._pending_bytes = 0
+        self._pending_since = None
+        frame = json.dumps(self.token_frame(text))
+        self._write(f"data: {frame}\n\n".encode('utf-8'))
+
+    def _tick(self):
+        interval = min(self.flush_interval, self.heartbeat_interval) if self.flush_interval > 0 else self.heartbeat_interval
+        while not self._stop.wait(interval):
+            with self._lock:
+                if self.closed:
+                    return
+                now = time.monotonic()
+                try:
+                    if self._pending and now - self._pending_since >= self.flush_interval:
+                        self._flush_pending()
+                    elif not self._pending and now - self._last_write >= self.heartbeat_interval:
+                        self._write(b": ping\n\n")
+                except ClientDisconnected:
+                    return
+
+    def send_token(self, text: str):
+        if not text:
+            return
+        with self._lock:
+            self._pending.append(text)
+            self._pending_bytes += len(text.encode('utf-8'))
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+            if self._pending_bytes >= self.flush_bytes:
+                self._flush_pending()
+
+    def send_event(self, data):
+        """Flushes buffered tokens, then writes a non-token event immediately."""
+        with self._lock:
+            self._flush_pending()
+            payload = data if isinstance(data, str) else json.dumps(data)
+            self._write(f"data: {payload}\n\n".encode('utf-8'))
+
+    def close(self, done=True):
+        """Stops the ticker, flushes what is left and optionally sends [DONE]."""
+        self._stop.set()
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self._flush_pending()
+                if done:
+                    self._write(b"data: [DONE]\n\n")
+                # 압축 스트림이면 마지막 블록까지 내보냅니다.
+                finish = getattr(self.wfile, 'finish', None)
+                if finish:
+                    finish()
+            except (ClientDisconnected, BrokenPipeError, ConnectionResetError):
+                pass
@@ -0,0 +1,209 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from . import transport
+from .breaker import guard
+from .metrics import inc, observe
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+THUMBNAILS_ENABLED = os.getenv("THUMBNAILS_ENABLED", "1") != "0"
+# 변형 이름 -> 긴 변 최대 픽셀. 갤러리 격자는 small, 미리보기 창은 medium/large를 씁니다.
+THUMBNAIL_SIZES = {"small": 200, "medium": 640, "large": 1280}
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "webp").lower()  # webp | jpeg
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "78"))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "3"))      # Pillow는 리사이즈/인코딩 중 GIL을 놓습니다.
+THUMBNAIL_WAIT_SECONDS = float(os.getenv("THUMBNAIL_WAIT_SECONDS", "45"))  # 응답 후 작업을 기다리는 최대 시간
+THUMBNAIL_CACHE_CONTROL = "31536000"  # 변형 경로는 원본마다 고유하므로 오래 캐시해도 됩니다.
+THUMBNAIL_BUCKET = "synced_media"
+
+# 미리보기를 만들 수 없는 행(동영상, 디코더가 없는 HEIC, 깨진 파일)에 기록하는 값.
+# NULL과 구분되어 backfill이 같은 행을 매번 다시 고르지 않습니다.
+NO_PREVIEW = {}
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".heic", ".heif"}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# ==============================================================================
+# HELPER FUNCTIONS
+# ==============================================================================
+
+def media_kind(filename: str, content_type: str = None):
+    """'image', 'pdf', or None for media we cannot preview (video, audio, ...)."""
+    content_type = (content_type or "").lower()
+    extension = os.path.splitext(filename or "")[1].lower()
+    if content_type == "application/pdf" or extension == ".pdf":
+        return "pdf"
+    if content_type.startswith("image/") or extension in IMAGE_EXTENSIONS:
+        return "image"
+    return None
+
+
+def variant_path(path: str, name: str) -> str:
+    """Storage path of a variant, next to the original: public/u/abc.jpg -> public/u/abc_small.webp."""
+    extension = "jpg" if THUMBNAIL_FORMAT == "jpeg" else THUMBNAIL_FORMAT
+    return f"{os.path.splitext(path)[0]}_{name}.{extension}"
+
+
+def storage_path_from_url(url: str):
+    """Recovers the bucket path from a public URL, e.g. for backfilling old rows."""
+    marker = f"/object/public/{THUMBNAIL_BUCKET}/"
+    if marker not in (url or ""):
+        return None
+    return url.split(marker, 1)[1].split("?", 1)[0]
+
+
+def _open_source(data: bytes, kind: str):
+    from PIL import Image, ImageOps
+    largest = max(THUMBNAIL_SIZES.values())
+    if kind == "pdf":
+        from pdf2image import convert_from_bytes
+        # 첫 페이지만, 가장 큰 변형 크기로 바로 래스터화합니다.
+        pages = convert_from_bytes(data, first_page=1, last_page=1, size=largest)
+        if not pages:
+            raise ValueError("PDF 첫 페이지 래스터화 결과가 비어 있습니다.")
+        return pages[0]
+    image = Image.open(io.BytesIO(data))
+    # JPEG는 디코딩 단계에서 1/2~1/8로 줄여 읽어, 큰 사진의 디코딩 시간과 메모리를 아낍니다.
+    image.draft("RGB", (largest, largest))
+    return ImageOps.exif_transpose(image)
+
+
+def render_variants(data: bytes, kind: str) -> dict:
+    """Encodes every THUMBNAIL_SIZES variant of an image or a PDF's first page.
+
+    Variants are produced largest first, each resized from the previous one,
+    and never upscaled beyond the source. Returns {name: (bytes, content_type)}.
+    """
+    from PIL import Image
+    image = _open_source(data, kind)
+    fmt = "JPEG" if THUMBNAIL_FORMAT == "jpeg" else THUMBNAIL_FORMAT.upper()
+    if fmt == "JPEG" or image.mode not in ("RGB", "RGBA"):
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha and fmt != "JPEG" else "RGB")
+
+    variants = {}
+    current = image
+    for name, size in sorted(THUMBNAIL_SIZES.items(), key=lambda item: -item[1]):
+        if max(current.size) > size:
+            current = current.copy()
+            current.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+        buffer = io.BytesIO()
+        current.save(buffer, format=fmt, quality=THUMBNAIL_QUALITY, method=4 if fmt == "WEBP" else 0, optimize=fmt == "JPEG")
+        variants[name] = (buffer.getvalue(), f"image/{THUMBNAIL_FORMAT}")
+    return variants
+
+def _is_permanent_failure(error) -> bool:
+    """True for errors that will recur on every retry: an undecodable or oversized image."""
+    from PIL import Image, UnidentifiedImageError
+    return isinstance(error, (UnidentifiedImageError, Image.DecompressionBombError))
+
+
+def mark_no_preview(supabase, url: str):
+    """Records that a file has no preview, so it is not picked up for backfilling again."""
+    with guard('supabase'):
+        supabase.table('synced_media').update({'thumbnails': NO_PREVIEW}).eq('url', url).execute()
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def generate_thumbnails(supabase, path: str, url: str, data, filename: str = None, content_type: str = None):
+    """Renders, uploads and records the thumbnail variants of one synced_media file.
+
+    data is the original's bytes, or a callable returning them so that queued
+    jobs do not all hold their file in memory at once.
+
+    Variants are stored next to the original and their public URLs are written
+    to synced_media.thumbnails ({"small": url, "medium": url, "large": url}),
+    which expects:
+
+        alter table synced_media add column thumbnails jsonb;
+
+    Files without a preview (unsupported type, undecodable image) get
+    NO_PREVIEW instead of staying NULL. Returns the URL map, or None if the
+    file has no preview.
+    """
+    kind = media_kind(filename or path, content_type)
+    if kind is None:
+        inc("thumbnail_jobs_total", kind="other", result="skipped")
+        mark_no_preview(supabase, url)
+        return None
+
+    started = time.monotonic()
+    try:
+        try:
+            variants = render_variants(data() if callable(data) else data, kind)
+        except Exception as e:
+            if not _is_permanent_failure(e):
+                raise
+            inc("thumbnail_jobs_total", kind=kind, result="skipped")
+            print(f"WARN: 미리보기를 만들 수 없는 파일입니다 ('{path}'): {e}")
+            mark_no_preview(supabase, url)
+            return None
+        urls = {}
+        bucket = supabase.storage.from_(THUMBNAIL_BUCKET)
+        for name, (body, variant_type) in variants.items():
+            target = variant_path(path, name)
+            with guard('supabase_storage'):
+                transport.call(
+                    'supabase_storage',
+                    {"op": "upload", "bucket": THUMBNAIL_BUCKET, "path": target, "body": body, "content_type": variant_type},
+                    lambda target=target, body=body, variant_type=variant_type: bucket.upload(
+                        target,
+                        body,
+                        file_options={"content-type": variant_type, "cache-control": THUMBNAIL_CACHE_CONTROL, "upsert": "true"}
+                    )
+                )
+            urls[name] = bucket.get_public_url(target)
+        with guard('supabase'):
+            supabase.table('synced_media').update({'thumbnails': urls}).eq('url', url).execute()
+    except Exception as e:
+        inc("thumbnail_jobs_total", kind=kind, result="error")
+        print(f"WARN: 썸네일 생성 실패 ('{path}'): {e}")
+        raise
+
+    elapsed = time.monotonic() - started
+    observe("thumbnail_generation_seconds", elapsed, kind=kind)
+    inc("thumbnail_jobs_total", kind=kind, result="ok")
+    print(f"INFO: 썸네일 {len(urls)}개 생성 완료 ('{path}', {elapsed:.2f}초)")
+    return urls
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, THUMBNAIL_WORKERS), thread_name_prefix="thumbnail")
+        return _executor
+
+
+def schedule(supabase, path: str, url: str, data, filename: str = None, content_type: str = None):
+    """Queues generate_thumbnails on the worker pool; returns its Future, or None when disabled."""
+    if not THUMBNAILS_ENABLED:
+        return None
+    return _get_executor().submit(generate_thumbnails, supabase, path, url, data, filename, content_type)
+
+
+def wait_for(futures, timeout: float = THUMBNAIL_WAIT_SECONDS, deadline=None) -> int:
+    """Waits for scheduled jobs after the response has been sent; returns how many are unfinished.
+
+    The wait never outlasts the request's deadline, so the function is not
+    cut off at maxDuration. Unfinished or failed jobs leave thumbnails NULL;
+    scripts/backfill_thumbnails.py picks those rows up later.
+    """
+    futures = [f for f in futures if f is not None]
+    if not futures:
+        return 0
+    if deadline is not None:
+        timeout = min(timeout, deadline.remaining())
+    _, pending = wait(futures, timeout=timeout)
+    if pending:
+        print(f"WARN: 썸네일 작업 {len(pending)}개가 {timeout:.0f}초 안에 끝나지 않았습니다.")
+    return len(pending)
@@ -0,0 +1,265 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .budget import estimate_image_tokens
+from .dedup import hamming_distance, image_hash
+from .metrics import record_cache
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+TIMETABLE_PREPROCESS_ENABLED = os.getenv("TIMETABLE_PREPROCESS", "1") != "0"
+LINE_EDGE_THRESHOLD = 10      # 격자선으로 볼 최소 밝기 차이 (0~255)
+LINE_MIN_COVERAGE = 0.35      # 행/열 길이 대비 엣지 픽셀 비율이 이 이상이면 격자선
+MIN_GRID_LINES = 3            # 가로/세로 각각 이만큼은 있어야 시간표 격자로 인정
+GRID_PADDING_RATIO = 0.02     # 격자 바깥 라벨(요일, 시각)이 잘리지 않도록 남기는 여백
+MIN_CELL_PX = int(os.getenv("TIMETABLE_MIN_CELL_PX", "28"))  # 30분 칸 하나의 최소 높이
+MIN_SIDE = 512
+MAX_SIDE = 1536
+
+# ==============================================================================
+# DETECTION
+# ==============================================================================
+
+def _line_positions(edges, axis, min_coverage):
+    """Indexes along the other axis whose edge coverage exceeds min_coverage, merged into lines."""
+    import numpy as np
+    coverage = edges.mean(axis=axis)
+    candidates = np.flatnonzero(coverage >= min_coverage)
+    lines = []
+    for index in candidates:
+        # 두께가 여러 픽셀인 선은 하나로 합칩니다.
+        if lines and index - lines[-1][-1] <= 2:
+            lines[-1].append(index)
+        else:
+            lines.append([index])
+    return [int(sum(group) / len(group)) for group in lines]
+
+
+def _largest_regular_group(lines):
+    """Keeps the longest run of lines whose gaps stay near the median gap.
+
+    Status bars, app headers and tab bars also produce full-width edges, but
+    far from the evenly spaced grid rows.
+    """
+    if len(lines) < 2:
+        return lines
+    gaps = sorted(b - a for a, b in zip(lines, lines[1:]))
+    limit = gaps[len(gaps) // 2] * 1.6
+    groups = [[lines[0]]]
+    for previous, current in zip(lines, lines[1:]):
+        if current - previous <= limit:
+            groups[-1].append(current)
+        else:
+            groups.append([current])
+    return max(groups, key=len)
+
+
+def detect_grid(gray):
+    """Finds the timetable grid in a grayscale uint8 array by projection analysis.
+
+    Grid lines are long runs of brightness change: the row projection of the
+    vertical gradient gives horizontal lines and vice versa. Returns
+    (box, rows, cols) with box = (left, top, right, bottom), or None.
+    """
+    import numpy as np
+    signed = gray.astype(np.int16)
+    horizontal_edges = np.abs(np.diff(signed, axis=0)) >= LINE_EDGE_THRESHOLD
+    vertical_edges = np.abs(np.diff(signed, axis=1)) >= LINE_EDGE_THRESHOLD
+
+    rows = _largest_regular_group(_line_positions(horizontal_edges, 1, LINE_MIN_COVERAGE))
+    cols = _largest_regular_group(_line_positions(vertical_edges, 0, LINE_MIN_COVERAGE))
+    if len(rows) < MIN_GRID_LINES or len(cols) < MIN_GRID_LINES:
+        return None
+    # 격자선이 바깥으로 이어지는 범위까지 포함해, 첫 세로선 왼쪽의 시각 라벨과 첫 가로선 위의 요일 라벨을 남깁니다.
+    # 두께 있는 선은 양쪽 가장자리에만 엣지가 생기므로 선 위치 ±2px를 함께 봅니다.
+    row_extent = np.mean([horizontal_edges[max(0, y - 2):y + 3].any(axis=0) for y in rows], axis=0) >= 0.5
+    col_extent = np.mean([vertical_edges[:, max(0, x - 2):x + 3].any(axis=1) for x in cols], axis=0) >= 0.5
+    left, right = _extend(row_extent, cols[0], cols[-1])
+    top, bottom = _extend(col_extent, rows[0], rows[-1])
+    return (left, top, right + 1, bottom + 1), rows, cols
+
+
+def _extend(mask, start, end, max_gap=3):
+    """Widens [start, end] while mask stays true, tolerating gaps of max_gap pixels."""
+    gap = 0
+    position = start
+    while position > 0 and gap <= max_gap:
+        position -= 1
+        gap = 0 if mask[position] else gap + 1
+        if gap == 0:
+            start = position
+    gap = 0
+    position = end
+    while position < len(mask) - 1 and gap <= max_gap:
+        position += 1
+        gap = 0 if mask[position] else gap + 1
+        if gap == 0:
+            end = position
+    return start, end
+
+
+def content_box(gray, tolerance=12):
+    """Bounding box of everything that differs from the dominant border colour."""
+    import numpy as np
+    border = np.concatenate([gray[0], gray[-1], gray[:, 0], gray[:, -1]])
+    background = int(np.median(border))
+    mask = np.abs(gray.astype(np.int16) - background) > tolerance
+    ys, xs = np.nonzero(mask)
+    if not len(xs):
+        return None
+    return int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+
+
+def _median_spacing(lines):
+    gaps = sorted(b - a for a, b in zip(lines, lines[1:]) if b - a > 3)
+    return gaps[len(gaps) // 2] if gaps else None
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def preprocess_timetable(img):
+    """Crops a timetable screenshot/render to its grid, normalizes contrast and downsamples.
+
+    Status bars, app chrome and empty margins are cut away; the image is then
+    scaled so a 30-minute row stays about MIN_CELL_PX tall, clamped to
+    [MIN_SIDE, MAX_SIDE] on the long side. Falls back to trimming uniform
+    margins when no grid is found. Returns (image, report).
+    """
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    started = time.perf_counter()
+    img = ImageOps.exif_transpose(img).convert('RGB')
+    width, height = img.size
+    report = {"enabled": TIMETABLE_PREPROCESS_ENABLED, "original_size": [width, height],
+              "original_tokens": estimate_image_tokens(width, height)}
+    if not TIMETABLE_PREPROCESS_ENABLED:
+        return img, report
+
+    gray = np.asarray(img.convert('L'))
+    grid = detect_grid(gray)
+    row_spacing = None
+    if grid:
+        box, rows, cols = grid
+        row_spacing = _median_spacing(rows)
+        report.update(mode="grid", lines=[len(rows), len(cols)])
+    else:
+        box = content_box(gray)
+        report.update(mode="trim" if box else "none")
+
+    if box:
+        pad_x, pad_y = int(width * GRID_PADDING_RATIO), int(height * GRID_PADDING_RATIO)
+        left, top, right, bottom = box
+        box = (max(0, left - pad_x), max(0, top - pad_y), min(width, right + pad_x), min(height, bottom + pad_y))
+        img = img.crop(box)
+        report["crop"] = list(box)
+
+    # 명도 기준으로만 늘려 파스텔 톤 과목 색이 원색으로 바뀌지 않게 합니다.
+    img = ImageOps.autocontrast(img, cutoff=0.5, preserve_tone=True)
+
+    scale = 1.0
+    if row_spacing:
+        scale = min(1.0, MIN_CELL_PX / row_spacing)
+    long_side = max(img.size) * scale
+    if long_side > MAX_SIDE:
+        scale *= MAX_SIDE / long_side
+    elif long_side < MIN_SIDE:
+        scale = min(1.0, MIN_SIDE / max(img.size))
+    if scale < 1.0:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+
+    report.update(size=list(img.size), scale=round(scale, 3), tokens=estimate_image_tokens(*img.size),
+                  ms=round((time.perf_counter() - started) * 1000, 1))
+    return img, report
+
+# ==============================================================================
+# RESULT CACHE
+# ==============================================================================
+# 같은 학과 학생들은 같은 수강신청 포털 양식, 종종 같은 시간표를 올립니다.
+# 전처리된 이미지의 지각 해시가 가까우면 모델을 다시 부르지 않고 저장된 결과를 돌려줍니다.
+TIMETABLE_CACHE_ENABLED = os.getenv("TIMETABLE_CACHE", "1") != "0"
+TIMETABLE_CACHE_SIZE = int(os.getenv("TIMETABLE_CACHE_SIZE", "512"))
+TIMETABLE_CACHE_TTL = float(os.getenv("TIMETABLE_CACHE_TTL", str(7 * 24 * 3600)))
+TIMETABLE_CACHE_HASH_SIZE = 16       # 256비트 dHash: 64비트로는 같은 양식의 다른 시간표를 구분하지 못합니다.
+TIMETABLE_CACHE_DISTANCE = int(os.getenv("TIMETABLE_CACHE_DISTANCE", "12"))  # 256비트 중 (JPEG 잡음, 1px 크롭 차이 허용)
+TIMETABLE_CACHE_THUMB = 128          # 해시가 가까운 후보를 다시 확인할 흑백 썸네일 크기
+TIMETABLE_CACHE_BLOCK = 16           # 썸네일을 16x16 타일로 나눠 타일별 평균 차이를 봅니다.
+TIMETABLE_CACHE_MAX_BLOCK_DIFF = float(os.getenv("TIMETABLE_CACHE_MAX_BLOCK_DIFF", "8"))
+
+
+def _thumbnail(img):
+    import numpy as np
+    from PIL import Image
+    return np.asarray(img.convert('L').resize((TIMETABLE_CACHE_THUMB,) * 2, Image.LANCZOS), dtype=np.float32)
+
+
+def _max_block_diff(a, b) -> float:
+    """Largest mean absolute difference over a BLOCK x BLOCK grid of tiles.
+
+    A whole-image average would hide one changed class cell; a per-tile
+    maximum does not.
+    """
+    size = TIMETABLE_CACHE_THUMB // TIMETABLE_CACHE_BLOCK
+    diff = abs(a - b).reshape(TIMETABLE_CACHE_BLOCK, size, TIMETABLE_CACHE_BLOCK, size)
+    return float(diff.mean(axis=(1, 3)).max())
+
+
+class TimetableCache:
+    """LRU/TTL cache from a perceptual hash of a preprocessed timetable to its extracted events.
+
+    Entries are namespaced by model and prompt version. A lookup matches the
+    closest entry within TIMETABLE_CACHE_DISTANCE bits, then confirms it on a
+    thumbnail so that same-template timetables with one different class miss.
+    """
+
+    def __init__(self, max_entries=TIMETABLE_CACHE_SIZE, ttl=TIMETABLE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (namespace, hash) -> (events, thumbnail, stored_at)
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, img):
+        return image_hash(img, TIMETABLE_CACHE_HASH_SIZE), _thumbnail(img)
+
+    def get(self, img, namespace: str):
+        """Returns a copy of the cached events for a near-identical image, or None."""
+        if not TIMETABLE_CACHE_ENABLED:
+            return None
+        phash, thumbnail = self._fingerprint(img)
+        now = time.time()
+        best = None
+        with self._lock:
+            for key, (events, stored_thumbnail, stored_at) in list(self.entries.items()):
+                if now - stored_at > self.ttl:
+                    del self.entries[key]
+                    continue
+                if key[0] != namespace:
+                    continue
+                distance = hamming_distance(key[1], phash)
+                if distance <= TIMETABLE_CACHE_DISTANCE and (best is None or distance < best[0]):
+                    best = (distance, key, events, stored_thumbnail)
+            if best and _max_block_diff(best[3], thumbnail) <= TIMETABLE_CACHE_MAX_BLOCK_DIFF:
+                self.entries.move_to_end(best[1])
+                record_cache("timetable", True)
+                print(f"INFO: 시간표 결과 캐시 적중 (해밍 거리 {best[0]})")
+                return copy.deepcopy(best[2])
+        record_cache("timetable", False)
+        return None
+
+    def put(self, img, namespace: str, events):
+        if not TIMETABLE_CACHE_ENABLED:
+            return
+        phash, thumbnail = self._fingerprint(img)
+        with self._lock:
+            self.entries[(namespace, phash)] = (copy.deepcopy(events), thumbnail, time.time())
+            self.entries.move_to_end((namespace, phash))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+result_cache = TimetableCache()
@@ -0,0 +1,357 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+# live: 그대로 호출 / record: 호출하고 응답을 기록 / replay: 기록된 응답만 사용 (네트워크 없음)
+TRANSPORT_MODE = os.getenv("UPSTREAM_TRANSPORT_MODE", "live").lower()
+# 모든 키가 실패했을 때 기록된 응답을 최후의 캐시로 사용합니다. 켜져 있으면 성공한 호출도 기록합니다.
+REPLAY_FALLBACK = os.getenv("UPSTREAM_REPLAY_FALLBACK", "0") == "1"
+RECORD_DIR = os.getenv("UPSTREAM_RECORD_DIR", os.path.join(tempfile.gettempdir(), "studious-recordings"))
+# 스트림을 기록된 청크 간격 그대로 재생합니다 (성능 재현용).
+REPLAY_REALTIME = os.getenv("UPSTREAM_REPLAY_REALTIME", "0") == "1"
+SECRET_PARAMS = {"token", "key", "api_key", "apikey", "access_token"}
+
+
+class RecordingMissing(LookupError):
+    """Raised in replay mode when no recording matches a request."""
+
+
+def recording_enabled() -> bool:
+    return TRANSPORT_MODE == "record" or (TRANSPORT_MODE == "live" and REPLAY_FALLBACK)
+
+
+def _passthrough() -> bool:
+    # 기록도 재생도 하지 않을 때는 지문(이미지 해시 등)조차 계산하지 않습니다.
+    return TRANSPORT_MODE != "replay" and not recording_enabled()
+
+# ==============================================================================
+# FINGERPRINTS & STORE
+# ==============================================================================
+
+def _canonical(value):
+    """Reduces a request description to JSON-safe data; binary payloads become digests."""
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return {"sha256": hashlib.sha256(value).hexdigest(), "len": len(value)}
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items(), key=lambda item: str(item[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if hasattr(value, 'tobytes') and hasattr(value, 'size'):  # PIL.Image
+        return {"image": _canonical(value.tobytes()), "size": list(value.size), "mode": value.mode}
+    inline_data = getattr(value, 'inline_data', None)
+    if inline_data is not None and getattr(inline_data, 'mime_type', ''):
+        return {"mime_type": inline_data.mime_type, "data": _canonical(inline_data.data)}
+    return str(value)
+
+
+def fingerprint(service: str, request) -> str:
+    body = json.dumps({"service": service, "request": _canonical(request)}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def _path(service, key):
+    return os.path.join(RECORD_DIR, service, f"{key}.json")
+
+
+def save(service: str, key: str, entry: dict):
+    os.makedirs(os.path.join(RECORD_DIR, service), exist_ok=True)
+    entry = dict(entry, service=service, fingerprint=key, recorded_at=time.time())
+    tmp_path = f"{_path(service, key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp_path, _path(service, key))
+
+
+def load(service: str, key: str):
+    try:
+        with open(_path(service, key), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _replay_chunks(chunks):
+    """Yields recorded chunk payloads, sleeping to reproduce their timing if REPLAY_REALTIME."""
+    started = time.monotonic()
+    for chunk in chunks:
+        if REPLAY_REALTIME:
+            delay = chunk["t"] - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        yield chunk["data"]
+
+# ==============================================================================
+# HTTP (OpenRouter, Apify, Blob)
+# ==============================================================================
+
+def _http_request_key(method, url, kwargs):
+    params = {k: v for k, v in (kwargs.get('params') or {}).items() if k.lower() not in SECRET_PARAMS}
+    # 헤더에는 인증 정보가 들어 있으므로 지문에서 제외합니다.
+    return {"method": method.upper(), "url": url, "params": params,
+            "json": kwargs.get('json'), "data": kwargs.get('data')}
+
+
+class ReplayResponse:
+    """A requests.Response look-alike built from a recording."""
+
+    def __init__(self, entry):
+        self.status_code = entry["status_code"]
+        self.headers = entry.get("headers", {})
+        self.url = entry.get("url")
+        self._entry = entry
+        self.replayed = True
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        if self._entry.get("chunks") is not None:
+            return b"\n".join(base64.b64decode(c) for c in _replay_chunks(self._entry["chunks"]))
+        return base64.b64decode(self._entry.get("body", ""))
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f"{self.status_code} (replayed) for url: {self.url}", response=self)
+
+    def iter_lines(self, *args, **kwargs):
+        chunks = self._entry.get("chunks")
+        if chunks is None:
+            yield from self.content.splitlines()
+            return
+        for data in _replay_chunks(chunks):
+            yield base64.b64decode(data)
+
+    def close(self):
+        pass
+
+
+class RecordingResponse:
+    """Wraps a streamed requests.Response and saves its lines with timing once consumed."""
+
+    def __init__(self, response, service, key, url):
+        self._response = response
+        self._service = service
+        self._key = key
+        self._url = url
+        self._chunks = []
+        self._saved = False
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def iter_lines(self, *args, **kwargs):
+        started = time.monotonic()
+        for line in self._response.iter_lines(*args, **kwargs):
+            self._chunks.append({"t": round(time.monotonic() - started, 4), "data": base64.b64encode(line).decode('ascii')})
+            if line.strip() == b'data: [DONE]':
+                # 읽는 쪽이 [DONE]에서 멈추므로 여기서 완료된 것으로 보고 저장합니다.
+                self._save()
+            yield line
+        self._save()
+
+    def close(self):
+        # 중간에 끊긴 스트림은 재생하면 결과가 달라지므로 저장하지 않습니다.
+        self._response.close()
+
+    def _save(self):
+        if self._saved or self._response.status_code >= 400:
+            return
+        self._saved = True
+        save(self._service, self._key, {"url": self._url, "status_code": self._response.status_code,
+                                         "headers": {"content-type": self._response.headers.get('content-type', '')},
+                                         "chunks": self._chunks})
+
+
+def http(service: str, method: str, url: str, **kwargs):
+    """requests.request with record/replay; service names the upstream ("openrouter", "apify", "blob").
+
+    Streamed responses (stream=True) are recorded line by line with their
+    arrival time and saved once fully read.
+    """
+    import requests
+    if _passthrough():
+        return requests.request(method, url, **kwargs)
+
+    key = fingerprint(service, _http_request_key(method, url, kwargs))
+    if TRANSPORT_MODE == "replay":
+        entry = load(service, key)
+        if entry is None:
+            raise RecordingMissing(f"No recording for {service} {method.upper()} {url}")
+        return ReplayResponse(entry)
+
+    response = requests.request(method, url, **kwargs)
+    if kwargs.get('stream') and 'text/event-stream' in response.headers.get('content-type', ''):
+        return RecordingResponse(response, service, key, url)
+    if response.status_code < 400:
+        save(service, key, {"url": url, "status_code": response.status_code,
+                            "headers": {"content-type": response.headers.get('content-type', '')},
+                            "body": base64.b64encode(response.content).decode('ascii')})
+    return response
+
+
+def http_last_resort(service: str, method: str, url: str, **kwargs):
+    """Returns the recorded response for a request when UPSTREAM_REPLAY_FALLBACK is on, else None."""
+    if not REPLAY_FALLBACK:
+        return None
+    entry = load(service, fingerprint(service, _http_request_key(method, url, kwargs)))
+    if entry is None:
+        return None
+    print(f"WARN: 모든 키가 실패하여 기록된 {service} 응답으로 대체합니다.")
+    return ReplayResponse(entry)
+
+# ==============================================================================
+# GEMINI
+# ==============================================================================
+
+def _gemini_request_key(model_name, contents, system, kwargs):
+    options = {k: v for k, v in kwargs.items() if k not in ('request_options',)}
+    return {"model": model_name.replace('models/', ''), "system": system, "contents": contents, "options": options}
+
+
+def _usage_dict(response):
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return None
+    return {
+        "prompt_token_count": getattr(usage, 'prompt_token_count', 0) or 0,
+        "candidates_token_count": getattr(usage, 'candidates_token_count', 0) or 0,
+        "cached_content_token_count": getattr(usage, 'cached_content_token_count', 0) or 0,
+    }
+
+
+class ReplayGeminiResponse:
+    """Stands in for a GenerateContentResponse (or its stream) from a recording."""
+
+    def __init__(self, entry):
+        self._entry = entry
+        self.usage_metadata = SimpleNamespace(**entry["usage"]) if entry.get("usage") else None
+        self.replayed = True
+
+    @property
+    def text(self):
+        if self._entry.get("chunks") is not None:
+            return "".join(chunk["data"] for chunk in self._entry["chunks"])
+        return self._entry["text"]
+
+    def __iter__(self):
+        for text in _replay_chunks(self._entry.get("chunks") or [{"t": 0, "data": self._entry.get("text", "")}]):
+            yield SimpleNamespace(text=text)
+
+    def resolve(self):
+        pass
+
+
+class RecordingGeminiStream:
+    """Iterates a streamed Gemini response and saves its chunks with timing when it completes."""
+
+    def __init__(self, response, service, key):
+        self._response = response
+        self._service = service
+        self._key = key
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __iter__(self):
+        chunks = []
+        started = time.monotonic()
+        for chunk in self._response:
+            text = getattr(chunk, 'text', '') or ''
+            chunks.append({"t": round(time.monotonic() - started, 4), "data": text})
+            yield chunk
+        save(self._service, self._key, {"chunks": chunks, "usage": _usage_dict(self._response)})
+
+
+class RecordedModel:
+    """Proxies a GenerativeModel, routing generate_content through record/replay.
+
+    system is the system instruction text; it is part of the fingerprint
+    because cached-content models do not expose it.
+    """
+
+    def __init__(self, model, model_name, system=None, service="gemini"):
+        self._model = model
+        self._model_name = model_name
+        self._system = system
+        self._service = service
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def generate_content(self, contents, **kwargs):
+        if _passthrough():
+            return self._model.generate_content(contents, **kwargs)
+
+        key = fingerprint(self._service, _gemini_request_key(self._model_name, contents, self._system, kwargs))
+        if TRANSPORT_MODE == "replay":
+            entry = load(self._service, key)
+            if entry is None:
+                raise RecordingMissing(f"No recording for {self._service} {self._model_name}")
+            return ReplayGeminiResponse(entry)
+
+        response = self._model.generate_content(contents, **kwargs)
+        if kwargs.get('stream'):
+            return RecordingGeminiStream(response, self._service, key)
+        save(self._service, key, {"text": response.text, "usage": _usage_dict(response)})
+        return response
+
+
+def recorded(model, model_name, system=None):
+    """Wraps a GenerativeModel so its calls can be recorded and replayed."""
+    return RecordedModel(model, model_name, system)
+
+
+def gemini_last_resort(model_name, contents, system=None, **kwargs):
+    """Returns the recorded Gemini response for a request when UPSTREAM_REPLAY_FALLBACK is on, else None."""
+    if not REPLAY_FALLBACK:
+        return None
+    entry = load("gemini", fingerprint("gemini", _gemini_request_key(model_name, contents, system, kwargs)))
+    if entry is None:
+        return None
+    print(f"WARN: 모든 Gemini 키가 실패하여 기록된 응답으로 대체합니다 ({model_name}).")
+    return ReplayGeminiResponse(entry)
+
+# ==============================================================================
+# SDK CALLS (Supabase storage)
+# ==============================================================================
+
+def call(service: str, request, fn):
+    """Runs fn() with record/replay; the recorded result is its JSON-safe form (or its str)."""
+    if _passthrough():
+        return fn()
+
+    key = fingerprint(service, request)
+    if TRANSPORT_MODE == "replay":
+        entry = load(service, key)
+        if entry is None:
+            raise RecordingMissing(f"No recording for {service}")
+        return entry.get("result")
+
+    result = fn()
+    try:
+        json.dumps(result)
+        stored = result
+    except (TypeError, ValueError):
+        stored = str(result)
+    save(service, key, {"result": stored})
+    return result
@@ -3,10 +3,150 @@ import json
 import os
 import cgi
 import uuid
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from supabase import create_client, Client
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from _lib import thumbnails, transport
+from _lib.breaker import CircuitOpen, guard
+from _lib.deadline import Deadline
+from _lib.metrics import flushes_metrics
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+MAX_FILES_PER_REQUEST = int(os.getenv("SYNC_MAX_FILES", "50"))
+UPLOAD_WORKERS = int(os.getenv("SYNC_UPLOAD_WORKERS", "6"))  # Storage 동시 업로드 수
+
+_client = None
+
+
+def get_supabase() -> Client:
+    """Service-role client, created once per warm instance instead of per request."""
+    global _client
+    if _client is None:
+        _client = create_client(os.environ['VITE_PUBLICSUPABASE_URL'], os.environ['SUPABASE_SERVICE_ROLE_KEY'])
+    return _client
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def upload_file(supabase, user_id, file_item):
+    """Uploads one form file to the synced_media bucket and returns its storage path."""
+    filename = file_item.filename
+    file_bytes = file_item.file.read()
+    content_type = file_item.type
+
+    file_extension = os.path.splitext(filename)[1]
+    new_filename = f'public/{user_id}/{uuid.uuid4()}{file_extension}'
+
+    with guard('supabase_storage'):
+        transport.call(
+            'supabase_storage',
+            {"op": "upload", "bucket": "synced_media", "path": new_filename, "body": file_bytes, "content_type": content_type},
+            lambda: supabase.storage.from_('synced_media').upload(
+                new_filename,
+                file_bytes,
+                file_options={"content-type": content_type}
+            )
+        )
+    return new_filename
+
+
+def upload_files(supabase, user_id, file_items):
+    """Uploads files concurrently, then records every uploaded file with one bulk insert.
+
+    Returns (results, stored): one {"filename", "success", "url" | "error"}
+    result per file in request order, and (index, storage path) of every file
+    that was recorded. If the insert fails, the uploaded objects are removed
+    again so no unreferenced files are left in storage.
+    """
+    results = [{"filename": item.filename, "success": False} for item in file_items]
+    with ThreadPoolExecutor(max_workers=max(1, min(UPLOAD_WORKERS, len(file_items)))) as executor:
+        futures = [executor.submit(upload_file, supabase, user_id, item) for item in file_items]
+    uploaded = []  # (결과 인덱스, 저장 경로)
+    for index, future in enumerate(futures):
+        try:
+            uploaded.append((index, future.result()))
+        except Exception as e:
+            print(f"WARN: 파일 업로드 실패 ('{results[index]['filename']}'): {e}")
+            results[index]["error"] = str(e)
+            if isinstance(e, CircuitOpen):
+                results[index]["retryAfter"] = max(1, round(e.retry_after))
+
+    if not uploaded:
+        return results, []
+
+    rows = []
+    for index, path in uploaded:
+        public_url = supabase.storage.from_('synced_media').get_public_url(path)
+        results[index]["url"] = public_url
+        # Note: The user_id here is from the form data, linking the media to the user.
+        rows.append({'url': public_url, 'user_id': user_id})
+    try:
+        with guard('supabase'):
+            supabase.table('synced_media').insert(rows).execute()
+    except Exception as e:
+        print(f"ERROR: synced_media 일괄 저장 실패, 업로드한 파일 {len(uploaded)}개를 정리합니다: {e}")
+        try:
+            supabase.storage.from_('synced_media').remove([path for _, path in uploaded])
+        except Exception as cleanup_error:
+            print(f"ERROR: 업로드 파일 정리 실패: {cleanup_error}")
+        for index, _ in uploaded:
+            results[index].pop("url", None)
+            results[index]["error"] = f"메타데이터 저장 실패: {e}"
+            if isinstance(e, CircuitOpen):
+                results[index]["retryAfter"] = max(1, round(e.retry_after))
+        return results, []
+
+    for index, _ in uploaded:
+        results[index]["success"] = True
+    return results, uploaded
+
+
+def _reader(file_item):
+    """Reads a form file again inside a thumbnail job, so queued jobs don't hold their bytes."""
+    def read():
+        file_item.file.seek(0)
+        return file_item.file.read()
+    return read
+
+
+def schedule_thumbnails(supabase, file_items, results, stored):
+    """Queues thumbnail generation for every recorded file; returns the futures."""
+    futures = []
+    for index, path in stored:
+        item = file_items[index]
+        try:
+            futures.append(thumbnails.schedule(supabase, path, results[index]["url"], _reader(item),
+                                               item.filename, item.type))
+        except Exception as e:
+            print(f"WARN: 썸네일 작업 등록 실패 ('{path}'): {e}")
+    return futures
+
+# ==============================================================================
+# VERCEL HANDLER CLASS
+# ==============================================================================
+
 class Handler(BaseHTTPRequestHandler):
+    def _send_json(self, status_code, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-type', 'application/json')
+        # 길이를 밝혀 두어야 응답 후 썸네일 작업이 도는 동안 클라이언트가 응답을 바로 끝까지 읽습니다.
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.wfile.flush()
+
+    @flushes_metrics
     def do_POST(self):
+        deadline = Deadline('add_synced_media')
+        thumbnail_jobs = []
         try:
             # Get Supabase client with service role key for admin tasks
             supabase_url = os.environ.get('VITE_PUBLICSUPABASE_URL')
@@ -16,7 +156,7 @@ class Handler(BaseHTTPRequestHandler):
                 self.send_error(500, "Supabase environment variables not set.")
                 return
 
-            supabase = create_client(supabase_url, supabase_service_key)
+            supabase = get_supabase()
 
             # Parse the multipart form data
             fs = cgi.FieldStorage(
@@ -30,39 +170,49 @@ class Handler(BaseHTTPRequestHandler):
                 self.send_error(400, "File or userId missing from form data.")
                 return
 
-            file_item = fs['file']
-            filename = file_item.filename
-            file_bytes = file_item.file.read()
-            content_type = file_item.type
+            # 'file' 필드를 여러 번 보내면 한 요청으로 일괄 업로드합니다.
+            file_field = fs['file']
+            file_items = file_field if isinstance(file_field, list) else [file_field]
+            if len(file_items) > MAX_FILES_PER_REQUEST:
+                return self._send_json(413, {'error': f'한 번에 최대 {MAX_FILES_PER_REQUEST}개의 파일만 업로드할 수 있습니다.'})
             user_id = fs.getvalue('userId')
+            if isinstance(user_id, list):
+                user_id = user_id[0]
 
-            # Upload file to Supabase Storage
-            file_extension = os.path.splitext(filename)[1]
-            new_filename = f'public/{user_id}/{uuid.uuid4()}{file_extension}'
-            
-            supabase.storage.from_('synced_media').upload(
-                new_filename,
-                file_bytes,
-                file_options={"content-type": content_type}
-            )
+            results, stored = upload_files(supabase, user_id, file_items)
+            # 썸네일은 워커 풀에서 바로 만들기 시작하고, 응답은 기다리지 않고 보냅니다.
+            thumbnail_jobs = schedule_thumbnails(supabase, file_items, results, stored)
+            succeeded = sum(1 for result in results if result["success"])
 
-            # Get public URL and insert metadata into the database
-            public_url = supabase.storage.from_('synced_media').get_public_url(new_filename)
-            
-            # Insert metadata into the 'synced_media' table
-            # Note: The user_id here is from the form data, linking the media to the user.
-            supabase.table('synced_media').insert({'url': public_url, 'user_id': user_id}).execute()
+            if len(results) == 1:
+                # 단일 파일 요청은 기존 응답 형식을 유지합니다.
+                if succeeded:
+                    return self._send_json(200, {'success': True, 'url': results[0]['url']})
+                if 'retryAfter' in results[0]:
+                    return self._send_json(503, {'error': results[0]['error'], 'type': 'CircuitOpen'},
+                                           headers={'Retry-After': str(results[0]['retryAfter'])})
+                return self._send_json(500, {'error': results[0]['error'], 'details': results[0]['error']})
 
-            # Send success response
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': True, 'url': public_url}).encode('utf-8'))
+            # 일부만 실패해도 200으로 파일별 결과를 돌려주어, 클라이언트가 실패한 파일만 다시 보낼 수 있게 합니다.
+            self._send_json(200 if succeeded else 500, {
+                'success': succeeded == len(results),
+                'uploaded': succeeded,
+                'failed': len(results) - succeeded,
+                'results': results,
+            })
+
+        except CircuitOpen as e:
+            # 저장소가 장애 중이면 타임아웃까지 기다리지 않고 바로 재시도 시점을 알려 줍니다.
+            self._send_json(503, {'error': str(e), 'type': type(e).__name__},
+                            headers={'Retry-After': str(max(1, round(e.retry_after)))})
 
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': str(e), 'type': type(e).__name__}).encode('utf-8'))
+            self._send_json(500, {'error': str(e), 'type': type(e).__name__})
+
+        finally:
+            # Content-Length만큼 쓰면 런타임이 응답을 클라이언트에 돌려주고 호출을 끝난 것으로 봅니다.
+            # 그 뒤의 작업은 인스턴스가 멈추거나 회수되면 중단될 수 있으므로 보장되지 않으며,
+            # 끝나지 못한 썸네일은 NULL로 남아 backfill 스크립트가 채웁니다. 기다림은 남은 예산 안으로 제한합니다.
+            thumbnails.wait_for(thumbnail_jobs, deadline=deadline)
 
-        return
\ No newline at end of file
+        return
@@ -9,6 +9,79 @@ import traceback
 import requests
 import uuid
 from urllib.parse import unquote, urlparse
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from _lib.admission import AdmissionRejected, admission_key, admit, send_rejection
+from _lib.breaker import is_available, record_outcome
+from _lib.compression import send_json
+from _lib.deadline import DOWNLOAD_TIMEOUT, Deadline, DeadlineExceeded
+from _lib.pdf_text import prepare_pdf_parts, format_pdf_report
+from _lib.profiling import start_profile
+from _lib.metrics import flushes_metrics, record_llm_call, usage_from_gemini
+from _lib.prompts import build_model, register_prompt
+from _lib.routing import choose_model, describe_materials
+from _lib.transport import gemini_last_resort
+
+# ==============================================================================
+# PROMPTS
+# ==============================================================================
+SHARED_FORMATTING_RULES = """
+# 🎨 출력 서식 규칙 (★★★★★ 가장 중요)
+당신이 생성하는 모든 텍스트는 아래 규칙을 **반드시** 따라야 합니다.
+
+1.  **수학 수식 (LaTeX):** 모든 수학 기호, 변수, 방정식은 **반드시** KaTeX 문법으로 감싸야 합니다. (인라인: $, 블록: $$). 수식 내부에 일반 텍스트(한글 등)를 넣어야 할 경우, 반드시 `\\text{}` 명령어로 감싸야 합니다.
+2.  **다이어그램 (Mermaid):** 복잡한 시스템, 알고리즘, 상태 변화는 **반드시** Mermaid.js 문법으로 시각화해야 합니다. (```mermaid...```). **주의:** 노드 안에서 줄을 바꾸려면 반드시 전체 텍스트를 큰따옴표(`"`)로 감싸고 실제 엔터 키로 줄을 나눠야 합니다. `<br>` 태그는 사용하지 마세요.
+3.  **코드 (Code Block):** 모든 소스 코드는 **반드시** 언어를 명시한 코드 블록으로 작성해야 합니다. (```python...```)
+4.  **핵심 용어 (Tooltip):** 중요한 전공 용어는 **반드시** `<dfn title="설명">용어</dfn>` HTML 태그로 감싸 설명을 제공해야 합니다.
+5.  **자유 시각화 (visual):** 복잡한 개념 등을 시각화할 때 사용합니다.
+    ### visual JSON 생성 규칙 (★★★★★ 반드시 준수)
+    1.  **텍스트 내용**: 텍스트를 표시할 때는 반드시 `props` 객체 안에 `content` 속성을 사용해야 합니다.
+    2.  **요소 중첩**: 다른 요소를 자식으로 포함할 때는 반드시 최상위 레벨의 `children` 배열을 사용해야 합니다.
+    3.  **스타일링**: 스타일은 `className`을 사용하지 말고, 반드시 CSS 속성을 직접 포함하는 인라인 `style` 객체를 사용해야 합니다.
+"""
+
+GRADING_PROMPT = register_prompt("assignment_grading", "v1", f"""
+# 역할: 최고의 대학 교수 및 튜터
+학생의 과제물을 채점하고 상세한 피드백을 제공합니다.
+{SHARED_FORMATTING_RULES}
+
+# 작업 순서
+1. **채점:** 100점 만점으로 채점하고 단계별 부분 점수를 매깁니다.
+2. **총평:** 잘한 점과 개선점을 요약합니다.
+3. **상세 피드백:** 오답과 부족한 부분을 상세히 설명합니다.
+4. **모범 풀이:** 이상적인 문제 해결 과정을 단계별로 제시합니다.
+5. **추가 학습 제안:** 관련 키워드나 주제를 제안합니다.
+
+# JSON 출력 형식 (반드시 준수)
+- 단일 JSON 객체로만 응답합니다.
+{{
+    "title": "AI 채점 결과: [문제의 핵심 내용]",
+    "content": "# AI 채점 결과\n\n## 총점\n- .../100\n\n## 총평\n- ...\n\n## 상세 피드백\n- ...\n\n## 모범 풀이\n- ...\n\n## 추가 학습 제안\n- ...",
+    "subjectId": "[요청 정보의 subjectId]"
+}}
+""")
+
+SOLVING_PROMPT = register_prompt("assignment_solving", "v1", f"""
+# 역할: 최고의 대학 교수 및 튜터
+학생의 문제를 상세하고 이해하기 쉽게 풀어줍니다.
+{SHARED_FORMATTING_RULES}
+
+# 작업 순서
+1. **문제 분석:** 문제의 핵심 요소를 파악합니다.
+2. **핵심 개념 정리:** 문제 해결에 필요한 이론과 공식을 정리합니다.
+3. **모범 풀이:** 위의 '출력 서식 규칙'을 적극적으로 사용하여 단계별로 상세히 설명합니다.
+4. **결론:** 최종 답안을 명확하게 제시하고 풀이 과정을 요약합니다.
+
+# JSON 출력 형식 (반드시 준수)
+- 단일 JSON 객체로만 응답합니다.
+{{
+    "title": "AI 문제 풀이: [문제의 핵심 내용]",
+    "content": "# AI 문제 풀이\n\n## 문제 분석\n- ...\n\n## 핵심 개념 정리\n- ...\n\n## 모범 풀이\n- ...\n\n## 결론\n- ...",
+    "subjectId": "[요청 정보의 subjectId]"
+}}
+""")
 
 class handler(BaseHTTPRequestHandler):
     def handle_error(self, e, message="오류 발생", status_code=500):
@@ -24,7 +97,9 @@ class handler(BaseHTTPRequestHandler):
             except Exception as write_error:
                 print(f"FATAL: 오류 응답 전송 중 추가 오류 발생: {write_error}")
 
+    @flushes_metrics
     def do_POST(self):
+        deadline = Deadline('assignment_helper')
         api_keys = [
             os.environ.get('GEMINI_API_KEY_PRIMARY'),
             os.environ.get('GEMINI_API_KEY_SECONDARY'),
@@ -39,6 +114,10 @@ class handler(BaseHTTPRequestHandler):
 
         last_error = None
         job_dir = None
+        ticket = None
+        # 프로파일러는 finally에서 반드시 멈춰야 하므로 try 직전에 시작합니다.
+        profile = start_profile('assignment_helper', self)
+        outcome = "error"
 
         try:
             content_length = int(self.headers['Content-Length'])
@@ -49,6 +128,8 @@ class handler(BaseHTTPRequestHandler):
             if not isinstance(blob_urls, list):
                 return self.handle_error(ValueError("blobUrls가 제공되지 않았거나 형식이 잘못되었습니다."), status_code=400)
 
+            ticket = admit('assignment_helper', admission_key(self), deadline)
+
             # Create a unique temporary directory for this job
             job_id = str(uuid.uuid4())
             job_dir = os.path.join(tempfile.gettempdir(), job_id)
@@ -58,8 +139,9 @@ class handler(BaseHTTPRequestHandler):
             if blob_urls:
                 print(f"INFO: {len(blob_urls)}개의 파일을 Blob에서 다운로드합니다...")
                 for url in blob_urls:
+                    download_timeout = deadline.timeout("download", DOWNLOAD_TIMEOUT)
                     try:
-                        response = requests.get(url, stream=True)
+                        response = requests.get(url, stream=True, timeout=download_timeout)
                         response.raise_for_status()
                         
                         path = urlparse(url).path
@@ -70,6 +152,7 @@ class handler(BaseHTTPRequestHandler):
                             for chunk in response.iter_content(chunk_size=8192):
                                 f.write(chunk)
                         print(f"INFO: 다운로드 완료: {filename}")
+                        profile.mark("download", file=filename, bytes=os.path.getsize(file_path))
                     except requests.exceptions.RequestException as e:
                         return self.handle_error(e, f"Blob URL에서 파일 다운로드 실패: {url}", 500)
 
@@ -81,65 +164,10 @@ class handler(BaseHTTPRequestHandler):
 
             has_answer = answer_file_count > 0
             
-            shared_formatting_rules = """
-            # 🎨 출력 서식 규칙 (★★★★★ 가장 중요)
-            당신이 생성하는 모든 텍스트는 아래 규칙을 **반드시** 따라야 합니다.
-            
-            1.  **수학 수식 (LaTeX):** 모든 수학 기호, 변수, 방정식은 **반드시** KaTeX 문법으로 감싸야 합니다. (인라인: $, 블록: $$). 수식 내부에 일반 텍스트(한글 등)를 넣어야 할 경우, 반드시 `\\text{{}}` 명령어로 감싸야 합니다.
-            2.  **다이어그램 (Mermaid):** 복잡한 시스템, 알고리즘, 상태 변화는 **반드시** Mermaid.js 문법으로 시각화해야 합니다. (```mermaid...```). **주의:** 노드 안에서 줄을 바꾸려면 반드시 전체 텍스트를 큰따옴표(`"`)로 감싸고 실제 엔터 키로 줄을 나눠야 합니다. `<br>` 태그는 사용하지 마세요.
-            3.  **코드 (Code Block):** 모든 소스 코드는 **반드시** 언어를 명시한 코드 블록으로 작성해야 합니다. (```python...```)
-            4.  **핵심 용어 (Tooltip):** 중요한 전공 용어는 **반드시** `<dfn title="설명">용어</dfn>` HTML 태그로 감싸 설명을 제공해야 합니다.
-            5.  **자유 시각화 (visual):** 복잡한 개념 등을 시각화할 때 사용합니다.
-                ### visual JSON 생성 규칙 (★★★★★ 반드시 준수)
-                1.  **텍스트 내용**: 텍스트를 표시할 때는 반드시 `props` 객체 안에 `content` 속성을 사용해야 합니다.
-                2.  **요소 중첩**: 다른 요소를 자식으로 포함할 때는 반드시 최상위 레벨의 `children` 배열을 사용해야 합니다.
-                3.  **스타일링**: 스타일은 `className`을 사용하지 말고, 반드시 CSS 속성을 직접 포함하는 인라인 `style` 객체를 사용해야 합니다.
-            """
-
-            prompt_template_grading = f"""
-            # 역할: 최고의 대학 교수 및 튜터
-            학생의 과제물을 채점하고 상세한 피드백을 제공합니다.
-            {shared_formatting_rules}
-
-            # 작업 순서
-            1. **채점:** 100점 만점으로 채점하고 단계별 부분 점수를 매깁니다.
-            2. **총평:** 잘한 점과 개선점을 요약합니다.
-            3. **상세 피드백:** 오답과 부족한 부분을 상세히 설명합니다.
-            4. **모범 풀이:** 이상적인 문제 해결 과정을 단계별로 제시합니다.
-            5. **추가 학습 제안:** 관련 키워드나 주제를 제안합니다.
-
-            # JSON 출력 형식 (반드시 준수)
-            - 단일 JSON 객체로만 응답합니다.
-            {{
-                "title": "AI 채점 결과: [문제의 핵심 내용]",
-                "content": "# AI 채점 결과\n\n## 총점\n- .../100\n\n## 총평\n- ...\n\n## 상세 피드백\n- ...\n\n## 모범 풀이\n- ...\n\n## 추가 학습 제안\n- ...",
-                "subjectId": "{subject_id}"
-            }}
-            """
-
-            prompt_template_solving = f"""
-            # 역할: 최고의 대학 교수 및 튜터
-            학생의 문제를 상세하고 이해하기 쉽게 풀어줍니다.
-            {shared_formatting_rules}
-
-            # 작업 순서
-            1. **문제 분석:** 문제의 핵심 요소를 파악합니다.
-            2. **핵심 개념 정리:** 문제 해결에 필요한 이론과 공식을 정리합니다.
-            3. **모범 풀이:** 위의 '출력 서식 규칙'을 적극적으로 사용하여 단계별로 상세히 설명합니다.
-            4. **결론:** 최종 답안을 명확하게 제시하고 풀이 과정을 요약합니다.
-
-            # JSON 출력 형식 (반드시 준수)
-            - 단일 JSON 객체로만 응답합니다.
-            {{
-                "title": "AI 문제 풀이: [문제의 핵심 내용]",
-                "content": "# AI 문제 풀이\n\n## 문제 분석\n- ...\n\n## 핵심 개념 정리\n- ...\n\n## 모범 풀이\n- ...\n\n## 결론\n- ...",
-                "subjectId": "{subject_id}"
-            }}
-            """
-            
-            prompt_template = prompt_template_grading if has_answer else prompt_template_solving
+            # 고정 지시문은 import 시점에 한 번만 만들고, 요청별 값만 본문에 붙입니다.
+            prompt_spec = GRADING_PROMPT if has_answer else SOLVING_PROMPT
 
-            request_contents = [prompt_template]
+            request_contents = [f"# 요청 정보\n- subjectId: {subject_id}\n"]
             
             if note_context:
                 request_contents.append(f"\n--- 기존 노트 내용 ---\n{note_context}\n")
@@ -151,7 +179,6 @@ class handler(BaseHTTPRequestHandler):
             ans_files = files[reference_file_count + problem_file_count:]
 
             def process_files(file_list, category_name):
-                import google.ai.generativelanguage as glm
                 contents = [f"\n--- {category_name} ---"]
                 for filename in file_list:
                     file_path = os.path.join(job_dir, filename)
@@ -160,7 +187,9 @@ class handler(BaseHTTPRequestHandler):
                             contents.append(Image.open(file_path))
                         elif filename.lower().endswith('.pdf'):
                             with open(file_path, 'rb') as f:
-                                contents.append(glm.Part(inline_data=glm.Blob(mime_type='application/pdf', data=f.read())))
+                                pdf_parts, pdf_report = prepare_pdf_parts(f.read(), label=filename)
+                            print(format_pdf_report(pdf_report))
+                            contents.extend(pdf_parts)
                         else:
                             with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
                                 contents.append(f.read())
@@ -171,32 +200,65 @@ class handler(BaseHTTPRequestHandler):
             if ref_files: request_contents.extend(process_files(ref_files, "참고 자료 파일"))
             if prob_files: request_contents.extend(process_files(prob_files, "문제 파일"))
             if ans_files: request_contents.extend(process_files(ans_files, "학생 답안 파일"))
+            profile.mark("decode", files=len(files))
+
+            routing = choose_model('assignment_helper', describe_materials(request_contents, prompt_spec.tokens),
+                                   task='grading' if has_answer else 'solving')
+            model_name = routing["model"]
+            ticket.charge_model(model_name)
+            profile.mark("request_build", model=model_name)
 
             for i, api_key in enumerate(valid_keys):
+                if not is_available('gemini', i + 1):
+                    print(f"WARN: Gemini 키 #{i + 1}의 서킷 브레이커가 열려 있어 건너뜁니다.")
+                    continue
+                request_options = deadline.request_options("model")
+                started = time.monotonic()
+                response = None
                 try:
                     print(f"INFO: API 키 #{i + 1} (으)로 Gemini API 호출 시도...")
                     genai.configure(api_key=api_key)
-                    model = genai.GenerativeModel('gemini-2.5-flash')
-                    response = model.generate_content(request_contents)
+                    model = build_model(model_name, prompt_spec, api_key)
+                    response = model.generate_content(request_contents, request_options=request_options)
+                    record_outcome('gemini', i + 1, started)
+                    record_llm_call('assignment_helper', model_name, i + 1, started, usage_from_gemini(response))
+                    profile.mark("model", key=i + 1)
                     
                     cleaned_text = response.text.strip().replace('```json', '').replace('```', '')
                     json_response = json.loads(cleaned_text)
+                    json_response["subjectId"] = subject_id
 
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json; charset=utf-8')
-                    self.end_headers()
-                    self.wfile.write(json.dumps(json_response).encode('utf-8'))
+                    outcome = "ok"
+                    send_json(self, 200, json_response, ensure_ascii=True, headers=profile.headers())
                     return
                 except Exception as e:
+                    deadline.check("model")  # 예산 끝에서 잘린 호출은 키 장애로 기록하지 않습니다.
                     last_error = e
+                    if response is None:  # 응답 파싱 실패는 키 탓이 아닙니다.
+                        record_outcome('gemini', i + 1, started, e)
+                    record_llm_call('assignment_helper', model_name, i + 1, started, error=e)
                     print(f"WARN: API 키 #{i + 1} 사용 실패. 다음 키로 폴백합니다. 오류: {e}")
                     continue
             
+            response = gemini_last_resort(model_name, request_contents, prompt_spec.text)
+            if response is not None:
+                json_response = json.loads(response.text.strip().replace('```json', '').replace('```', ''))
+                json_response["subjectId"] = subject_id
+                outcome = "ok"
+                send_json(self, 200, json_response, ensure_ascii=True, headers=profile.headers())
+                return
             raise ConnectionError("모든 Gemini API 키로 요청에 실패했습니다.") from last_error
 
+        except AdmissionRejected as e:
+            send_rejection(self, e)
+        except DeadlineExceeded as e:
+            self.handle_error(e, "요청 시간 한도를 초과했습니다.", 504)
         except Exception as e:
             self.handle_error(e)
         finally:
+            if ticket:
+                ticket.release()
+            profile.finish(outcome)
             if job_dir and os.path.exists(job_dir):
                 try:
                     shutil.rmtree(job_dir)
@@ -3,14 +3,29 @@ import json
 import os
 import requests
 import traceback
-import google.generativeai as genai
-import google.generativeai
 
 import io
+import sys
+import time
 from PIL import Image
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from _lib.admission import AdmissionRejected, admission_key, admit, send_rejection
+from _lib.breaker import is_available, record_outcome
+from _lib.metrics import flushes_metrics, inc, record_llm_call, usage_from_gemini
+from _lib.compression import start_event_stream
+from _lib.deadline import DOWNLOAD_TIMEOUT, MIN_ATTEMPT_SECONDS, STREAM_READ_TIMEOUT, Deadline, DeadlineExceeded
+from _lib.prompts import build_model
+from _lib.retrieval import select_context
+from _lib.routing import FLASH_MODEL
+from _lib import transport
+from _lib.sse import ClientDisconnected, SSEWriter
+
 class handler(BaseHTTPRequestHandler):
+    @flushes_metrics
     def do_POST(self):
+        # 스트리밍 루프까지 같은 시간 예산을 쓰도록 요청 단위로 보관합니다.
+        self.deadline = Deadline('chat')
         # API 키 목록을 환경 변수에서 가져옵니다.
         api_keys = [
             os.environ.get('OPENROUTER_API_KEY_PRIMARY'),
@@ -28,6 +43,7 @@ class handler(BaseHTTPRequestHandler):
         if not valid_keys:
             return self.handle_error(ValueError("설정된 API 키가 없습니다."), "API 키 설정 오류", 500)
 
+        ticket = None
         try:
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
@@ -41,8 +57,12 @@ class handler(BaseHTTPRequestHandler):
             if not history:
                 raise ValueError("대화 내용이 비어있습니다.")
 
+            ticket = admit('chat', admission_key(self), self.deadline)
+            ticket.charge_model(model_identifier)
+
             # --- [프롬프트 강화] ---
-            system_prompt_text = self.get_system_prompt(note_context)
+            query = "" if body.get('fullContext') else self.retrieval_query(history)
+            system_prompt_text = self.get_system_prompt(note_context, query)
             
             messages = self.prepare_messages(history)
 
@@ -50,8 +70,9 @@ class handler(BaseHTTPRequestHandler):
             image_parts = []
             if file_urls:
                 for url in file_urls:
+                    download_timeout = self.deadline.timeout("download", DOWNLOAD_TIMEOUT)
                     try:
-                        response = requests.get(url)
+                        response = requests.get(url, timeout=download_timeout)
                         response.raise_for_status()
                         content_type = response.headers.get('content-type')
                         if content_type and 'image' in content_type:
@@ -67,10 +88,22 @@ class handler(BaseHTTPRequestHandler):
                 # OpenRouter는 현재 멀티모달 입력을 이 형식으로 지원하지 않을 수 있습니다.
                 self.execute_openrouter(model_identifier, messages, system_prompt_text, valid_keys)
 
+        except AdmissionRejected as e:
+            send_rejection(self, e)
+        except DeadlineExceeded as e:
+            self.handle_error(e, "요청 시간 한도를 초과했습니다.", 504)
         except Exception as e:
             self.handle_error(e, "API 요청 처리 중 오류 발생")
+        finally:
+            if ticket:
+                ticket.release()
 
-    def get_system_prompt(self, note_context):
+    def retrieval_query(self, history):
+        # 마지막 사용자 질문과 그 직전 질문을 함께 써서 "그럼 그건?" 같은 후속 질문도 찾도록 합니다.
+        user_texts = [msg.get('text', msg.get('parts', [{}])[0].get('text', '')) for msg in history if msg.get('role') == 'user']
+        return "\n".join(user_texts[-2:])
+
+    def get_system_prompt(self, note_context, query=""):
         prompt = r"""
         당신은 학생의 학습을 돕는 유능한 AI 튜터입니다. 당신의 답변은 반드시 아래 규칙을 따라야 합니다.
 
@@ -129,7 +162,12 @@ class handler(BaseHTTPRequestHandler):
         2.  **답변 형식:** 절대로 JSON을 사용하지 마세요. 다른 부가 정보나 포장 없이, 순수한 마크다운 형식의 답변만 생성해야 합니다.
 """
         if note_context:
-            prompt += f"\n---\n# 참고 자료\n아래는 사용자가 현재 보고 있는 노트의 내용입니다. 이 내용을 바탕으로 답변해주세요.\n\n{note_context}\n---"
+            context, report = select_context(note_context, query)
+            print(f"INFO: 노트 컨텍스트 {report['mode']} - {report['note_tokens']} -> {report['context_tokens']} 토큰")
+            if report["mode"] == "retrieval":
+                prompt += f"\n---\n# 참고 자료\n아래는 사용자가 현재 보고 있는 노트의 목차와, 질문과 관련된 부분을 발췌한 내용입니다. 이 내용을 바탕으로 답변해주세요.\n\n{context}\n---"
+            else:
+                prompt += f"\n---\n# 참고 자료\n아래는 사용자가 현재 보고 있는 노트의 내용입니다. 이 내용을 바탕으로 답변해주세요.\n\n{context}\n---"
         return prompt
 
     def prepare_messages(self, history):
@@ -146,38 +184,51 @@ class handler(BaseHTTPRequestHandler):
         if not gemini_api_keys:
             raise ValueError("설정된 Gemini API 키가 없습니다.")
 
+        clean_model_id = model_identifier.replace('google/', '')
+        gemini_messages = [
+            {'role': 'user', 'parts': [system_prompt_text]},
+            {'role': 'model', 'parts': ['네, 알겠습니다. 규칙을 모두 확인했으며, 반드시 JSON 형식으로만 답변하겠습니다.']}
+        ] + self.convert_to_gemini_format(messages)
+
+        # 마지막 사용자 메시지에 이미지 추가
+        if image_parts and gemini_messages:
+            last_message = gemini_messages[-1]
+            if last_message['role'] == 'user':
+                # 텍스트 파트와 이미지 파트를 결합
+                text_part = last_message['parts'][0] # 기존 텍스트 파트
+                last_message['parts'] = [text_part] + image_parts
+
         last_error = None
         for i, api_key in enumerate(gemini_api_keys):
+            if not is_available('gemini', i + 1):
+                print(f"WARN: Gemini 키 #{i + 1}의 서킷 브레이커가 열려 있어 건너뜁니다.")
+                continue
+            request_options = self.deadline.request_options("model")
+            started = time.monotonic()
             try:
                 print(f"INFO: Gemini Direct 모델 '{model_identifier}' / API 키 #{i + 1} 호출 시도...")
-                genai.configure(api_key=api_key)
-                
-                clean_model_id = model_identifier.replace('google/', '')
-                model = genai.GenerativeModel(clean_model_id)
-
-                gemini_messages = [
-                    {'role': 'user', 'parts': [system_prompt_text]},
-                    {'role': 'model', 'parts': ['네, 알겠습니다. 규칙을 모두 확인했으며, 반드시 JSON 형식으로만 답변하겠습니다.']}
-                ] + self.convert_to_gemini_format(messages)
-
-                # 마지막 사용자 메시지에 이미지 추가
-                if image_parts and gemini_messages:
-                    last_message = gemini_messages[-1]
-                    if last_message['role'] == 'user':
-                        # 텍스트 파트와 이미지 파트를 결합
-                        text_part = last_message['parts'][0] # 기존 텍스트 파트
-                        last_message['parts'] = [text_part] + image_parts
+                # 전역 genai.configure 없이 키별 클라이언트에 고정된 모델을 씁니다.
+                model = build_model(clean_model_id, None, api_key)
 
                 response = model.generate_content(
                     gemini_messages,
-                    stream=True
+                    stream=True,
+                    request_options=request_options
                 )
+                record_outcome('gemini', i + 1, started)
                 
                 self.stream_json_response(response)
+                record_llm_call('chat', clean_model_id, i + 1, started, usage_from_gemini(response))
                 return
             except Exception as e:
                 last_error = e
+                record_outcome('gemini', i + 1, started, e)
+                record_llm_call('chat', clean_model_id, i + 1, started, error=e)
                 print(f"WARN: Gemini Direct API 키 #{i + 1} 사용 실패. 다음 키로 폴백합니다. 오류: {e}")
+        response = transport.gemini_last_resort(clean_model_id, gemini_messages, stream=True)
+        if response is not None:
+            self.stream_json_response(response)
+            return
         raise ConnectionError(f"모든 Gemini API 키로 요청에 실패했습니다.") from last_error
 
     def convert_to_gemini_format(self, messages):
@@ -193,17 +244,24 @@ class handler(BaseHTTPRequestHandler):
             raise ValueError("설정된 OpenRouter API 키가 없습니다.")
 
         last_error = None
+        payload = {
+            "model": model_identifier,
+            "messages": [{"role": "system", "content": system_prompt_text}] + messages,
+            "stream": True,
+            "usage": {"include": True}
+        }
         for i, api_key in enumerate(openrouter_api_keys):
+            if not is_available('openrouter', i + 1):
+                print(f"WARN: OpenRouter 키 #{i + 1}의 서킷 브레이커가 열려 있어 건너뜁니다.")
+                continue
+            # 연결은 짧게, 청크 사이 대기는 남은 예산 안에서만 허용합니다.
+            read_timeout = self.deadline.timeout("model", STREAM_READ_TIMEOUT, MIN_ATTEMPT_SECONDS)
+            started = time.monotonic()
             try:
                 print(f"INFO: OpenRouter 모델 '{model_identifier}' / API 키 #{i + 1} 호출 시도...")
-                payload = {
-                    "model": model_identifier,
-                    "messages": [{"role": "system", "content": system_prompt_text}] + messages,
-                    "stream": True
-                }
-
-                response = requests.post(
-                    url="https://openrouter.ai/api/v1/chat/completions",
+                response = transport.http(
+                    'openrouter', 'POST',
+                    "https://openrouter.ai/api/v1/chat/completions",
                     headers={
                         "Authorization": f"Bearer {api_key}",
                         "Content-Type": "application/json",
@@ -211,79 +269,113 @@ class handler(BaseHTTPRequestHandler):
                         "X-Title": "Studious"
                     },
                     json=payload,
-                    stream=True
+                    stream=True,
+                    timeout=(10, read_timeout)
                 )
                 response.raise_for_status()
+                # 스트림은 응답 헤더를 받은 시점까지의 지연으로 판단합니다.
+                record_outcome('openrouter', i + 1, started)
                 
-                self.stream_openrouter_response(response)
+                usage = self.stream_openrouter_response(response)
+                record_llm_call('chat', model_identifier, i + 1, started, usage, upstream="openrouter")
                 return
             except requests.exceptions.RequestException as e:
                 last_error = e
+                record_outcome('openrouter', i + 1, started, e)
+                record_llm_call('chat', model_identifier, i + 1, started, error=e, upstream="openrouter")
                 print(f"WARN: API 키 #{i + 1} 사용 실패. 다음 키로 폴백합니다. 오류: {e}")
+        response = transport.http_last_resort('openrouter', 'POST', "https://openrouter.ai/api/v1/chat/completions", json=payload)
+        if response is not None:
+            self.stream_openrouter_response(response)
+            return
+        if any(key.startswith('AIza') for key in valid_keys):
+            return self.failover_to_gemini(model_identifier, messages, system_prompt_text, valid_keys)
         raise ConnectionError(f"모든 OpenRouter API 키로 요청에 실패했습니다.") from last_error
 
+    def failover_to_gemini(self, model_identifier, messages, system_prompt_text, valid_keys):
+        """Answers an OpenRouter request with direct Gemini once every OpenRouter key is down or open."""
+        # google/gemini-* 모델은 같은 모델로, 나머지는 Flash로 대체합니다.
+        gemini_model = model_identifier.split('/', 1)[-1] if model_identifier.startswith('google/gemini-') else FLASH_MODEL
+        gemini_model = gemini_model.split(':', 1)[0]
+        inc("circuit_breaker_failovers_total", endpoint="chat", source="openrouter", target="gemini")
+        print(f"WARN: OpenRouter를 사용할 수 없어 Gemini '{gemini_model}'(으)로 전환합니다.")
+        self.execute_gemini_direct(gemini_model, messages, system_prompt_text, valid_keys)
+
     def stream_json_response(self, response_iterator):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/event-stream; charset=utf-8')
-        self.end_headers()
-        
+        stream = start_event_stream(self)
+        writer = SSEWriter(stream, lambda text: {"type": "token", "content": text})
         try:
             for chunk in response_iterator:
+                if self.stream_deadline_reached(writer):
+                    break
                 if chunk.text:
-                    token_json = json.dumps({"type": "token", "content": chunk.text})
-                    self.wfile.write(f"data: {token_json}\n\n".encode('utf-8'))
-                    self.wfile.flush()
+                    writer.send_token(chunk.text)
                 if hasattr(chunk, 'info') and hasattr(chunk.info, 'thought_summary') and chunk.info.thought_summary:
-                    thought_json = json.dumps({"type": "thought", "content": chunk.info.thought_summary})
-                    self.wfile.write(f"data: {thought_json}\n\n".encode('utf-8'))
-                    self.wfile.flush()
+                    writer.send_event({"type": "thought", "content": chunk.info.thought_summary})
+        except ClientDisconnected as e:
+            print(f"WARN: 클라이언트 연결 종료로 Gemini 스트림을 중단합니다: {e}")
         except Exception as e:
             print(f"ERROR: 스트리밍 중 오류 발생: {e}")
-            error_json = json.dumps({"error": "스트리밍 중 오류 발생", "details": str(e)})
-            self.wfile.write(f"data: {error_json}\n\n".encode('utf-8'))
-            self.wfile.flush()
-
-        # 스트림의 끝을 알리는 [DONE] 메시지 전송
-        self.wfile.write('data: [DONE]\n\n'.encode('utf-8'))
-        self.wfile.flush()
+            try:
+                writer.send_event({"error": "스트리밍 중 오류 발생", "details": str(e)})
+            except ClientDisconnected:
+                pass
+        finally:
+            # 남은 토큰을 내보내고 스트림의 끝을 알리는 [DONE] 메시지 전송
+            writer.close()
 
     def stream_openrouter_response(self, response):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/event-stream; charset=utf-8')
-        self.end_headers()
-
+        stream = start_event_stream(self)
+        writer = SSEWriter(stream, lambda text: {"token": text})
+        usage = (0, 0, 0)
         try:
             for line in response.iter_lines():
-                if line:
-                    decoded_line = line.decode('utf-8')
-                    if decoded_line.startswith('data: '):
-                        json_str = decoded_line[len('data: '):].strip()
-                        if json_str == '[DONE]':
-                            break
-                        if not json_str:
-                            continue
-                        
-                        try:
-                            data = json.loads(json_str)
-                            if 'choices' in data and data['choices']:
-                                delta = data['choices'][0].get('delta', {})
-                                content = delta.get('content')
-                                if content:
-                                    # 토큰을 포함한 JSON 객체를 생성하여 전송
-                                    token_json = json.dumps({"token": content})
-                                    self.wfile.write(f"data: {token_json}\n\n".encode('utf-8'))
-                                    self.wfile.flush()
-                        except json.JSONDecodeError:
-                            print(f"WARN: OpenRouter 스트림의 JSON 파싱 실패: {json_str}")
-                            continue
+                if writer.closed or self.stream_deadline_reached(writer):
+                    break
+                if not line or not line.startswith(b'data: '):
+                    continue
+                json_str = line[len(b'data: '):].strip()
+                if json_str == b'[DONE]':
+                    break
+                if not json_str:
+                    continue
+
+                try:
+                    data = json.loads(json_str)
+                except json.JSONDecodeError:
+                    print(f"WARN: OpenRouter 스트림의 JSON 파싱 실패: {json_str.decode('utf-8', errors='replace')}")
+                    continue
+                if data.get('usage'):
+                    # OpenRouter는 usage.include가 설정되면 마지막 청크에 토큰 사용량을 보냅니다.
+                    details = data['usage'].get('prompt_tokens_details') or {}
+                    usage = (data['usage'].get('prompt_tokens', 0), data['usage'].get('completion_tokens', 0), details.get('cached_tokens', 0))
+                if 'choices' in data and data['choices']:
+                    delta = data['choices'][0].get('delta', {})
+                    content = delta.get('content')
+                    if content:
+                        writer.send_token(content)
+        except ClientDisconnected as e:
+            print(f"WARN: 클라이언트 연결 종료로 OpenRouter 스트림을 중단합니다: {e}")
         except Exception as e:
             print(f"ERROR: OpenRouter 스트리밍 중 오류 발생: {e}")
-            error_json = json.dumps({"error": "스트리밍 중 오류 발생", "details": str(e)})
-            self.wfile.write(f"data: {error_json}\n\n".encode('utf-8'))
-            self.wfile.flush()
-
-        self.wfile.write('data: [DONE]\n\n'.encode('utf-8'))
-        self.wfile.flush()
+            try:
+                writer.send_event({"error": "스트리밍 중 오류 발생", "details": str(e)})
+            except ClientDisconnected:
+                pass
+        finally:
+            # 클라이언트가 떠났다면 업스트림 연결도 즉시 끊어 토큰 생성을 중단시킵니다.
+            response.close()
+            writer.close()
+        return usage
+
+    def stream_deadline_reached(self, writer):
+        """Ends a stream cleanly with a timeout event once the request deadline has passed."""
+        if not self.deadline.expired:
+            return False
+        inc("request_deadline_exceeded_total", endpoint=self.deadline.endpoint, stage="stream")
+        print(f"WARN: 요청 시간 예산을 모두 사용하여 스트림을 부분 응답으로 종료합니다. {self.deadline.describe()}")
+        writer.send_event({"type": "timeout", "error": "응답 시간 한도에 도달하여 답변이 중간에 끝났습니다."})
+        return True
 
     def handle_error(self, e, message="오류 발생", status_code=500):
         print(f"ERROR: {message}: {e}")
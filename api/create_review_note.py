@@ -8,6 +8,26 @@ from PIL import Image
 import traceback
 import shutil
 import re # re 모듈 추가
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import unquote, urlparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from _lib.admission import AdmissionRejected, admission_key, admit, send_rejection, verified_user_id
+from _lib.breaker import is_available, record_outcome
+from _lib.budget import TokenBudgetExceeded, govern_request
+from _lib.deadline import DOWNLOAD_TIMEOUT, Deadline, DeadlineExceeded
+from _lib.digests import build_digest, format_digests, load_digests, save_digest, week_number
+from _lib.dedup import dedup_materials, format_dedup_report
+from _lib.compression import send_json, start_event_stream
+from _lib.materials import MaterialsTooLarge, MemoryCeiling, decode_material, download_material
+from _lib.metrics import flushes_metrics, record_llm_call, usage_from_gemini
+from _lib.prompts import build_model, register_prompt
+from _lib.routing import FLASH_MODEL, choose_model, describe_materials
+from _lib.sse import ClientDisconnected, SSEWriter
+from _lib import transport
+from _lib.transport import gemini_last_resort
 
 # ==============================================================================
 # HELPER FUNCTIONS
@@ -39,9 +59,188 @@ def extract_first_json(text: str):
     except json.JSONDecodeError as e:
         raise ValueError(f"Failed to decode JSON: {e} - Response text was: '{text}'")
 
+# ==============================================================================
+# PROMPTS
+# ==============================================================================
+REVIEW_NOTE_PROMPT = register_prompt("create_review_note", "v1", """
+당신은 인지과학과 교육심리학 전문가입니다. 첨부된 강의 자료를 분석하여, 학생이 스스로 깊이 있게 학습할 수 있는 최고의 복습 노트를 제작해야 합니다.
+
+절대 규칙: 모든 시각 자료는 반드시 지정된 언어의 코드 블록 안에 포함하여 출력해야 합니다. 이 규칙은 선택이 아닌 필수입니다. 코드 블록 바깥에 순수한 JSON이나 다이어그램 코드를 절대로 출력해서는 안 됩니다. 이 규칙을 위반한 출력은 실패한 것으로 간주됩니다.
+
+# 🎨 출력 서식 규칙 (★★★★★ 가장 중요)
+당신이 생성하는 모든 텍스트는 아래 규칙을 반드시 따라야 합니다.
+
+1.  **수학 수식 (LaTeX):** 모든 수학 기호, 변수, 방정식은 반드시 KaTeX 문법으로 감싸야 합니다.
+    -   인라인 수식: $로 감쌉니다. 예: $q''_x = -k \\frac{dT}{dx}$
+    -   블록 수식: $$로 감쌉니다. 예: $$T(x) = T_s + \\frac{q'''}{2k}(Lx - x^2)$$
+    -   수식 내부에 일반 텍스트(한글 등)를 넣어야 할 경우, 반드시 `\\text{}` 명령어로 감싸야 합니다. (예: $(P_\\text{목표} - P_\\text{시작})$)
+
+2.  Mermaid (mermaid): 순서도, 타임라인 등을 시각화할 때 사용합니다.
+   - **따옴표 규칙:** 노드 이름, 링크 텍스트, subgraph 제목에 줄바꿈, 공백, 또는 특수문자 `( ) ,`가 포함될 경우, 반드시 전체 내용을 큰따옴표(`"`)로 감싸야 합니다.
+   - **줄바꿈:** 노드 안에서 줄을 바꾸려면 `<br>` 태그 대신, 반드시 전체 텍스트를 큰따옴표(`"`)로 감싸고 실제 엔터 키로 줄을 나눠야 합니다.
+   - **수식 사용 금지:** Mermaid 노드 안에서는 LaTeX 수식을 렌더링할 수 없으니, `ΔP`와 같은 간단한 텍스트나 유니코드 기호만 사용하세요.
+
+   - **올바른 예시:**
+    A["첫 번째 줄
+    두 번째 줄"]
+    B["노드 이름 (특수문자)"]
+    C -- "링크 텍스트" --> D
+    subgraph "서브그래프 제목"
+
+  - **잘못된 예시:**
+   A[첫 번째 줄<br>두 번째 줄]
+   B[노드 이름 (특수문자)]
+     C -- 링크 텍스트 --> D
+     subgraph 서브그래프 제목
+
+3.  **코드 (Code Block):** 모든 소스 코드는 반드시 언어를 명시한 코드 블록으로 작성해야 합니다.
+    -   예시: ```python\nprint("Hello")\n```
+
+4.  **핵심 용어 (Tooltip):** 중요한 전공 용어는 반드시 <dfn title="용어에 대한 간단한 설명">핵심 용어</dfn> HTML 태그로 감싸 설명을 제공해야 합니다.
+    -   예시: <dfn title="매질 없이 열이 직접 전달되는 현상">복사</dfn>
+
+5.  **자유 시각화 (visual):** 복잡한 개념, 비교, 구조 등을 설명해야 할 때, 아래 규칙에 따라 가상의 UI 컴포넌트 구조를 JSON으로 설계하여 시각화할 수 있습니다. **이 JSON 데이터는 반드시 `visual` 언어 타입의 코드 블록으로 감싸야 합니다.**
+
+    - **올바른 예시:**
+    ```visual
+    {
+      "type": "box",
+      "children": [ { "type": "text", "props": { "content": "예시" } } ]
+    }
+    ```
+
+    ### visual JSON 생성 규칙 (★★★★★ 반드시 준수)
+    1.  **텍스트 내용**: 텍스트를 표시할 때는 반드시 `props` 객체 안에 `content` 속성을 사용해야 합니다.
+    2.  **요소 중첩**: 다른 요소를 자식으로 포함할 때는 반드시 최상위 레벨의 `children` 배열을 사용해야 합니다.
+    3.  **스타일링**: 스타일은 `className`을 사용하지 말고, 반드시 CSS 속성을 직접 포함하는 인라인 `style` 객체를 사용해야 합니다.
+
+# 📚 결과물 구조 (코넬 노트 + SQ3R 변형)
+1.  **Cues (단서 영역):** 학습 내용을 대표하는 핵심 질문, 키워드, 용어를 5~7개 제시하세요.
+2.  **Notes (노트 영역):** -   Cues 영역의 각 항목에 대해 상세하고 깊이 있는 설명을 제공합니다.
+    -   반드시 위에서 설명한 '출력 서식 규칙'을 준수하여(수식, 다이어그램, 코드, 툴팁) 내용을 풍부하게 만드세요.
+    -   단순 요약을 넘어, 개념 간의 연결, 실제 적용 사례, 잠재적인 질문을 포함하여 "살아있는 지식"을 전달해야 합니다.
+3.  **Summary (요약 영역):** -   강의 자료 전체의 핵심 내용을 3~5문장으로 압축하여 요약합니다.
+    -   이 요약은 학생이 30초 안에 해당 강의의 정수를 파악할 수 있도록 도와야 합니다.
+
+# ✅ 최종 품질 체크리스트
+-   Cues, Notes, Summary 구조가 명확하게 구분되었는가?
+-   Notes 영역이 '출력 서식 규칙'을 완벽하게 준수하여 작성되었는가?
+-   단순 정보 나열이 아닌, 깊이 있는 학습을 유도하는 내용인가?
+
+결과물은 다른 설명 없이, 다음 JSON 형식으로만 생성해야 합니다.
+**주의: JSON 문자열 값 내의 모든 백슬래시(예: LaTeX 수식)는 반드시 이중 백슬래시(\\)로 이스케이프해야 합니다.**
+```json
+{
+  "title": "생성된 노트의 제목",
+  "content": "위 규칙들을 모두 준수한 복습 노트 본문(마크다운). **모든 백슬래시는 이중 이스케이프되어야 합니다.**",
+  "key_insights": ["핵심 인사이트 1", "핵심 인사이트 2"],
+  "quiz": {
+    "questions": [
+      {
+        "question": "질문 1",
+        "options": ["옵션 1", "옵션 2", "옵션 3", "옵션 4"],
+        "answer": "정답 옵션"
+      }
+    ]
+  },
+  "subjectName": "추론된 과목명 (예: 인지과학 개론)"
+}
+```
+""")
+
+REVIEW_NOTE_DRAFT_PROMPT = register_prompt("create_review_note_draft", "v1", """
+당신은 강의 자료를 빠르게 훑어 복습 노트의 초안을 만드는 조교입니다. 첨부된 강의 자료를 바탕으로, 최종 노트가 완성되기 전에 학생이 먼저 볼 수 있는 간결한 초안을 작성하세요.
+
+# 규칙
+- `content`에는 상세 설명 없이 마크다운 제목(##, ###)과 글머리 기호로 된 개요만 작성합니다.
+- `key_insights`는 3~5개의 짧은 문장으로 작성합니다.
+- 수식은 KaTeX 문법($...$)을 사용하고, JSON 문자열 안의 모든 백슬래시는 이중 백슬래시(\\\\)로 이스케이프해야 합니다.
+
+결과물은 다른 설명 없이, 다음 JSON 형식으로만 생성해야 합니다.
+```json
+{
+  "title": "생성된 노트의 제목",
+  "content": "마크다운 개요",
+  "key_insights": ["핵심 인사이트 1", "핵심 인사이트 2"]
+}
+```
+""")
+
+# 분할 모드: 같은 지시문에 출력 범위만 덧붙여, 본문과 퀴즈/인사이트를 동시에 생성합니다.
+SPLIT_SECTIONS = (
+    ("body", register_prompt("create_review_note_body", "v1", REVIEW_NOTE_PROMPT.text + """
+# ✂️ 분할 생성 모드
+이번 요청에서는 위 JSON 형식 중 `title`, `content`, `subjectName` 필드만 생성하세요. `key_insights`와 `quiz`는 별도 요청에서 생성되므로 출력하지 마세요.
+"""), ("title", "content", "subjectName")),
+    ("extras", register_prompt("create_review_note_extras", "v1", REVIEW_NOTE_PROMPT.text + """
+# ✂️ 분할 생성 모드
+이번 요청에서는 위 JSON 형식 중 `key_insights`와 `quiz` 필드만 생성하세요. 노트 본문(`content`)은 별도 요청에서 생성되므로 출력하지 마세요.
+"""), ("key_insights", "quiz")),
+)
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def generate_json(valid_keys, model_name, prompt_spec, request_contents, endpoint='create_review_note', deadline=None):
+    """Calls the model with key fallback and returns the first JSON object of its reply.
+
+    Each key attempt gets the time left on deadline; DeadlineExceeded stops the loop.
+    """
+    last_error = None
+    for i, api_key in enumerate(valid_keys):
+        if not is_available('gemini', i + 1):
+            print(f"WARN: Gemini 키 #{i + 1}의 서킷 브레이커가 열려 있어 건너뜁니다.")
+            continue
+        request_options = deadline.request_options(f"model:{prompt_spec.name}") if deadline else None
+        started = time.monotonic()
+        response = None
+        try:
+            print(f"INFO: API 키 #{i + 1} (으)로 복습노트 생성 시도 ({model_name}, {prompt_spec.name})...")
+            genai.configure(api_key=api_key)
+            model = build_model(model_name, prompt_spec, api_key)
+
+            response = model.generate_content(request_contents, request_options=request_options)
+            record_outcome('gemini', i + 1, started)
+            record_llm_call(endpoint, model_name, i + 1, started, usage_from_gemini(response))
+
+            return extract_first_json(response.text)
+        except Exception as e:
+            if deadline is not None:
+                deadline.check("model")  # 예산 끝에서 잘린 호출은 키 장애로 기록하지 않습니다.
+            last_error = e
+            if response is None:  # JSON 파싱 실패는 키 탓이 아닙니다.
+                record_outcome('gemini', i + 1, started, e)
+            record_llm_call(endpoint, model_name, i + 1, started, error=e)
+            print(f"WARN: API 키 #{i + 1} 사용 실패. 다음 키로 폴백합니다. 오류: {e}")
+
+    response = gemini_last_resort(model_name, request_contents, prompt_spec.text)
+    if response is not None:
+        return extract_first_json(response.text)
+    raise ConnectionError("모든 Gemini API 키로 요청에 실패했습니다.") from last_error
+
+def generate_sections(valid_keys, model_name, request_contents, deadline=None):
+    """Generates the note body and the quiz/insights concurrently and merges them.
+
+    Each section runs its own key fallback loop on the same request contents, so
+    wall time is that of the slowest section. Fails if any section fails.
+    """
+    merged = {}
+    with ThreadPoolExecutor(max_workers=len(SPLIT_SECTIONS)) as executor:
+        futures = [
+            (fields, executor.submit(generate_json, valid_keys, model_name, spec, request_contents, f'create_review_note_{section}', deadline))
+            for section, spec, fields in SPLIT_SECTIONS
+        ]
+        for fields, future in futures:
+            section_data = future.result()
+            merged.update({field: section_data[field] for field in fields if field in section_data})
+    return merged
+
 class handler(BaseHTTPRequestHandler):
 
+    @flushes_metrics
     def do_POST(self):
+        deadline = Deadline('create_review_note')
         api_keys = [
             os.environ.get('GEMINI_API_KEY_PRIMARY'),
             os.environ.get('GEMINI_API_KEY_SECONDARY'),
@@ -53,8 +252,8 @@ class handler(BaseHTTPRequestHandler):
         if not valid_keys:
             return self.handle_error(ValueError("설정된 Gemini API 키가 없습니다."), "API 키 설정 오류", 500)
 
-        last_error = None
         blob_urls_to_delete = [] # To store URLs for cleanup
+        ticket = None
 
         try:
             content_length = int(self.headers['Content-Length'])
@@ -65,102 +264,33 @@ class handler(BaseHTTPRequestHandler):
             if 'blobUrls' not in data or not isinstance(data['blobUrls'], list):
                 return self.handle_error(ValueError("유효하지 않은 blobUrls 입니다."), status_code=400)
 
+            # 주차 다이제스트는 로그인한 사용자별로만 읽고 씁니다. subjectId는 클라이언트가 보내는 값이라 믿지 않습니다.
+            subject_id = data.get('subjectId')
+            user_id = None
+            if data.get('incremental') or subject_id:
+                user_id = verified_user_id(self)
+                if not user_id:
+                    return self.handle_error(PermissionError("로그인 토큰이 없거나 유효하지 않습니다."),
+                                             "증분 모드와 주차 다이제스트에는 로그인이 필요합니다.", 401)
+                if not data.get('week'):
+                    return self.handle_error(ValueError("week 값이 없습니다."),
+                                             "증분 모드와 주차 다이제스트에는 주차(week)를 지정해야 합니다.", 400)
+
+            # 거부된 요청은 Blob을 지우지 않아야 클라이언트가 Retry-After 뒤에 그대로 재시도할 수 있습니다.
+            ticket = admit('create_review_note', admission_key(self), deadline)
             blob_urls_to_delete.extend(blob_urls) # Add to cleanup list
 
             subject_name = data.get('subject', '[과목명]')
             week_info = data.get('week', '[N주차/18주차]')
             material_types = data.get('materialTypes', '[PPT/PDF/텍스트 등]')
 
-            prompt = f"""
-              당신은 인지과학과 교육심리학 전문가입니다. 첨부된 강의 자료를 분석하여, 학생이 스스로 깊이 있게 학습할 수 있는 최고의 복습 노트를 제작해야 합니다.
-
-              # 📖 노트 정보
-              - 과목: {subject_name}
-              - 주차: {week_info}
-              - 자료 형태: {material_types}
-
-              절대 규칙: 모든 시각 자료는 반드시 지정된 언어의 코드 블록 안에 포함하여 출력해야 합니다. 이 규칙은 선택이 아닌 필수입니다. 코드 블록 바깥에 순수한 JSON이나 다이어그램 코드를 절대로 출력해서는 안 됩니다. 이 규칙을 위반한 출력은 실패한 것으로 간주됩니다. 
-      
-              # 🎨 출력 서식 규칙 (★★★★★ 가장 중요)
-              당신이 생성하는 모든 텍스트는 아래 규칙을 반드시 따라야 합니다.
-
-              1.  **수학 수식 (LaTeX):** 모든 수학 기호, 변수, 방정식은 반드시 KaTeX 문법으로 감싸야 합니다. 
-                  -   인라인 수식: $로 감쌉니다. 예: $q''_x = -k \\frac{{dT}}{{dx}}$
-                  -   블록 수식: $$로 감쌉니다. 예: $$T(x) = T_s + \\frac{{q'''}}{{2k}}(Lx - x^2)$$
-                  -   수식 내부에 일반 텍스트(한글 등)를 넣어야 할 경우, 반드시 `\\text{{}}` 명령어로 감싸야 합니다. (예: $(P_\\text{{목표}} - P_\\text{{시작}})$)
-
-              2.  Mermaid (mermaid): 순서도, 타임라인 등을 시각화할 때 사용합니다.
-                 - **따옴표 규칙:** 노드 이름, 링크 텍스트, subgraph 제목에 줄바꿈, 공백, 또는 특수문자 `( ) ,`가 포함될 경우, 반드시 전체 내용을 큰따옴표(`"`)로 감싸야 합니다.
-                 - **줄바꿈:** 노드 안에서 줄을 바꾸려면 `<br>` 태그 대신, 반드시 전체 텍스트를 큰따옴표(`"`)로 감싸고 실제 엔터 키로 줄을 나눠야 합니다.
-                 - **수식 사용 금지:** Mermaid 노드 안에서는 LaTeX 수식을 렌더링할 수 없으니, `ΔP`와 같은 간단한 텍스트나 유니코드 기호만 사용하세요.
-
-                 - **올바른 예시:**
-                  A["첫 번째 줄
-                  두 번째 줄"]
-                  B["노드 이름 (특수문자)"]
-                  C -- "링크 텍스트" --> D
-                  subgraph "서브그래프 제목"
-        
-                - **잘못된 예시:**
-                 A[첫 번째 줄<br>두 번째 줄]
-                 B[노드 이름 (특수문자)]
-                   C -- 링크 텍스트 --> D
-                   subgraph 서브그래프 제목  
-
-              3.  **코드 (Code Block):** 모든 소스 코드는 반드시 언어를 명시한 코드 블록으로 작성해야 합니다.
-                  -   예시: ```python\nprint("Hello")\n```
-
-              4.  **핵심 용어 (Tooltip):** 중요한 전공 용어는 반드시 <dfn title="용어에 대한 간단한 설명">핵심 용어</dfn> HTML 태그로 감싸 설명을 제공해야 합니다.
-                  -   예시: <dfn title="매질 없이 열이 직접 전달되는 현상">복사</dfn>
-
-              5.  **자유 시각화 (visual):** 복잡한 개념, 비교, 구조 등을 설명해야 할 때, 아래 규칙에 따라 가상의 UI 컴포넌트 구조를 JSON으로 설계하여 시각화할 수 있습니다. **이 JSON 데이터는 반드시 `visual` 언어 타입의 코드 블록으로 감싸야 합니다.**
-
-                  - **올바른 예시:**
-                  ```visual
-                  {{
-                    "type": "box",
-                    "children": [ {{ "type": "text", "props": {{ "content": "예시" }} }} ]
-                  }}
-                  ```
-
-                  ### visual JSON 생성 규칙 (★★★★★ 반드시 준수)
-                  1.  **텍스트 내용**: 텍스트를 표시할 때는 반드시 `props` 객체 안에 `content` 속성을 사용해야 합니다.
-                  2.  **요소 중첩**: 다른 요소를 자식으로 포함할 때는 반드시 최상위 레벨의 `children` 배열을 사용해야 합니다.
-                  3.  **스타일링**: 스타일은 `className`을 사용하지 말고, 반드시 CSS 속성을 직접 포함하는 인라인 `style` 객체를 사용해야 합니다.
-
-              # 📚 결과물 구조 (코넬 노트 + SQ3R 변형)
-              1.  **Cues (단서 영역):** 학습 내용을 대표하는 핵심 질문, 키워드, 용어를 5~7개 제시하세요.
-              2.  **Notes (노트 영역):** -   Cues 영역의 각 항목에 대해 상세하고 깊이 있는 설명을 제공합니다.
-                  -   반드시 위에서 설명한 '출력 서식 규칙'을 준수하여(수식, 다이어그램, 코드, 툴팁) 내용을 풍부하게 만드세요.
-                  -   단순 요약을 넘어, 개념 간의 연결, 실제 적용 사례, 잠재적인 질문을 포함하여 "살아있는 지식"을 전달해야 합니다.
-              3.  **Summary (요약 영역):** -   강의 자료 전체의 핵심 내용을 3~5문장으로 압축하여 요약합니다.
-                  -   이 요약은 학생이 30초 안에 해당 강의의 정수를 파악할 수 있도록 도와야 합니다.
-
-              # ✅ 최종 품질 체크리스트
-              -   Cues, Notes, Summary 구조가 명확하게 구분되었는가?
-              -   Notes 영역이 '출력 서식 규칙'을 완벽하게 준수하여 작성되었는가?
-              -   단순 정보 나열이 아닌, 깊이 있는 학습을 유도하는 내용인가?
-
-              결과물은 다른 설명 없이, 다음 JSON 형식으로만 생성해야 합니다. 
-              **주의: JSON 문자열 값 내의 모든 백슬래시(예: LaTeX 수식)는 반드시 이중 백슬래시(\\)로 이스케이프해야 합니다.**
-              ```json
-              {{
-                "title": "생성된 노트의 제목",
-                "content": "위 규칙들을 모두 준수한 복습 노트 본문(마크다운). **모든 백슬래시는 이중 이스케이프되어야 합니다.**",
-                "key_insights": ["핵심 인사이트 1", "핵심 인사이트 2"],
-                "quiz": {{
-                  "questions": [
-                    {{
-                      "question": "질문 1",
-                      "options": ["옵션 1", "옵션 2", "옵션 3", "옵션 4"],
-                      "answer": "정답 옵션"
-                    }}
-                  ]
-                }},
-                "subjectName": "추론된 과목명 (예: 인지과학 개론)"
-              }}
-              ```
-              """
+            # 고정 지시문은 REVIEW_NOTE_PROMPT(system instruction)로 보내고, 요청별 정보만 본문에 붙입니다.
+            prompt = (
+                "# 📖 노트 정보\n"
+                f"- 과목: {subject_name}\n"
+                f"- 주차: {week_info}\n"
+                f"- 자료 형태: {material_types}\n"
+            )
 
             request_contents = [prompt]
 
@@ -169,69 +299,103 @@ class handler(BaseHTTPRequestHandler):
             if ai_conversation_text:
                 request_contents.append(ai_conversation_text)
 
+            # 증분 모드: 이전 주차 자료를 다시 보내는 대신, 저장된 주차별 다이제스트만 붙입니다.
+            prior_digests = []
+            if data.get('incremental') and subject_id:
+                prior_digests = load_digests(user_id, subject_id, week_info)
+                if prior_digests:
+                    request_contents[0] += f"- 이전 주차 다이제스트: {len(prior_digests)}개 (이번 주차 내용과 연결하여 설명하세요)\n"
+                    request_contents.append(format_digests(prior_digests))
+                print(f"INFO: 증분 모드 - 이전 주차 다이제스트 {len(prior_digests)}개 사용 (subjectId={subject_id})")
+
             text_materials = []
-            import google.ai.generativelanguage as glm
 
+            # 파일은 하나씩 임시 버퍼로 받아 파트로 만든 뒤 원본 바이트를 바로 버립니다.
+            memory = MemoryCeiling()
             for url in blob_urls:
+                download_timeout = deadline.timeout("download", DOWNLOAD_TIMEOUT)
                 try:
-                    response = requests.get(url, stream=True)
-                    response.raise_for_status()
-                    file_content = response.content
-                    content_type = response.headers.get('content-type', 'application/octet-stream')
-
-                    if 'image/' in content_type:
-                        request_contents.append(Image.open(io.BytesIO(file_content)))
-                    elif 'application/pdf' in content_type:
-                        request_contents.append(glm.Part(inline_data=glm.Blob(mime_type='application/pdf', data=file_content)))
+                    spool, content_type, _ = download_material(url, download_timeout)
+                    with spool:
+                        kind, parts = decode_material(spool, content_type, memory, label=unquote(os.path.basename(urlparse(url).path)))
+                    if kind == "text":
+                        text_materials.extend(parts)
                     else:
-                        text_materials.append(file_content.decode('utf-8', errors='ignore'))
+                        request_contents.extend(parts)
+                except MaterialsTooLarge:
+                    raise
                 except Exception as e:
                     print(f"WARN: Blob URL에서 파일 다운로드 또는 처리 실패 ('{url}'): {e}")
+            print(f"INFO: 자료 메모리 사용 추정 {memory.held / 1e6:.1f}MB (최고 {memory.peak / 1e6:.1f}MB / 상한 {memory.ceiling / 1e6:.0f}MB)")
 
             if text_materials:
                 request_contents.append("\n--- 학습 자료 (텍스트) ---" + "\n\n".join(text_materials))
 
-            for i, api_key in enumerate(valid_keys):
-                try:
-                    print(f"INFO: API 키 #{i + 1} (으)로 참고서 생성 시도...")
-                    genai.configure(api_key=api_key)
-                    model = genai.GenerativeModel('gemini-2.5-pro')
-
-                    response = model.generate_content(request_contents)
-
-                    generated_data = extract_first_json(response.text)
-
-                    json_response = {
-                        "title": generated_data.get("title", f"{subject_name} - {week_info} 복습노트"),
-                        "content": generated_data.get("content", ""), # Changed from summary to content
-                        "key_insights": generated_data.get("key_insights", []),
-                        "quiz": generated_data.get("quiz", {}),
-                        "subjectId": data.get("subjectId"), # This will still be null
-                        "subjectName": generated_data.get("subjectName", subject_name) # Add subjectName from Gemini
-                    }
-
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json; charset=utf-8')
-                    self.end_headers()
-                    self.wfile.write(json.dumps(json_response, ensure_ascii=False).encode('utf-8'))
-                    return
-
-                except Exception as e:
-                    last_error = e
-                    print(f"WARN: API 키 #{i + 1} 사용 실패. 다음 키로 폴백합니다. 오류: {e}")
-                    continue
+            request_contents, dedup_report = dedup_materials(request_contents)
+            print(format_dedup_report(dedup_report))
+
+            routing = choose_model('create_review_note', describe_materials(request_contents, REVIEW_NOTE_PROMPT.tokens))
+            model_name = routing["model"]
+            ticket.charge_model(model_name)
+            request_contents, budget_report = govern_request(request_contents, model_name, instruction_tokens=REVIEW_NOTE_PROMPT.tokens)
+            print(f"INFO: 입력 토큰 추정치 {budget_report['after']['total']} / 예산 {budget_report['budget']} (축소 조치 {len(budget_report['actions'])}건)")
+
+            def build_note(generated_data):
+                return {
+                    "title": generated_data.get("title", f"{subject_name} - {week_info} 복습노트"),
+                    "content": generated_data.get("content", ""), # Changed from summary to content
+                    "key_insights": generated_data.get("key_insights", []),
+                    "quiz": generated_data.get("quiz", {}),
+                    "subjectId": subject_id,
+                    "subjectName": generated_data.get("subjectName", subject_name), # Add subjectName from Gemini
+                    "meta": {"tokenBudget": budget_report, "prompt": REVIEW_NOTE_PROMPT.describe(), "routing": routing, "dedup": dedup_report,
+                             "splitSections": bool(data.get('splitSections')),
+                             "incremental": {"digests": [d.get("week") for d in prior_digests],
+                                             "tokens": sum(d.get("tokens", 0) for d in prior_digests)}}
+                }
+
+            if data.get('splitSections'):
+                generate_note = lambda: generate_sections(valid_keys, model_name, request_contents, deadline)
+            else:
+                generate_note = lambda: generate_json(valid_keys, model_name, REVIEW_NOTE_PROMPT, request_contents, deadline=deadline)
 
-            raise ConnectionError("모든 Gemini API 키로 요청에 실패했습니다.") from last_error
+            # 번호가 없는 주차(시험 대비 등)는 다른 주차를 덮어쓰지 않도록 다이제스트를 저장하지 않습니다.
+            if subject_id and week_number(week_info) is not None:
+                generate_note_only = generate_note
 
+                def generate_note():
+                    generated_data = generate_note_only()
+                    try:
+                        save_digest(user_id, subject_id, week_info, build_digest(generated_data, week_info))
+                    except Exception as e:
+                        print(f"WARN: 주차 다이제스트 저장 실패 (subjectId={subject_id}, week={week_info}): {e}")
+                    return generated_data
+
+            if data.get('twoPhase'):
+                self.stream_two_phase(valid_keys, request_contents, generate_note, build_note, deadline)
+                return
+
+            send_json(self, 200, build_note(generate_note()))
+
+        except AdmissionRejected as e:
+            send_rejection(self, e)
+        except DeadlineExceeded as e:
+            self.handle_error(e, "요청 시간 한도를 초과했습니다.", 504)
+        except TokenBudgetExceeded as e:
+            self.handle_error(e, "입력 자료가 모델 한도를 초과합니다.", 413)
+        except MaterialsTooLarge as e:
+            self.handle_error(e, "입력 자료가 처리 가능한 메모리 한도를 초과합니다.", 413)
         except Exception as e:
             self.handle_error(e, "참고서 생성 중 오류 발생")
         finally:
+            if ticket:
+                ticket.release()
             # Clean up Vercel Blobs
             blob_read_write_token = os.environ.get('BLOB_READ_WRITE_TOKEN')
             if blob_read_write_token:
                 for url in blob_urls_to_delete:
                     try:
-                        delete_response = requests.delete(url, headers={'Authorization': f'Bearer {blob_read_write_token}'})
+                        delete_response = transport.http('blob', 'DELETE', url, headers={'Authorization': f'Bearer {blob_read_write_token}'}, timeout=10)
                         delete_response.raise_for_status()
                         print(f"INFO: Blob 삭제 완료: {url}")
                     except Exception as delete_error:
@@ -239,6 +403,53 @@ class handler(BaseHTTPRequestHandler):
             else:
                 print("WARN: BLOB_READ_WRITE_TOKEN이 설정되지 않아 Blob을 삭제할 수 없습니다.")
 
+    def stream_two_phase(self, valid_keys, request_contents, generate_note, build_note, deadline):
+        """Streams a quick Flash draft first, then the full note as an upgrade event.
+
+        Both calls start at once on the same materials; the client receives
+        `draft` (title, outline content, key_insights) as soon as Flash answers
+        and `final` (the regular response body) when the full note is ready.
+        """
+        stream = start_event_stream(self)
+        writer = SSEWriter(stream, lambda text: {"type": "token", "content": text})
+        executor = ThreadPoolExecutor(max_workers=2)
+        final_future = executor.submit(generate_note)
+        draft_future = executor.submit(generate_json, valid_keys, FLASH_MODEL, REVIEW_NOTE_DRAFT_PROMPT,
+                                       request_contents, 'create_review_note_draft', deadline)
+        draft_sent = False
+        try:
+            try:
+                draft = draft_future.result(timeout=deadline.remaining())
+                writer.send_event({"type": "draft", "data": {
+                    "title": draft.get("title", ""),
+                    "content": draft.get("content", ""),
+                    "key_insights": draft.get("key_insights", []),
+                }})
+                draft_sent = True
+            except ClientDisconnected:
+                raise
+            except Exception as e:
+                # 초안이 실패해도 최종 노트는 계속 기다립니다.
+                print(f"WARN: 초안 생성 실패: {e}")
+                writer.send_event({"type": "draft_error", "details": str(e)})
+
+            try:
+                writer.send_event({"type": "final", "data": build_note(final_future.result(timeout=deadline.remaining()))})
+            except ClientDisconnected:
+                raise
+            except (DeadlineExceeded, FutureTimeoutError) as e:
+                # 플랫폼이 함수를 끊기 전에 끝냅니다. 초안을 보냈다면 그것이 부분 결과가 됩니다.
+                print(f"WARN: 최종 복습노트가 시간 한도 내에 완성되지 않았습니다: {e}")
+                writer.send_event({"type": "timeout", "error": "요청 시간 한도를 초과했습니다.", "partial": draft_sent})
+            except Exception as e:
+                print(f"ERROR: 최종 복습노트 생성 실패: {e}")
+                writer.send_event({"type": "error", "error": "복습노트 생성 중 오류 발생", "details": str(e)})
+        except ClientDisconnected as e:
+            print(f"WARN: 클라이언트 연결 종료로 2단계 스트림을 중단합니다: {e}")
+        finally:
+            writer.close()
+            executor.shutdown(wait=False)
+
     def handle_error(self, e, message="오류 발생", status_code=500):
         print(f"ERROR: {message} - {e}")
         traceback.print_exc()
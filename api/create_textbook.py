@@ -2,12 +2,110 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 import google.generativeai as genai
-import tempfile
-import shutil
-from PIL import Image
 import traceback
-import requests
-import io
+import sys
+import time
+from urllib.parse import unquote, urlparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from _lib.admission import AdmissionRejected, admission_key, admit, send_rejection
+from _lib.breaker import is_available, record_outcome
+from _lib.budget import TokenBudgetExceeded, govern_request
+from _lib.deadline import DOWNLOAD_TIMEOUT, Deadline, DeadlineExceeded
+from _lib.dedup import dedup_materials, format_dedup_report
+from _lib.compression import send_json
+from _lib.materials import MaterialsTooLarge, MemoryCeiling, decode_material, download_material
+from _lib.profiling import start_profile
+from _lib.metrics import flushes_metrics, record_llm_call, usage_from_gemini
+from _lib.prompts import build_model, register_prompt
+from _lib.routing import choose_model, describe_materials
+from _lib import transport
+from _lib.transport import gemini_last_resort
+
+# ==============================================================================
+# PROMPTS
+# ==============================================================================
+TEXTBOOK_PROMPT = register_prompt("create_textbook", "v1", """
+당신은 인지과학과 교육심리학 전문가입니다. 첨부된 강의 자료를 분석하여, 학생이 스스로 깊이 있게 학습할 수 있는 최고의 참고서를 제작해야 합니다.
+
+# 🎨 출력 서식 규칙 (★★★★★ 가장 중요)
+당신이 생성하는 모든 텍스트는 아래 규칙을 **반드시** 따라야 합니다.
+
+1.  **수학 수식 (LaTeX):** 모든 수학 기호, 변수, 방정식은 **반드시** KaTeX 문법으로 감싸야 합니다.
+    -   인라인 수식: $로 감쌉니다. 예: $q''_x = -k \\frac{dT}{dx}$
+    -   블록 수식: $$로 감쌉니다. 예: $$ T(x) = T_s + \\frac{q'''}{2k}(Lx - x^2) $$
+    -   수식 내부에 일반 텍스트(한글 등)를 넣어야 할 경우, 반드시 `\\text{}` 명령어로 감싸야 합니다. (예: $(P_\\text{목표} - P_\\text{시작})$)
+
+2.  **코드 (Code Block):** 모든 소스 코드는 **반드시** 언어를 명시한 코드 블록으로 작성해야 합니다.
+    -   예시: ```python\nprint("Hello")\n```
+
+3.  **핵심 용어 (Tooltip):** 중요한 전공 용어는 **반드시** `<dfn title="용어에 대한 간단한 설명">핵심 용어</dfn>` HTML 태그로 감싸 설명을 제공해야 합니다.
+    -   예시: `<dfn title="매질 없이 열이 직접 전달되는 현상">복사</dfn>`
+
+4.  **이미지 (Image):**
+-   본문에 이미지를 포함해야 할 경우, 내가 제공하는 공개 URL을 사용해야 합니다. 각 이미지는 `--- 다음은 이미지 #N에 대한 컨텍스트입니다. 이 이미지의 공개 URL은 [URL] 입니다. ---` 형식으로 제공됩니다.
+-   이미지를 삽입할 때는 반드시 `<img src="[제공된 URL]" alt="이미지에 대한 상세한 설명"/>` HTML 태그를 사용하세요. `alt` 속성에는 이미지를 보지 않고도 내용을 이해할 수 있을 만큼 구체적인 설명을 포함해야 합니다.
+-   **절대로 `imgur.com` 등 외부 이미지 링크를 생성하거나 사용하지 마세요.** 제공된 URL만 사용해야 합니다.
+-   예시: `<img src="https://.../image.png" alt="뉴런의 구조를 보여주는 다이어그램. 세포체, 축삭, 수상돌기가 표시되어 있음."/>`
+
+# 🖼️ 절대 규칙: 모든 시각 자료는 반드시 지정된 언어의 코드 블록 안에 포함하여 출력해야 합니다. 이 규칙은 선택이 아닌 필수입니다. 코드 블록 바깥에 순수한 JSON이나 다이어그램 코드를 절대로 출력해서는 안 됩니다. 이 규칙을 위반한 출력은 실패한 것으로 간주됩니다.
+
+ Mermaid (mermaid): 순서도, 타임라인 등을 시각화할 때 사용합니다.
+- **따옴표 규칙:** 노드 이름, 링크 텍스트, subgraph 제목에 줄바꿈, 공백, 또는 특수문자 `( ) ,`가 포함될 경우, 반드시 전체 내용을 큰따옴표(`"`)로 감싸야 합니다.
+- **줄바꿈:** 노드 안에서 줄을 바꾸려면 `<br>` 태그 대신, 반드시 전체 텍스트를 큰따옴표(`"`)로 감싸고 실제 엔터 키로 줄을 나눠야 합니다.
+- **수식 사용 금지:** Mermaid 노드 안에서는 LaTeX 수식을 렌더링할 수 없으니, `ΔP`와 같은 간단한 텍스트나 유니코드 기호만 사용하세요.
+
+- **올바른 예시:**
+A["첫 번째 줄
+두 번째 줄"]
+B["노드 이름 (특수문자)"]
+C -- "링크 텍스트" --> D
+subgraph "서브그래프 제목"
+
+-       **잘못된 예시:**
+A[첫 번째 줄<br>두 번째 줄]
+B[노드 이름 (특수문자)]
+C -- 링크 텍스트 --> D
+subgraph "서브그래프 제목"
+
+자유 시각화 (visual): 복잡한 개념, 비교, 구조 등을 설명해야 할 때, 아래 규칙에 따라 가상의 UI 컴포넌트 구조를 JSON으로 설계하여 시각화할 수 있습니다. **이 JSON 데이터는 반드시 `visual` 언어 타입의 코드 블록으로 감싸야 합니다.**
+
+- **올바른 예시:**
+```visual
+{
+  "type": "box",
+  "children": [ { "type": "text", "props": { "content": "예시" } } ]
+}
+```
+
+### visual JSON 생성 규칙 (★★★★★ 반드시 준수)
+1.  **텍스트 내용**: 텍스트를 표시할 때는 반드시 `props` 객체 안에 `content` 속성을 사용해야 합니다.
+    -   **올바른 예시:** `{ "type": "text", "props": { "content": "내용" } }`
+    -   **잘못된 예시:** `{ "type": "text", "props": { "children": "내용" } }`
+2.  **요소 중첩**: 다른 요소를 자식으로 포함할 때는 반드시 최상위 레벨의 `children` 배열을 사용해야 합니다.
+    -   **올바른 예시:** `{ "type": "box", "children": [ { "type": "text", ... } ] }`
+    -   **잘못된 예시:** `{ "type": "box", "props": { "children": [ ... ] } }`
+3.  **스타일링**: 스타일은 `className`을 사용하지 말고, 반드시 CSS 속성을 직접 포함하는 인라인 `style` 객체를 사용해야 합니다.
+    -   **올바른 예시:** `{ "props": { "style": { "color": "blue", "fontSize": "16px" } } }`
+    -   **잘못된 예시:** `{ "props": { "className": "text-blue-500 text-base" } }`
+
+4.  **개념 분리**: 서로 다른 여러 개념을 나란히 비교하거나 나열할 때, 하나의 거대한 `visual` 블록으로 합치지 마세요. 각 개념에 대해 **별개의 `visual` 코드 블록을 생성**하여 명확하게 구분해야 합니다. (예: '전도, 대류, 복사'를 설명한다면, 각각에 대한 `visual` 블록을 총 3개 만들어야 합니다.)
+
+# 📚 결과물 구조 (Gagne의 9단계 + 백워드 설계)
+1단계: **주의집중 & 학습목표** (핵심 질문, 구체적 목표, 이전 학습과의 연결고리)
+2단계: **선행지식 활성화** (사전 점검 퀴즈, 관련 개념 요약)
+3단계: **핵심 내용 구조화** (각 개념별 정의, 시각화(Mermaid), 구체적 예시, 주의사항 제시)
+4단계: **단계별 예제** (유형별 모범 풀이와 사고과정 설명, 변형 문제 제시, 자료에 제시된 문제 빠짐없이 제시.)
+5단계: **능동 연습 설계** (기초/응용/교차 연습 문제 및 자가 채점 해설)
+6단계: **요약 및 연결** (핵심 요약, 암기용 개념 카드, 다음 학습 예고)
+7단계: **복습 스케줄링** (1일/3일/1주 후 복습 계획 제안)
+
+# ✅ 최종 품질 체크리스트
+- 위의 '출력 서식 규칙'이 모두 완벽하게 적용되었는가?
+- 자기주도 학습이 가능한 친절하고 상세한 설명인가?
+
+결과물은 다른 설명 없이, 위 규칙들을 모두 준수한 참고서 본문(마크다운)만 생성해야 합니다.
+""")
 
 class handler(BaseHTTPRequestHandler):
     def handle_error(self, e, message="오류 발생", status_code=500):
@@ -23,7 +121,9 @@ class handler(BaseHTTPRequestHandler):
             except Exception as write_error:
                 print(f"FATAL: 오류 응답 전송 중 추가 오류 발생: {write_error}")
 
+    @flushes_metrics
     def do_POST(self):
+        deadline = Deadline('create_textbook')
         api_keys = [
             os.environ.get('GEMINI_API_KEY_PRIMARY'),
             os.environ.get('GEMINI_API_KEY_SECONDARY'),
@@ -37,6 +137,10 @@ class handler(BaseHTTPRequestHandler):
 
         last_error = None
         blob_urls_to_delete = [] # To store URLs for cleanup
+        ticket = None
+        # 프로파일러는 finally에서 반드시 멈춰야 하므로 try 직전에 시작합니다.
+        profile = start_profile('create_textbook', self)
+        outcome = "error"
 
         try:
             content_length = int(self.headers['Content-Length'])
@@ -46,7 +150,9 @@ class handler(BaseHTTPRequestHandler):
             blob_urls = data.get('blobUrls', [])
             if not blob_urls or not isinstance(blob_urls, list):
                 return self.handle_error(ValueError("유효하지 않은 blobUrls 입니다."), status_code=400)
-            
+
+            # 거부된 요청은 Blob을 지우지 않아야 클라이언트가 Retry-After 뒤에 그대로 재시도할 수 있습니다.
+            ticket = admit('create_textbook', admission_key(self), deadline)
             blob_urls_to_delete.extend(blob_urls) # Add to cleanup list
 
             subject_name = data.get('subject', '[과목명]')
@@ -54,157 +160,126 @@ class handler(BaseHTTPRequestHandler):
             week_info = data.get('week', '[N주차/18주차]')
             material_types = data.get('materialTypes', '[PPT/PDF/텍스트 등]')
 
-            prompt = f"""
-            당신은 인지과학과 교육심리학 전문가입니다. 첨부된 강의 자료를 분석하여, 학생이 스스로 깊이 있게 학습할 수 있는 최고의 참고서를 제작해야 합니다.
-
-            # 📖 교과서 정보
-            - 과목: {subject_name}
-            - 주차: {week_info}
-            - 자료 형태: {material_types}
-
-            # 🎨 출력 서식 규칙 (★★★★★ 가장 중요)
-            당신이 생성하는 모든 텍스트는 아래 규칙을 **반드시** 따라야 합니다.
-
-            1.  **수학 수식 (LaTeX):** 모든 수학 기호, 변수, 방정식은 **반드시** KaTeX 문법으로 감싸야 합니다.
-                -   인라인 수식: $로 감쌉니다. 예: $q''_x = -k \frac{{dT}}{{dx}}$
-                -   블록 수식: $$로 감쌉니다. 예: $$ T(x) = T_s + \frac{{q'''}}{{2k}}(Lx - x^2) $$
-                -   수식 내부에 일반 텍스트(한글 등)를 넣어야 할 경우, 반드시 `\\text{{}}` 명령어로 감싸야 합니다. (예: $(P_\\text{{목표}} - P_\\text{{시작}})$)
-
-            2.  **코드 (Code Block):** 모든 소스 코드는 **반드시** 언어를 명시한 코드 블록으로 작성해야 합니다.
-                -   예시: ```python\nprint("Hello")\n```
-
-            3.  **핵심 용어 (Tooltip):** 중요한 전공 용어는 **반드시** `<dfn title="용어에 대한 간단한 설명">핵심 용어</dfn>` HTML 태그로 감싸 설명을 제공해야 합니다.
-                -   예시: `<dfn title="매질 없이 열이 직접 전달되는 현상">복사</dfn>`
-
-            4.  **이미지 (Image):**
-            -   본문에 이미지를 포함해야 할 경우, 내가 제공하는 공개 URL을 사용해야 합니다. 각 이미지는 `--- 다음은 이미지 #N에 대한 컨텍스트입니다. 이 이미지의 공개 URL은 [URL] 입니다. ---` 형식으로 제공됩니다.
-            -   이미지를 삽입할 때는 반드시 `<img src="[제공된 URL]" alt="이미지에 대한 상세한 설명"/>` HTML 태그를 사용하세요. `alt` 속성에는 이미지를 보지 않고도 내용을 이해할 수 있을 만큼 구체적인 설명을 포함해야 합니다.
-            -   **절대로 `imgur.com` 등 외부 이미지 링크를 생성하거나 사용하지 마세요.** 제공된 URL만 사용해야 합니다.
-            -   예시: `<img src="https://.../image.png" alt="뉴런의 구조를 보여주는 다이어그램. 세포체, 축삭, 수상돌기가 표시되어 있음."/>`
-
-            # 🖼️ 절대 규칙: 모든 시각 자료는 반드시 지정된 언어의 코드 블록 안에 포함하여 출력해야 합니다. 이 규칙은 선택이 아닌 필수입니다. 코드 블록 바깥에 순수한 JSON이나 다이어그램 코드를 절대로 출력해서는 안 됩니다. 이 규칙을 위반한 출력은 실패한 것으로 간주됩니다.
-
-             Mermaid (mermaid): 순서도, 타임라인 등을 시각화할 때 사용합니다.
-        - **따옴표 규칙:** 노드 이름, 링크 텍스트, subgraph 제목에 줄바꿈, 공백, 또는 특수문자 `( ) ,`가 포함될 경우, 반드시 전체 내용을 큰따옴표(`"`)로 감싸야 합니다.
-        - **줄바꿈:** 노드 안에서 줄을 바꾸려면 `<br>` 태그 대신, 반드시 전체 텍스트를 큰따옴표(`"`)로 감싸고 실제 엔터 키로 줄을 나눠야 합니다.
-        - **수식 사용 금지:** Mermaid 노드 안에서는 LaTeX 수식을 렌더링할 수 없으니, `ΔP`와 같은 간단한 텍스트나 유니코드 기호만 사용하세요.
-
-        - **올바른 예시:**
-         A["첫 번째 줄
-        두 번째 줄"]
-        B["노드 이름 (특수문자)"]
-        C -- "링크 텍스트" --> D
-        subgraph "서브그래프 제목"
-        
--       **잘못된 예시:**
-        A[첫 번째 줄<br>두 번째 줄]
-        B[노드 이름 (특수문자)]
-        C -- 링크 텍스트 --> D
-        subgraph "서브그래프 제목"  
-        
-            자유 시각화 (visual): 복잡한 개념, 비교, 구조 등을 설명해야 할 때, 아래 규칙에 따라 가상의 UI 컴포넌트 구조를 JSON으로 설계하여 시각화할 수 있습니다. **이 JSON 데이터는 반드시 `visual` 언어 타입의 코드 블록으로 감싸야 합니다.**
-
-            - **올바른 예시:**
-            ```visual
-            {{
-              "type": "box",
-              "children": [ {{ "type": "text", "props": {{ "content": "예시" }} }} ]
-            }}
-            ```
-
-            ### visual JSON 생성 규칙 (★★★★★ 반드시 준수)
-            1.  **텍스트 내용**: 텍스트를 표시할 때는 반드시 `props` 객체 안에 `content` 속성을 사용해야 합니다.
-                -   **올바른 예시:** `{{ "type": "text", "props": {{ "content": "내용" }} }}`
-                -   **잘못된 예시:** `{{ "type": "text", "props": {{ "children": "내용" }} }}`
-            2.  **요소 중첩**: 다른 요소를 자식으로 포함할 때는 반드시 최상위 레벨의 `children` 배열을 사용해야 합니다.
-                -   **올바른 예시:** `{{ "type": "box", "children": [ {{ "type": "text", ... }} ] }}`
-                -   **잘못된 예시:** `{{ "type": "box", "props": {{ "children": [ ... ] }} }}`
-            3.  **스타일링**: 스타일은 `className`을 사용하지 말고, 반드시 CSS 속성을 직접 포함하는 인라인 `style` 객체를 사용해야 합니다.
-                -   **올바른 예시:** `{{ "props": {{ "style": {{ "color": "blue", "fontSize": "16px" }} }} }}`
-                -   **잘못된 예시:** `{{ "props": {{ "className": "text-blue-500 text-base" }} }}`
-
-            4.  **개념 분리**: 서로 다른 여러 개념을 나란히 비교하거나 나열할 때, 하나의 거대한 `visual` 블록으로 합치지 마세요. 각 개념에 대해 **별개의 `visual` 코드 블록을 생성**하여 명확하게 구분해야 합니다. (예: '전도, 대류, 복사'를 설명한다면, 각각에 대한 `visual` 블록을 총 3개 만들어야 합니다.)
-
-
-            # 📚 결과물 구조 (Gagne의 9단계 + 백워드 설계)
-            1단계: **주의집중 & 학습목표** (핵심 질문, 구체적 목표, 이전 학습과의 연결고리)
-            2단계: **선행지식 활성화** (사전 점검 퀴즈, 관련 개념 요약)
-            3단계: **핵심 내용 구조화** (각 개념별 정의, 시각화(Mermaid), 구체적 예시, 주의사항 제시)
-            4단계: **단계별 예제** (유형별 모범 풀이와 사고과정 설명, 변형 문제 제시, 자료에 제시된 문제 빠짐없이 제시.)
-            5단계: **능동 연습 설계** (기초/응용/교차 연습 문제 및 자가 채점 해설)
-            6단계: **요약 및 연결** (핵심 요약, 암기용 개념 카드, 다음 학습 예고)
-            7단계: **복습 스케줄링** (1일/3일/1주 후 복습 계획 제안)
-
-            # ✅ 최종 품질 체크리스트
-            - 위의 '출력 서식 규칙'이 모두 완벽하게 적용되었는가?
-            - 자기주도 학습이 가능한 친절하고 상세한 설명인가?
-
-            결과물은 다른 설명 없이, 위 규칙들을 모두 준수한 참고서 본문(마크다운)만 생성해야 합니다.
-            """
+            # 고정 지시문은 TEXTBOOK_PROMPT(system instruction)로 보내고, 요청별 정보만 본문에 붙입니다.
+            prompt = (
+                "# 📖 교과서 정보\n"
+                f"- 과목: {subject_name}\n"
+                f"- 주차: {week_info}\n"
+                f"- 자료 형태: {material_types}\n"
+            )
             
             request_contents = [prompt]
             text_materials = []
             image_counter = 1
-            import google.ai.generativelanguage as glm
 
+            # 파일은 하나씩 임시 버퍼로 받아 파트로 만든 뒤 원본 바이트를 바로 버립니다.
+            memory = MemoryCeiling()
             for url in blob_urls:
+                download_timeout = deadline.timeout("download", DOWNLOAD_TIMEOUT)
                 try:
-                    response = requests.get(url, stream=True)
-                    response.raise_for_status()
-                    file_content = response.content
-                    content_type = response.headers.get('content-type', 'application/octet-stream')
+                    spool, content_type, size = download_material(url, download_timeout)
+                    profile.mark("download", url=url, bytes=size)
+                    with spool:
+                        kind, parts = decode_material(spool, content_type, memory, label=unquote(os.path.basename(urlparse(url).path)))
 
-                    if 'image/' in content_type:
+                    if kind == "image":
                         request_contents.append(f"--- 다음은 이미지 #{image_counter}에 대한 컨텍스트입니다. 이 이미지의 공개 URL은 {url} 입니다. ---")
-                        request_contents.append(Image.open(io.BytesIO(file_content)))
+                        request_contents.extend(parts)
                         request_contents.append(f"--- 이미지 #{image_counter}의 끝 ---")
                         image_counter += 1
-                    elif 'application/pdf' in content_type:
-                        request_contents.append(glm.Part(inline_data=glm.Blob(mime_type='application/pdf', data=file_content)))
+                    elif kind == "pdf":
+                        request_contents.extend(parts)
                     else:
-                        text_materials.append(file_content.decode('utf-8', errors='ignore'))
+                        text_materials.extend(parts)
+                    profile.mark("decode", url=url, content_type=content_type)
+                except MaterialsTooLarge:
+                    raise
                 except Exception as e:
                     print(f"WARN: Blob URL에서 파일 다운로드 또는 처리 실패 ('{url}'): {e}")
+            print(f"INFO: 자료 메모리 사용 추정 {memory.held / 1e6:.1f}MB (최고 {memory.peak / 1e6:.1f}MB / 상한 {memory.ceiling / 1e6:.0f}MB)")
 
             if text_materials:
                 request_contents.append("\n--- 학습 자료 (텍스트) ---\n" + "\n\n".join(text_materials))
+
+            request_contents, dedup_report = dedup_materials(request_contents)
+            print(format_dedup_report(dedup_report))
+            profile.mark("dedup")
+
+            routing = choose_model('create_textbook', describe_materials(request_contents, TEXTBOOK_PROMPT.tokens))
+            model_name = routing["model"]
+            ticket.charge_model(model_name)
+            request_contents, budget_report = govern_request(request_contents, model_name, instruction_tokens=TEXTBOOK_PROMPT.tokens)
+            print(f"INFO: 입력 토큰 추정치 {budget_report['after']['total']} / 예산 {budget_report['budget']} (축소 조치 {len(budget_report['actions'])}건)")
+            profile.mark("request_build", model=model_name)
                 
             for i, api_key in enumerate(valid_keys):
+                if not is_available('gemini', i + 1):
+                    print(f"WARN: Gemini 키 #{i + 1}의 서킷 브레이커가 열려 있어 건너뜁니다.")
+                    continue
+                request_options = deadline.request_options("model")
+                started = time.monotonic()
                 try:
-                    print(f"INFO: API 키 #{i + 1} (으)로 참고서 생성 시도...")
+                    print(f"INFO: API 키 #{i + 1} (으)로 참고서 생성 시도 ({model_name})...")
                     genai.configure(api_key=api_key)
-                    model = genai.GenerativeModel('gemini-2.5-pro')
+                    model = build_model(model_name, TEXTBOOK_PROMPT, api_key)
                     
-                    response = model.generate_content(request_contents)
+                    response = model.generate_content(request_contents, request_options=request_options)
+                    record_outcome('gemini', i + 1, started)
+                    record_llm_call('create_textbook', model_name, i + 1, started, usage_from_gemini(response))
+                    profile.mark("model", key=i + 1)
                     
                     json_response = {
                         "title": f"{subject_name} - {week_info} 참고서",
                         "content": response.text,
-                        "subjectId": subject_id
+                        "subjectId": subject_id,
+                        "meta": {"tokenBudget": budget_report, "prompt": TEXTBOOK_PROMPT.describe(), "routing": routing, "dedup": dedup_report}
                     }
 
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json; charset=utf-8')
-                    self.end_headers()
-                    self.wfile.write(json.dumps(json_response, ensure_ascii=False).encode('utf-8'))
+                    outcome = "ok"
+                    send_json(self, 200, json_response, headers=profile.headers())
                     return
 
                 except Exception as e:
+                    deadline.check("model")  # 예산 끝에서 잘린 호출은 키 장애로 기록하지 않습니다.
                     last_error = e
+                    record_outcome('gemini', i + 1, started, e)
+                    record_llm_call('create_textbook', model_name, i + 1, started, error=e)
                     print(f"WARN: API 키 #{i + 1} 사용 실패. 다음 키로 폴백합니다. 오류: {e}")
                     continue
 
+            response = gemini_last_resort(model_name, request_contents, TEXTBOOK_PROMPT.text)
+            if response is not None:
+                outcome = "ok"
+                send_json(self, 200, {
+                    "title": f"{subject_name} - {week_info} 참고서",
+                    "content": response.text,
+                    "subjectId": subject_id,
+                    "meta": {"tokenBudget": budget_report, "prompt": TEXTBOOK_PROMPT.describe(), "routing": routing,
+                             "dedup": dedup_report, "replayed": True}
+                }, headers=profile.headers())
+                return
             raise ConnectionError("모든 Gemini API 키로 요청에 실패했습니다.") from last_error
 
+        except AdmissionRejected as e:
+            send_rejection(self, e)
+        except DeadlineExceeded as e:
+            self.handle_error(e, "요청 시간 한도를 초과했습니다.", 504)
+        except TokenBudgetExceeded as e:
+            self.handle_error(e, "입력 자료가 모델 한도를 초과합니다.", 413)
+        except MaterialsTooLarge as e:
+            self.handle_error(e, "입력 자료가 처리 가능한 메모리 한도를 초과합니다.", 413)
         except Exception as e:
             self.handle_error(e, "참고서 생성 중 오류 발생")
         finally:
+            if ticket:
+                ticket.release()
+            profile.finish(outcome)
             # Clean up Vercel Blobs
             blob_read_write_token = os.environ.get('BLOB_READ_WRITE_TOKEN')
             if blob_read_write_token:
                 for url in blob_urls_to_delete:
                     try:
-                        delete_response = requests.delete(url, headers={'Authorization': f'Bearer {blob_read_write_token}'})
+                        delete_response = transport.http('blob', 'DELETE', url, headers={'Authorization': f'Bearer {blob_read_write_token}'}, timeout=10)
                         delete_response.raise_for_status()
                         print(f"INFO: Blob 삭제 완료: {url}")
                     except Exception as delete_error:
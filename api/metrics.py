@@ -0,0 +1,40 @@
+from http.server import BaseHTTPRequestHandler
+import hmac
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from _lib.metrics import load_snapshots, render_prometheus
+
+# 이 엔드포인트는 METRICS_SINK에 저장된 스냅샷을 합산합니다.
+# - file (기본값): 같은 /tmp를 공유하는 프로세스만 보입니다. 로컬 `vercel dev`나 단일 서버 배포용입니다.
+# - supabase: 각 함수 인스턴스가 요청이 끝날 때마다 metrics_snapshots 테이블에 누적값을 올리므로,
+#   Vercel 배포에서는 이 설정이어야 모든 함수와 인스턴스의 값이 합산됩니다.
+class handler(BaseHTTPRequestHandler):
+    def _send_error_json(self, status_code, message):
+        self.send_response(status_code)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(json.dumps({"error": message}).encode('utf-8'))
+
+    def do_GET(self):
+        # METRICS_TOKEN이 없으면 엔드포인트를 열지 않습니다. 토큰은 상수 시간으로 비교합니다.
+        metrics_token = os.environ.get('METRICS_TOKEN')
+        if not metrics_token:
+            return self._send_error_json(404, "Not Found")
+        authorization = self.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {metrics_token}".encode('utf-8')):
+            return self._send_error_json(401, "Unauthorized")
+
+        snapshots = load_snapshots()
+        if 'format=json' in self.path:
+            body = json.dumps(snapshots, ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        else:
+            body = render_prometheus(snapshots).encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.end_headers()
+        self.wfile.write(body)
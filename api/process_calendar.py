@@ -1,16 +1,41 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import os
-import google.generativeai as genai
 from PIL import Image
 import io
 from pdf2image import convert_from_bytes, pdfinfo_from_bytes
 import traceback
+import hashlib
 import json
 import re # re 모듈 추가
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from _lib.breaker import is_available, record_outcome
+from _lib.deadline import Deadline, DeadlineExceeded
+from _lib.metrics import flush as flush_metrics, record_llm_call, usage_from_gemini
+from _lib.prompts import build_model
+from _lib.routing import choose_model, describe_materials
+from _lib.timetable import preprocess_timetable, result_cache
+from _lib import transport
 
 # Vercel은 이 Flask 앱을 자동으로 서버리스 함수로 변환합니다.
 app = Flask(__name__)
 
+
+@app.teardown_request
+def _flush_metrics(error=None):
+    # 스트리밍 응답(stream_with_context)은 스트림이 끝난 뒤에 호출됩니다.
+    flush_metrics()
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+BATCH_MAX_FILES = int(os.getenv("TIMETABLE_BATCH_MAX_FILES", "200"))
+BATCH_PREPROCESS_WORKERS = int(os.getenv("TIMETABLE_BATCH_PREPROCESS_WORKERS", str(os.cpu_count() or 2)))
+BATCH_MODEL_WORKERS_PER_KEY = int(os.getenv("TIMETABLE_BATCH_WORKERS_PER_KEY", "2"))  # 키 하나당 동시 호출 수
+
 # ==============================================================================
 # HELPER FUNCTIONS
 # ==============================================================================
@@ -37,13 +62,27 @@ def extract_first_json(text: str):
         raise ValueError(f"Failed to decode JSON: {e} - Response text was: '{text}'")
 
 # ==============================================================================
-# FLASK ROUTE
+# PROMPTS
 # ==============================================================================
+TIMETABLE_PROMPT = """이 시간표 이미지에서 과목 이름(subjectName), 시작 시간(startTime), 종료 시간(endTime), 요일(dayOfWeek)을 추출하여 JSON 배열 형식으로 만들어라.
 
-@app.route('/api/process_calendar', methods=['POST'])
-def process_calendar_handler():
-    print("--- FLASK SCHEDULE PROCESSING START ---")
-    # --- Gemini API 키 설정 ---
+추출 규칙:
+1. **시간 계산:** 시간표의 세로축은 시간을 나타내며, 각 행(row)은 30분의 간격을 의미한다. 과목이 차지하는 셀의 수직 길이를 바탕으로 시작 시간(startTime)과 종료 시간(endTime)을 정확히 계산해야 한다. 예를 들어, 과목이 2개의 행에 걸쳐 있다면 1시간짜리 수업이다.
+2. **중복 및 분리:** 한 요일의 같은 시간대에 여러 과목이 겹쳐 있거나 나란히 있는 경우, 각 과목을 반드시 별개의 JSON 객체로 분리하여 추출해야 한다.
+3. **출력 형식:**
+   - subjectName: 한글 과목명을 그대로 추출한다.
+   - startTime, endTime: 'HH:MM' 형식으로 추출한다.
+   - dayOfWeek: '월','화','수','목','금','토','일' 중 하나로 표기한다.
+4. **응답 형식:** 다른 설명 없이, 순수한 JSON 배열만을 응답으로 제공해야 한다.
+"""
+# 프롬프트가 바뀌면 이전 결과 캐시를 쓰지 않도록 캐시 키에 포함합니다.
+TIMETABLE_PROMPT_VERSION = hashlib.sha256(TIMETABLE_PROMPT.encode('utf-8')).hexdigest()[:12]
+
+# ==============================================================================
+# CORE LOGIC
+# ==============================================================================
+
+def get_valid_keys():
     api_keys = [
         os.environ.get('GEMINI_API_KEY_PRIMARY'),
         os.environ.get('GEMINI_API_KEY_SECONDARY'),
@@ -51,7 +90,114 @@ def process_calendar_handler():
         os.environ.get('GEMINI_API_KEY_QUATERNARY'),
         os.environ.get('GEMINI_API_KEY')
     ]
-    valid_keys = [key for key in api_keys if key]
+    return [key for key in api_keys if key]
+
+
+def load_timetable_image(file_data: bytes, file_type: str):
+    """Decodes an uploaded timetable, rasterizing the first page of a PDF."""
+    img = None
+    if file_type == 'application/pdf':
+        print("INFO: PDF file detected, attempting conversion.")
+        try:
+            pdfinfo_from_bytes(file_data)
+            images = convert_from_bytes(file_data, first_page=1, last_page=1)
+            if images:
+                img = images[0]
+                print("INFO: PDF successfully converted to image.")
+        except Exception as e:
+            if "Poppler" in str(e) or "PDFInfoNotInstalledError" in str(type(e)):
+                print("ERROR: Poppler not installed.")
+                raise ValueError("PDF 처리에 필요한 Poppler 라이브러리를 서버에 설치해야 합니다.")
+            else:
+                raise e
+    elif 'image' in file_type:
+        img = Image.open(io.BytesIO(file_data))
+        print("INFO: Image file processed.")
+
+    if img is None:
+        raise ValueError(f"지원하지 않는 파일 형식이거나 파일 처리 실패: {file_type}")
+    return img
+
+
+def prepare_timetable(file_data: bytes, file_type: str, preprocess: bool = True):
+    """Decodes and (optionally) crops one timetable. Returns (image, preprocess report or None).
+
+    Module-level and free of request state so batch mode can run it in a process pool.
+    """
+    img = load_timetable_image(file_data, file_type)
+    report = None
+    if preprocess:
+        try:
+            img, report = preprocess_timetable(img)
+            print(f"INFO: 시간표 전처리 {report}")
+        except Exception as e:
+            print(f"WARN: 시간표 전처리 실패, 원본 이미지를 사용합니다: {e}")
+    img.load()
+    return img, report
+
+
+def extract_timetable(img, valid_keys, deadline, first_key=0, endpoint='process_calendar'):
+    """Sends one timetable image to Gemini and returns the parsed events.
+
+    Keys are tried starting from first_key, so concurrent batch items spread
+    over the key pool instead of all hitting the primary key first.
+    """
+    last_error = None
+    routing = choose_model('process_calendar', describe_materials([TIMETABLE_PROMPT, img]))
+    model_name = routing["model"]
+    cache_namespace = f"{model_name}:{TIMETABLE_PROMPT_VERSION}"
+    cached = result_cache.get(img, cache_namespace)
+    if cached is not None:
+        return cached
+    for offset in range(len(valid_keys)):
+        index = (first_key + offset) % len(valid_keys)
+        if not is_available('gemini', index + 1):
+            print(f"WARN: Gemini 키 #{index + 1}의 서킷 브레이커가 열려 있어 건너뜁니다.")
+            continue
+        request_options = deadline.request_options("model", 180)
+        started = time.monotonic()
+        try:
+            print(f"INFO: API 키 #{index + 1} (으)로 시간표 처리 시도...")
+            # 배치 모드에서는 여러 스레드가 동시에 호출하므로 키별 클라이언트에 고정된 모델을 씁니다.
+            model = build_model(model_name, None, valid_keys[index])
+
+            response = model.generate_content([TIMETABLE_PROMPT, img], request_options=request_options)
+            record_outcome('gemini', index + 1, started)
+            record_llm_call(endpoint, model_name, index + 1, started, usage_from_gemini(response))
+
+            raw_text = response.text
+            print(f"INFO: Gemini Raw Response for Calendar: {raw_text[:300]}...")
+
+            json_response = extract_first_json(raw_text)
+            print("INFO: Successfully parsed Gemini response.")
+            result_cache.put(img, cache_namespace, json_response)
+            return json_response
+
+        except Exception as e:
+            last_error = e
+            record_outcome('gemini', index + 1, started, e)
+            record_llm_call(endpoint, model_name, index + 1, started, error=e)
+            print(f"WARN: API 키 #{index + 1} 사용 실패. 다음 키로 폴백합니다. 오류: {e}")
+            continue
+
+    # 모든 키가 실패한 경우
+    response = transport.gemini_last_resort(model_name, [TIMETABLE_PROMPT, img])
+    if response is not None:
+        return extract_first_json(response.text)
+    raise ConnectionError(str(last_error) if last_error else "Unknown error.") from last_error
+
+# ==============================================================================
+# FLASK ROUTE
+# ==============================================================================
+
+@app.route('/api/process_calendar', methods=['POST'])
+def process_calendar_handler():
+    if request.files.getlist('files'):
+        return process_calendar_batch_handler()
+    print("--- FLASK SCHEDULE PROCESSING START ---")
+    deadline = Deadline('process_calendar')
+    # --- Gemini API 키 설정 ---
+    valid_keys = get_valid_keys()
     if not valid_keys:
         print("ERROR: No Gemini API keys found.")
         return jsonify({"error": "설정된 Gemini API 키가 없습니다.", "details": "No Gemini API keys found in environment variables."}), 500
@@ -66,73 +212,121 @@ def process_calendar_handler():
     file_type = uploaded_file.mimetype
     print(f"INFO: Received file '{uploaded_file.filename}' with type '{file_type}'")
 
-    img = None
+    # --- 파일 디코딩 및 시간표 영역 검출/크롭 ---
     try:
-        if file_type == 'application/pdf':
-            print("INFO: PDF file detected, attempting conversion.")
-            try:
-                pdfinfo_from_bytes(file_data)
-                images = convert_from_bytes(file_data)
-                if images:
-                    img = images[0]
-                    print("INFO: PDF successfully converted to image.")
-            except Exception as e:
-                if "Poppler" in str(e) or "PDFInfoNotInstalledError" in str(type(e)):
-                    print("ERROR: Poppler not installed.")
-                    raise ValueError("PDF 처리에 필요한 Poppler 라이브러리를 서버에 설치해야 합니다.")
-                else:
-                    raise e
-        elif 'image' in file_type:
-            img = Image.open(io.BytesIO(file_data))
-            print("INFO: Image file processed.")
-        
-        if img is None:
-            raise ValueError(f"지원하지 않는 파일 형식이거나 파일 처리 실패: {file_type}")
-
+        img, _ = prepare_timetable(file_data, file_type, request.form.get('preprocess', '1') != '0')
     except Exception as e:
         print(f"ERROR: File processing failed. {e}")
         traceback.print_exc()
         return jsonify({"error": "파일 처리 중 오류가 발생했습니다.", "details": str(e)}), 500
 
-    # --- Gemini를 위한 프롬프트 ---
-    prompt = """이 시간표 이미지에서 과목 이름(subjectName), 시작 시간(startTime), 종료 시간(endTime), 요일(dayOfWeek)을 추출하여 JSON 배열 형식으로 만들어라.
-
-    추출 규칙:
-    1. **시간 계산:** 시간표의 세로축은 시간을 나타내며, 각 행(row)은 30분의 간격을 의미한다. 과목이 차지하는 셀의 수직 길이를 바탕으로 시작 시간(startTime)과 종료 시간(endTime)을 정확히 계산해야 한다. 예를 들어, 과목이 2개의 행에 걸쳐 있다면 1시간짜리 수업이다.
-    2. **중복 및 분리:** 한 요일의 같은 시간대에 여러 과목이 겹쳐 있거나 나란히 있는 경우, 각 과목을 반드시 별개의 JSON 객체로 분리하여 추출해야 한다.
-    3. **출력 형식:**
-       - subjectName: 한글 과목명을 그대로 추출한다.
-       - startTime, endTime: 'HH:MM' 형식으로 추출한다.
-       - dayOfWeek: '월','화','수','목','금','토','일' 중 하나로 표기한다.
-    4. **응답 형식:** 다른 설명 없이, 순수한 JSON 배열만을 응답으로 제공해야 한다.
+    # --- Gemini API 호출 ---
+    try:
+        return jsonify(extract_timetable(img, valid_keys, deadline))
+    except DeadlineExceeded as e:
+        print(f"ERROR: {e}")
+        return jsonify({"error": "요청 시간 한도를 초과했습니다.", "details": str(e)}), 504
+    except Exception as e:
+        print(f"ERROR: All API keys failed. Last error: {e}")
+        return jsonify({"error": "모든 Gemini API 키로 요청에 실패했습니다.", "details": str(e)}), 500
+
+
+@app.route('/api/process_calendar/batch', methods=['POST'])
+def process_calendar_batch_handler():
+    """Extracts many timetables in one call and streams one NDJSON line per file as it finishes.
+
+    Upload the files under the `files` form field. Decoding and cropping run in
+    a process pool; model calls run in BATCH_MODEL_WORKERS_PER_KEY threads per
+    API key. Each line is {"index", "filename", "status": "ok", "events"} or
+    {"index", "filename", "status": "error", "error"}; a final
+    {"type": "summary"} line closes the stream.
     """
+    print("--- FLASK BATCH SCHEDULE PROCESSING START ---")
+    deadline = Deadline('process_calendar')
+    valid_keys = get_valid_keys()
+    if not valid_keys:
+        return jsonify({"error": "설정된 Gemini API 키가 없습니다.", "details": "No Gemini API keys found in environment variables."}), 500
 
-    # --- Gemini API 호출 루프 ---
-    last_error = None
-    for i, api_key in enumerate(valid_keys):
-        try:
-            print(f"INFO: API 키 #{i + 1} (으)로 시간표 처리 시도...")
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(os.getenv("GENAI_MODEL", "gemini-2.5-flash")) # Use GENAI_MODEL env var, fallback to flash
-            
-            response = model.generate_content([prompt, img], request_options={'timeout': 180})
-            
-            raw_text = response.text
-            print(f"INFO: Gemini Raw Response for Calendar: {raw_text[:300]}...")
+    uploads = request.files.getlist('files')
+    if not uploads:
+        return jsonify({"error": "요청에 파일이 없습니다.", "details": "Upload files under the 'files' field."}), 400
+    if len(uploads) > BATCH_MAX_FILES:
+        return jsonify({"error": f"한 번에 최대 {BATCH_MAX_FILES}개의 파일만 처리할 수 있습니다."}), 413
+    # 스트리밍이 시작되면 요청 본문을 읽을 수 없으므로 미리 모두 읽어 둡니다.
+    files = [(upload.filename, upload.read(), upload.mimetype) for upload in uploads]
+    preprocess = request.form.get('preprocess', '1') != '0'
+    print(f"INFO: 시간표 {len(files)}개 일괄 처리 시작")
 
-            json_response = extract_first_json(raw_text)
-            print("INFO: Successfully parsed Gemini response.")
-            return jsonify(json_response)
+    return Response(stream_with_context(run_batch(files, valid_keys, deadline, preprocess)),
+                    mimetype='application/x-ndjson')
 
-        except Exception as e:
-            last_error = e
-            print(f"WARN: API 키 #{i + 1} 사용 실패. 다음 키로 폴백합니다. 오류: {e}")
-            continue
 
-    # 모든 키가 실패한 경우
-    final_error_details = str(last_error) if last_error else "Unknown error."
-    print(f"ERROR: All API keys failed. Last error: {final_error_details}")
-    return jsonify({"error": "모든 Gemini API 키로 요청에 실패했습니다.", "details": final_error_details}), 500
+def _preprocess_pool(workers):
+    # AWS Lambda 기반 런타임에는 /dev/shm이 없어 프로세스 풀을 만들 수 없으므로 스레드 풀로 대신합니다.
+    try:
+        return ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError) as e:
+        print(f"WARN: 프로세스 풀을 만들 수 없어 스레드 풀로 전처리합니다: {e}")
+        return ThreadPoolExecutor(max_workers=workers)
+
+
+def run_batch(files, valid_keys, deadline, preprocess=True):
+    """Yields NDJSON lines for each file as its preprocessing and extraction finish."""
+    started = time.monotonic()
+    preprocess_pool = _preprocess_pool(min(BATCH_PREPROCESS_WORKERS, len(files)))
+    model_pool = ThreadPoolExecutor(max_workers=min(len(valid_keys) * BATCH_MODEL_WORKERS_PER_KEY, len(files)))
+    stages = {}  # future -> ("prepare" | "extract", index)
+    succeeded = failed = 0
+
+    def line(payload):
+        return json.dumps(payload, ensure_ascii=False) + "\n"
+
+    try:
+        for index, (filename, file_data, file_type) in enumerate(files):
+            try:
+                future = preprocess_pool.submit(prepare_timetable, file_data, file_type, preprocess)
+            except Exception as e:
+                # 워커 프로세스를 띄울 수 없는 환경이면 남은 파일은 스레드 풀에서 전처리합니다.
+                print(f"WARN: 프로세스 풀 제출 실패, 스레드 풀로 전환합니다: {e}")
+                preprocess_pool.shutdown(wait=False, cancel_futures=True)
+                preprocess_pool = ThreadPoolExecutor(max_workers=min(BATCH_PREPROCESS_WORKERS, len(files)))
+                future = preprocess_pool.submit(prepare_timetable, file_data, file_type, preprocess)
+            stages[future] = ("prepare", index)
+
+        while stages:
+            done, _ = wait(list(stages), timeout=max(0.1, deadline.remaining()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                stage, index = stages.pop(future)
+                filename = files[index][0]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"WARN: 시간표 '{filename}' 처리 실패 ({stage}): {e}")
+                    yield line({"index": index, "filename": filename, "status": "error", "stage": stage, "error": str(e)})
+                    continue
+                if stage == "prepare":
+                    img, report = result
+                    # 파일마다 시작 키를 달리해 동시 호출이 키 풀 전체에 고르게 퍼지게 합니다.
+                    extract = model_pool.submit(extract_timetable, img, valid_keys, deadline,
+                                                index % len(valid_keys), 'process_calendar_batch')
+                    stages[extract] = ("extract", index)
+                    continue
+                succeeded += 1
+                yield line({"index": index, "filename": filename, "status": "ok", "events": result})
+
+        for future, (stage, index) in stages.items():
+            future.cancel()
+            failed += 1
+            yield line({"index": index, "filename": files[index][0], "status": "error", "stage": stage,
+                        "error": "요청 시간 한도를 초과하여 처리하지 못했습니다."})
+        yield line({"type": "summary", "total": len(files), "succeeded": succeeded, "failed": failed,
+                    "ms": round((time.monotonic() - started) * 1000)})
+    finally:
+        preprocess_pool.shutdown(wait=False, cancel_futures=True)
+        model_pool.shutdown(wait=False, cancel_futures=True)
 
 # Vercel의 엔트리포인트입니다.
 # 이 파일은 api/process_calendar.py이므로, 'app' 객체를 찾아서 실행합니다.
\ No newline at end of file
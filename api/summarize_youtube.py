@@ -1,8 +1,21 @@
-import json, os, time, re, traceback
+import json, os, time, re, traceback, hashlib, hmac, tempfile
 import requests
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import google.generativeai as genai
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlencode, urlparse, parse_qs
 from http.server import BaseHTTPRequestHandler
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from _lib.admission import admission_key
+from _lib.breaker import CircuitOpen, guard, is_available, record_outcome
+from _lib.compression import send_json, start_event_stream
+from _lib.deadline import Deadline, DeadlineExceeded
+from _lib.metrics import flushes_metrics, record_cache, record_llm_call, usage_from_gemini
+from _lib.prompts import build_model, register_prompt
+from _lib import transport
+from _lib.sse import ClientDisconnected, SSEWriter
+from _lib.transport import gemini_last_resort
 
 # ==============================================================================
 # CONFIGURATION
@@ -12,11 +25,32 @@ API_KEY = os.getenv("GEMINI_API_KEY_QUATERNARY")
 APIFY_ENDPOINT = os.getenv("APIFY_ENDPOINT")
 APIFY_TOKEN = os.getenv("APIFY_TOKEN")
 HTTP_TIMEOUT = 240 # Apify can take a while, give it up to 4 minutes
+APIFY_API_BASE = os.getenv("APIFY_API_BASE", "https://api.apify.com/v2").rstrip("/")
+APIFY_REQUEST_TIMEOUT = 30 # Per-request timeout for the run/poll/dataset calls
+APIFY_POLL_WAIT = 20 # Seconds Apify may hold a poll request open (waitForFinish, max 60)
+APIFY_POLL_BACKOFF = (1.0, 1.5, 10.0) # initial delay, multiplier, max delay between polls
+APIFY_TERMINAL_STATUSES = {"SUCCEEDED", "FAILED", "ABORTED", "TIMED-OUT"}
+# Signs async job ids so only the caller who started a run can poll it
+JOB_SIGNING_KEY = (os.getenv("JOB_SIGNING_SECRET") or APIFY_TOKEN or "").encode('utf-8')
+SUMMARY_RESERVE_SECONDS = 90 # Budget kept back from the transcript wait for the Gemini summary
+GEMINI_KEYS = [key for key in dict.fromkeys([
+    os.getenv("GEMINI_API_KEY_PRIMARY"),
+    os.getenv("GEMINI_API_KEY_SECONDARY"),
+    os.getenv("GEMINI_API_KEY_TERTIARY"),
+    API_KEY,
+]) if key] # Key pool for batch summaries; the single-video path keeps using API_KEY
+YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY") # Only needed to expand playlist URLs
+TRANSCRIPT_CACHE_DIR = os.getenv("TRANSCRIPT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "studious-transcripts"))
+TRANSCRIPT_CACHE_TTL = 30 * 24 * 3600 # Captions rarely change once published
+BATCH_MAX_VIDEOS = int(os.getenv("YOUTUBE_BATCH_MAX_VIDEOS", "50"))
+BATCH_TRANSCRIPT_WORKERS = int(os.getenv("YOUTUBE_BATCH_TRANSCRIPT_WORKERS", "4")) # Concurrent Apify runs
+BATCH_SUMMARY_WORKERS_PER_KEY = 2
+DIGEST_MAX_SUMMARY_CHARS = 1500 # Per video, when building the course digest
 
 # ==============================================================================
 # PROMPTS
 # ==============================================================================
-COMBINED_PROMPT = """당신은 영상 콘텐츠 요약 및 분류 전문가입니다.
+COMBINED_PROMPT = register_prompt("youtube_summary", "v1", """당신은 영상 콘텐츠 요약 및 분류 전문가입니다.
 사용자가 제공한 유튜브 영상의 전사 내용을 꼼꼼히 분석하여, 아래 규칙과 출력 형식에 따라 완벽한 JSON 객체를 생성해주세요.
 
 [요약 규칙]
@@ -37,7 +71,7 @@ COMBINED_PROMPT = """당신은 영상 콘텐츠 요약 및 분류 전문가입
 - 반드시 아래와 같은 키를 가진 단일 JSON 객체로만 응답해야 합니다.
 - **매우 중요:** `summary` 내용이 길어지더라도, 전체 JSON 구조가 깨지지 않고 완벽하게 끝나도록 작성해야 합니다.
 
-{{
+{
   "title": "AI가 생성한 영상 제목",
   "tag": "AI가 생성한 포괄적 주제 태그",
   "summary": "마크다운 서식이 적용된, 서술형 문단으로 구성된 상세하고 체계적인 핵심 요약문. (요점 목록 제외)",
@@ -46,13 +80,10 @@ COMBINED_PROMPT = """당신은 영상 콘텐츠 요약 및 분류 전문가입
     "영상이 강조하는 가장 중요한 통찰 또는 시사점 2",
     "그 외 주목할 만한 핵심 정보나 주장"
   ]
-}}
+}
+""")
 
-[Transcript]
-{text}
-"""
-
-LEARNING_NOTE_PROMPT = """당신은 특정 주제에 대한 깊이 있는 지식을 갖춘 **인지과학 및 교육심리학 전문가이자 1:1 튜터**입니다.
+LEARNING_NOTE_PROMPT = register_prompt("youtube_learning_note", "v1", """당신은 특정 주제에 대한 깊이 있는 지식을 갖춘 **인지과학 및 교육심리학 전문가이자 1:1 튜터**입니다.
 제공된 영상 스크립트를 단순 요약하는 것을 넘어, 당신의 방대한 지식을 활용하여 내용을 보충하고 재구성하여, 마치 **대학 강의 교재의 한 챕터를 집필하듯** 깊이 있는 학습 자료를 만들어야 합니다.
 스크립트에 없는 내용이라도 주제와 직접적으로 관련된 **핵심 개념, 배경 지식, 심화 이론을 서론이나 본론에 적극적으로 추가**하여 완성도를 높여주세요.
 
@@ -62,7 +93,7 @@ LEARNING_NOTE_PROMPT = """당신은 특정 주제에 대한 깊이 있는 지식
 1.  **수학 수식 (LaTeX):** 모든 수학 기호, 변수, 방정식은 **반드시** KaTeX 문법으로 감싸야 합니다.
     -   인라인 수식: $로 감쌉니다. (예: $q = mc\Delta T$)
     -   블록 수식: $$로 감쌉니다. (예: $$E=mc^2$$)
-    -   수식 내부에 일반 텍스트(한글 등)를 넣어야 할 경우, 반드시 `\text{{}}` 명령어로 감싸야 합니다. (예: $(P_\text{{목표}} - P_\text{{시작}})$)
+    -   수식 내부에 일반 텍스트(한글 등)를 넣어야 할 경우, 반드시 `\text{}` 명령어로 감싸야 합니다. (예: $(P_\text{목표} - P_\text{시작})$)
 
 2.  **핵심 용어 (Tooltip):** 중요한 전공 용어는 **반드시** `<dfn title="용어에 대한 간단한 설명">핵심 용어</dfn>` HTML 태그로 감싸 설명을 제공해야 합니다. 이 규칙을 사용하므로, 별도의 `key_terms` JSON 필드는 필요 없습니다.
 
@@ -78,7 +109,7 @@ LEARNING_NOTE_PROMPT = """당신은 특정 주제에 대한 깊이 있는 지식
 - 반드시 아래 JSON 형식과 키(key)에 맞춰 응답해야 합니다.
 - `key_terms` 필드는 더 이상 사용하지 않습니다.
 
-{{
+{
   "title": "AI가 생성한 깊이 있는 학습 노트 제목",
   "tag": "AI가 생성한 포괄적 주제 태그 (예: IT, 경제, 과학)",
   "summary": "서론, 본론, 결론의 구조를 가지며, 위의 모든 서식 규칙(LaTeX, dfn, Mermaid)이 완벽하게 적용된 상세 학습 노트 본문.",
@@ -91,11 +122,30 @@ LEARNING_NOTE_PROMPT = """당신은 특정 주제에 대한 깊이 있는 지식
     "이 강의와 관련하여 더 깊게 학습하면 좋을 주제 1",
     "다음 단계로 학습을 이어가기 위한 추천 주제 2"
   ]
-}}
+}
+""")
+
+COURSE_DIGEST_PROMPT = register_prompt("youtube_course_digest", "v1", """당신은 강의 시리즈를 하나의 과정으로 정리하는 교육 설계 전문가입니다.
+여러 강의 영상의 요약이 순서대로 주어집니다. 이를 바탕으로 과정 전체를 조망하는 다이제스트를 작성하세요.
 
-[Transcript]
-{text}
-"""
+[작성 규칙]
+- 각 영상의 요약을 반복하지 말고, 강의 간의 흐름과 개념의 연결을 중심으로 정리합니다.
+- `modules`는 주어진 영상 순서를 유지하되, 내용이 이어지는 영상은 하나의 모듈로 묶을 수 있습니다.
+- 중요한 키워드는 `**굵은 글씨**`로 강조합니다. 모든 특수 문자는 JSON 규칙에 따라 이스케이프합니다.
+
+[결과 출력 형식]
+반드시 아래 키를 가진 단일 JSON 객체로만 응답해야 합니다.
+
+{
+  "title": "과정 전체를 대표하는 제목",
+  "overview": "과정 전체의 목표와 흐름을 설명하는 마크다운 문단",
+  "modules": [
+    {"title": "모듈 제목", "videos": [1, 2], "summary": "모듈에서 다루는 내용과 앞뒤 모듈과의 연결"}
+  ],
+  "key_insights": ["과정 전체를 관통하는 핵심 통찰 1", "핵심 통찰 2"],
+  "review_questions": ["과정 전체를 복습하는 질문 1", "질문 2"]
+}
+""")
 
 # ==============================================================================
 # HELPER FUNCTIONS
@@ -128,27 +178,110 @@ def extract_first_json(text: str):
 # CORE LOGIC
 # ==============================================================================
 
-def get_transcript_from_apify(youtube_url: str) -> str:
-    """Calls the Apify Actor to get the transcript."""
-    print(f"--- DEBUGGING ---")
-    print(f"APIFY_ENDPOINT from env: {os.getenv('APIFY_ENDPOINT')}")
-    print(f"APIFY_TOKEN from env is set: {bool(os.getenv('APIFY_TOKEN'))}")
-    
-    if not APIFY_ENDPOINT or not APIFY_TOKEN:
-        raise ValueError("APIFY_ENDPOINT and APIFY_TOKEN must be set.")
-
-    api_url = f"{APIFY_ENDPOINT}?token={APIFY_TOKEN}"
-    payload = {'videoUrl': youtube_url}
-    headers = {"Content-Type": "application/json"}
-
-    print(f"Final API URL being called: {APIFY_ENDPOINT}?token=...REDACTED...")
-    print(f"Payload being sent: {payload}")
-    print(f"--- END DEBUGGING ---")
-
-    r = requests.post(api_url, json=payload, headers=headers, timeout=HTTP_TIMEOUT)
-    r.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
-
-    results = r.json()
+def _actor_id_from_endpoint(endpoint):
+    """Extracts the actor id from a .../acts/<actor>/run-sync... endpoint URL."""
+    match = re.search(r"/acts/([^/?]+)", endpoint or "")
+    return match.group(1) if match else None
+
+
+APIFY_ACTOR_ID = os.getenv("APIFY_ACTOR_ID") or _actor_id_from_endpoint(APIFY_ENDPOINT)
+
+
+def start_apify_run(youtube_url: str) -> dict:
+    """Starts the transcript actor asynchronously and returns the run object."""
+    if not APIFY_ACTOR_ID or not APIFY_TOKEN:
+        raise ValueError("APIFY_ACTOR_ID (or an actor APIFY_ENDPOINT) and APIFY_TOKEN must be set.")
+    with guard('apify'):
+        r = transport.http(
+            'apify', 'POST',
+            f"{APIFY_API_BASE}/acts/{APIFY_ACTOR_ID}/runs",
+            params={"token": APIFY_TOKEN},
+            json={'videoUrl': youtube_url},
+            timeout=APIFY_REQUEST_TIMEOUT,
+        )
+        r.raise_for_status()
+    run = r.json()["data"]
+    print(f"INFO: Apify run started: {run['id']} ({run.get('status')})")
+    return run
+
+
+def get_apify_run(run_id: str, wait: int = 0) -> dict:
+    """Fetches a run, letting Apify hold the request open up to `wait` seconds."""
+    with guard('apify'):
+        r = transport.http(
+            'apify', 'GET',
+            f"{APIFY_API_BASE}/actor-runs/{run_id}",
+            params={"token": APIFY_TOKEN, "waitForFinish": max(0, min(int(wait), 60))},
+            timeout=APIFY_REQUEST_TIMEOUT + wait,
+        )
+        r.raise_for_status()
+    return r.json()["data"]
+
+
+def fetch_apify_dataset(dataset_id: str) -> list:
+    with guard('apify'):
+        r = transport.http(
+            'apify', 'GET',
+            f"{APIFY_API_BASE}/datasets/{dataset_id}/items",
+            params={"token": APIFY_TOKEN, "format": "json", "clean": "true"},
+            timeout=APIFY_REQUEST_TIMEOUT,
+        )
+        r.raise_for_status()
+    return r.json()
+
+
+def fetch_apify_run_input(run: dict) -> dict:
+    """The input a run was started with, read from its default key-value store."""
+    with guard('apify'):
+        r = transport.http(
+            'apify', 'GET',
+            f"{APIFY_API_BASE}/key-value-stores/{run['defaultKeyValueStoreId']}/records/INPUT",
+            params={"token": APIFY_TOKEN},
+            timeout=APIFY_REQUEST_TIMEOUT,
+        )
+        r.raise_for_status()
+    return r.json()
+
+
+def sign_job(run_id: str, owner: str) -> str:
+    """Job reference for an async run, bound to the admission key of the caller who started it."""
+    mac = hmac.new(JOB_SIGNING_KEY, f"{run_id}:{owner}".encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+    return f"{run_id}.{mac}"
+
+
+def verify_job(job_id: str, owner: str):
+    """Run id of a job reference issued to owner, or None for a foreign or forged one."""
+    run_id, _, mac = (job_id or "").partition(".")
+    if not run_id or not mac or not JOB_SIGNING_KEY:
+        return None
+    return run_id if hmac.compare_digest(sign_job(run_id, owner), job_id) else None
+
+
+def transcript_from_run(run: dict) -> str:
+    """Turns a finished run into transcript text, raising for failed runs."""
+    status = run.get("status")
+    if status != "SUCCEEDED":
+        raise ValueError(f"Apify run {run.get('id')} ended with status {status}.")
+    return parse_transcript_items(fetch_apify_dataset(run["defaultDatasetId"]))
+
+
+def wait_for_apify_run(run: dict, timeout: float = HTTP_TIMEOUT) -> dict:
+    """Polls a run with backoff until it reaches a terminal status or the timeout passes."""
+    delay, multiplier, max_delay = APIFY_POLL_BACKOFF
+    deadline = time.monotonic() + timeout
+    while run.get("status") not in APIFY_TERMINAL_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Apify run {run['id']} did not finish within {timeout} seconds.")
+        run = get_apify_run(run["id"], wait=min(APIFY_POLL_WAIT, remaining))
+        if run.get("status") not in APIFY_TERMINAL_STATUSES:
+            time.sleep(min(delay, max(0, deadline - time.monotonic())))
+            delay = min(delay * multiplier, max_delay)
+    return run
+
+
+def parse_transcript_items(results) -> str:
+    """Joins the caption segments of the actor's dataset items into one string."""
     # Correctly parse the nested data structure
     if not results or not isinstance(results, list) or not results[0].get('data'):
         raise ValueError("Apify returned no transcript data. The video may not have captions.")
@@ -171,31 +304,207 @@ def get_transcript_from_apify(youtube_url: str) -> str:
 
     return full_text
 
-def summarize_text(model, text: str, summary_type: str = 'default'):
-    """Summarizes and categorizes text content using the Gemini API."""
-    if summary_type == 'lecture':
-        prompt = LEARNING_NOTE_PROMPT.format(text=text)
-    else:
-        prompt = COMBINED_PROMPT.format(text=text)
 
-    resp = model.generate_content(prompt)
+def get_transcript_from_apify(youtube_url: str, deadline: Deadline = None) -> str:
+    """Runs the Apify Actor and waits for the transcript.
+
+    The run is started asynchronously and polled with backoff, so no single
+    HTTP call blocks for the whole scrape. Without an actor id the legacy
+    synchronous endpoint is used. With a deadline the wait stops early enough
+    to leave SUMMARY_RESERVE_SECONDS for summarization.
+    """
+    if not APIFY_TOKEN or not (APIFY_ACTOR_ID or APIFY_ENDPOINT):
+        raise ValueError("APIFY_ENDPOINT (or APIFY_ACTOR_ID) and APIFY_TOKEN must be set.")
+
+    timeout = HTTP_TIMEOUT
+    if deadline is not None:
+        deadline.check("transcript", SUMMARY_RESERVE_SECONDS)
+        timeout = min(HTTP_TIMEOUT, deadline.remaining() - SUMMARY_RESERVE_SECONDS)
+
+    if APIFY_ACTOR_ID:
+        run = wait_for_apify_run(start_apify_run(youtube_url), timeout)
+        return transcript_from_run(run)
+
+    print(f"Calling synchronous Apify endpoint: {APIFY_ENDPOINT}?token=...REDACTED...")
+    with guard('apify_sync'):
+        r = transport.http(
+            'apify', 'POST',
+            APIFY_ENDPOINT,
+            params={"token": APIFY_TOKEN},
+            json={'videoUrl': youtube_url},
+            headers={"Content-Type": "application/json"},
+            timeout=timeout,
+        )
+        r.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
+    return parse_transcript_items(r.json())
+
+def summarize_text(text: str, summary_type: str = 'default', api_key: str = API_KEY, deadline: Deadline = None,
+                   key_index: int = 1):
+    """Summarizes and categorizes text content using the Gemini API.
+
+    The static instructions go out as the system instruction; only the
+    transcript is sent per request. Call after genai.configure(api_key=...).
+    """
+    prompt_spec = LEARNING_NOTE_PROMPT if summary_type == 'lecture' else COMBINED_PROMPT
+    model = build_model(GENAI_MODEL, prompt_spec, api_key)
+    request_options = deadline.request_options("model") if deadline else None
+
+    started = time.monotonic()
+    try:
+        resp = model.generate_content(f"[Transcript]\n{text}", request_options=request_options)
+    except Exception as e:
+        record_llm_call("summarize_youtube", GENAI_MODEL, key_index, started, error=e)
+        resp = gemini_last_resort(GENAI_MODEL, f"[Transcript]\n{text}", prompt_spec.text)
+        if resp is None:
+            raise
+    else:
+        record_llm_call("summarize_youtube", GENAI_MODEL, key_index, started, usage_from_gemini(resp))
     result_data = extract_first_json(resp.text)
     return result_data
 
+
+def summarize_with_pool(text: str, summary_type: str, first_key: int = 0, deadline: Deadline = None):
+    """summarize_text over GEMINI_KEYS, starting at first_key and falling back through the rest."""
+    last_error = None
+    for offset in range(len(GEMINI_KEYS)):
+        index = (first_key + offset) % len(GEMINI_KEYS)
+        if not is_available('gemini', index + 1):
+            continue
+        started = time.monotonic()
+        try:
+            result = summarize_text(text, summary_type, GEMINI_KEYS[index], deadline, key_index=index + 1)
+            record_outcome('gemini', index + 1, started)
+            return result
+        except DeadlineExceeded:
+            # 요청 예산 소진은 키나 업스트림의 장애가 아니므로 차단기에 기록하지 않고 바로 중단합니다.
+            raise
+        except Exception as e:
+            if deadline is not None:
+                deadline.check("model")  # 예산 끝에서 잘린 호출도 같은 이유로 기록하지 않습니다.
+            last_error = e
+            record_outcome('gemini', index + 1, started, e)
+            print(f"WARN: API 키 #{index + 1} 요약 실패. 다음 키로 폴백합니다. 오류: {e}")
+    raise ConnectionError("모든 Gemini API 키로 요약에 실패했습니다.") from last_error
+
+# ==============================================================================
+# BATCH HELPERS
+# ==============================================================================
+
+def video_id(youtube_url: str) -> str:
+    """YouTube video id of a watch/youtu.be/shorts/embed URL, or a hash of the URL."""
+    parsed = urlparse(youtube_url)
+    query_id = parse_qs(parsed.query).get("v", [None])[0]
+    if query_id:
+        return query_id
+    match = re.match(r"^/(?:shorts/|embed/|live/)?([A-Za-z0-9_-]{11})", parsed.path)
+    if match and (parsed.netloc.endswith("youtu.be") or "/" in parsed.path[1:]):
+        return match.group(1)
+    return hashlib.sha256(youtube_url.encode('utf-8')).hexdigest()[:16]
+
+
+def _transcript_cache_path(youtube_url: str) -> str:
+    return os.path.join(TRANSCRIPT_CACHE_DIR, f"{video_id(youtube_url)}.json")
+
+
+def load_cached_transcript(youtube_url: str):
+    try:
+        with open(_transcript_cache_path(youtube_url), encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry.get("fetched_at", 0) > TRANSCRIPT_CACHE_TTL:
+        return None
+    return entry.get("transcript")
+
+
+def save_cached_transcript(youtube_url: str, transcript: str):
+    try:
+        os.makedirs(TRANSCRIPT_CACHE_DIR, exist_ok=True)
+        path = _transcript_cache_path(youtube_url)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"url": youtube_url, "transcript": transcript, "fetched_at": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"WARN: 트랜스크립트 캐시 저장 실패 ({youtube_url}): {e}")
+
+
+def get_transcript_cached(youtube_url: str, deadline: Deadline = None):
+    """Returns (transcript, cached), fetching from Apify only on a cache miss."""
+    transcript = load_cached_transcript(youtube_url)
+    record_cache("youtube_transcript", transcript is not None)
+    if transcript is not None:
+        return transcript, True
+    transcript = get_transcript_from_apify(youtube_url, deadline)
+    save_cached_transcript(youtube_url, transcript)
+    return transcript, False
+
+
+def expand_playlist(playlist_url: str) -> list:
+    """Video URLs of a playlist via the YouTube Data API, in playlist order."""
+    playlist_id = parse_qs(urlparse(playlist_url).query).get("list", [None])[0]
+    if not playlist_id:
+        raise ValueError("playlistUrl must contain a list= parameter.")
+    if not YOUTUBE_API_KEY:
+        raise ValueError("YOUTUBE_API_KEY must be set to expand playlists. Send youtubeUrls instead.")
+    urls, page_token = [], None
+    while len(urls) < BATCH_MAX_VIDEOS:
+        params = {"part": "contentDetails", "playlistId": playlist_id, "maxResults": 50, "key": YOUTUBE_API_KEY}
+        if page_token:
+            params["pageToken"] = page_token
+        with guard('youtube'):
+            r = transport.http('youtube', 'GET', "https://www.googleapis.com/youtube/v3/playlistItems",
+                               params=params, timeout=APIFY_REQUEST_TIMEOUT)
+            r.raise_for_status()
+        data = r.json()
+        urls.extend(f"https://www.youtube.com/watch?v={item['contentDetails']['videoId']}" for item in data.get("items", []))
+        page_token = data.get("nextPageToken")
+        if not page_token:
+            break
+    return urls[:BATCH_MAX_VIDEOS]
+
+
+def build_course_digest(results: list, deadline: Deadline = None):
+    """Combines per-video summaries (in playlist order) into one course-level digest."""
+    sections = []
+    for number, result in enumerate(results, start=1):
+        summary = str(result.get("summary", ""))[:DIGEST_MAX_SUMMARY_CHARS]
+        sections.append(f"## 영상 {number}. {result.get('title', '')}\n{summary}")
+    text = "\n\n".join(sections)
+    last_error = None
+    for index, api_key in enumerate(GEMINI_KEYS):
+        if not is_available('gemini', index + 1):
+            continue
+        model = build_model(GENAI_MODEL, COURSE_DIGEST_PROMPT, api_key)
+        request_options = deadline.request_options("digest") if deadline else None
+        started = time.monotonic()
+        try:
+            resp = model.generate_content(f"[Lecture summaries]\n{text}", request_options=request_options)
+            record_outcome('gemini', index + 1, started)
+            record_llm_call("summarize_youtube_digest", GENAI_MODEL, index + 1, started, usage_from_gemini(resp))
+            return extract_first_json(resp.text)
+        except Exception as e:
+            if deadline is not None:
+                deadline.check("digest")  # 요청 예산 끝에서 잘린 호출은 키 장애로 기록하지 않습니다.
+            last_error = e
+            record_outcome('gemini', index + 1, started, e)
+            record_llm_call("summarize_youtube_digest", GENAI_MODEL, index + 1, started, error=e)
+            print(f"WARN: API 키 #{index + 1} 과정 다이제스트 실패. 다음 키로 폴백합니다. 오류: {e}")
+    raise ConnectionError("모든 Gemini API 키로 과정 다이제스트 생성에 실패했습니다.") from last_error
+
 # ==============================================================================
 # VERCEL HANDLER CLASS
 # ==============================================================================
 
 class Handler(BaseHTTPRequestHandler):
-    def _send_json(self, status_code, body):
-        self.send_response(status_code)
-        self.send_header("Content-type", "application/json; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(json.dumps(body, ensure_ascii=False).encode("utf-8"))
+    def _send_json(self, status_code, body, headers=None):
+        send_json(self, status_code, body, headers=headers)
 
+    @flushes_metrics
     def do_POST(self):
+        deadline = Deadline('summarize_youtube')
         try:
-            if not API_KEY or not APIFY_ENDPOINT or not APIFY_TOKEN:
+            if not API_KEY or not (APIFY_ENDPOINT or APIFY_ACTOR_ID) or not APIFY_TOKEN:
                 return self._send_json(500, {"error": "Required environment variables (GEMINI, APIFY) are not set."})
 
             content_length = int(self.headers['Content-Length'])
@@ -204,14 +513,26 @@ class Handler(BaseHTTPRequestHandler):
             url = body.get("youtubeUrl")
             summary_type = body.get("summaryType", "default")
 
+            if body.get("youtubeUrls") or body.get("playlistUrl"):
+                urls = list(body.get("youtubeUrls") or []) or expand_playlist(body["playlistUrl"])
+                if not urls:
+                    return self._send_json(400, {"error": "No videos to summarize."})
+                if len(urls) > BATCH_MAX_VIDEOS:
+                    return self._send_json(413, {"error": f"At most {BATCH_MAX_VIDEOS} videos per batch."})
+                return self._stream_batch(urls, summary_type, bool(body.get("digest")), deadline)
+
             if not url:
                 return self._send_json(400, {"error": "youtubeUrl is required."})
 
+            if body.get("async"):
+                # Return a job reference right away; the client polls GET ?jobId=... for the result.
+                run = start_apify_run(url)
+                return self._send_pending(sign_job(run["id"], admission_key(self)), run.get("status"), summary_type)
+
             genai.configure(api_key=API_KEY)
-            model = genai.GenerativeModel(GENAI_MODEL)
 
-            transcript = get_transcript_from_apify(url)
-            result = summarize_text(model, transcript, summary_type)
+            transcript, _ = get_transcript_cached(url, deadline)
+            result = summarize_text(transcript, summary_type, deadline=deadline)
             
             return self._send_json(200, {**result, "mode": "transcript", "sourceUrl": url})
 
@@ -223,9 +544,136 @@ class Handler(BaseHTTPRequestHandler):
             except:
                 error_details = e.response.text[:200]
             return self._send_json(e.response.status_code, {"error": f"API call failed: {error_details}"})
+        except CircuitOpen as e:
+            return self._send_circuit_open(e)
+        except TimeoutError as e:
+            return self._send_json(504, {"error": str(e)})
         except Exception as e:
             print(f"Unhandled Exception: {e}\n{traceback.format_exc()}")
             return self._send_json(500, {"error": "An internal server error occurred."})
 
+    def _stream_batch(self, urls, summary_type, want_digest, deadline):
+        """Summarizes many videos, streaming one SSE event per video as it finishes.
+
+        Transcripts are fetched BATCH_TRANSCRIPT_WORKERS at a time (cached ones
+        return immediately) and each summary starts as soon as its transcript
+        arrives, spread over GEMINI_KEYS. Events: start, video (status ok/error),
+        optional digest, then summary.
+        """
+        print(f"INFO: 유튜브 영상 {len(urls)}개 일괄 요약 시작")
+        stream = start_event_stream(self)
+        writer = SSEWriter(stream, lambda text: {"type": "token", "content": text})
+        transcript_pool = ThreadPoolExecutor(max_workers=min(BATCH_TRANSCRIPT_WORKERS, len(urls)))
+        summary_pool = ThreadPoolExecutor(max_workers=len(GEMINI_KEYS) * BATCH_SUMMARY_WORKERS_PER_KEY)
+        stages = {transcript_pool.submit(get_transcript_cached, url, deadline): ("transcript", index)
+                  for index, url in enumerate(urls)}
+        results = [None] * len(urls)
+        succeeded = failed = cached = 0
+        try:
+            writer.send_event({"type": "start", "total": len(urls)})
+            while stages:
+                done, _ = wait(list(stages), timeout=max(0.1, deadline.remaining()), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    stage, index = stages.pop(future)
+                    try:
+                        value = future.result()
+                    except Exception as e:
+                        failed += 1
+                        print(f"WARN: 영상 {urls[index]} 처리 실패 ({stage}): {e}")
+                        writer.send_event({"type": "video", "index": index, "sourceUrl": urls[index],
+                                           "status": "error", "stage": stage, "error": str(e)})
+                        continue
+                    if stage == "transcript":
+                        transcript, was_cached = value
+                        cached += was_cached
+                        summary = summary_pool.submit(summarize_with_pool, transcript, summary_type,
+                                                      index % len(GEMINI_KEYS), deadline)
+                        stages[summary] = ("summary", index)
+                        continue
+                    results[index] = value
+                    succeeded += 1
+                    writer.send_event({"type": "video", "index": index, "sourceUrl": urls[index], "status": "ok",
+                                       "mode": "transcript", **value})
+
+            for future, (stage, index) in stages.items():
+                future.cancel()
+                failed += 1
+                writer.send_event({"type": "video", "index": index, "sourceUrl": urls[index], "status": "error",
+                                   "stage": stage, "error": "Request deadline reached before this video finished."})
+
+            completed = [result for result in results if result]
+            if want_digest and completed:
+                try:
+                    writer.send_event({"type": "digest", "videos": len(completed), **build_course_digest(completed, deadline)})
+                except Exception as e:
+                    print(f"WARN: 과정 다이제스트 생성 실패: {e}")
+                    writer.send_event({"type": "digest_error", "error": str(e)})
+            writer.send_event({"type": "summary", "total": len(urls), "succeeded": succeeded, "failed": failed,
+                               "cachedTranscripts": cached})
+        except ClientDisconnected as e:
+            print(f"WARN: 클라이언트 연결 종료로 일괄 요약을 중단합니다: {e}")
+        finally:
+            writer.close()
+            transcript_pool.shutdown(wait=False, cancel_futures=True)
+            summary_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _send_pending(self, job_id, status, summary_type):
+        query = urlencode({"jobId": job_id, "summaryType": summary_type})
+        return self._send_json(
+            202,
+            {"jobId": job_id, "status": status, "pollUrl": f"/api/summarize_youtube?{query}"},
+            headers={"Retry-After": "5"},
+        )
+
+    def _send_circuit_open(self, error):
+        # 트랜스크립트를 대신 받아 올 공급자가 없으므로 기다리지 않고 바로 재시도 시점을 알려 줍니다.
+        return self._send_json(
+            503,
+            {"error": "Transcript provider is temporarily unavailable.", "details": str(error)},
+            headers={"Retry-After": str(max(1, round(error.retry_after)))},
+        )
+
+    @flushes_metrics
     def do_GET(self):
-        self._send_json(405, {"error": "Method Not Allowed. Use POST."})
\ No newline at end of file
+        query = parse_qs(urlparse(self.path).query)
+        job_id = query.get("jobId", [None])[0]
+        if not job_id:
+            return self._send_json(405, {"error": "Method Not Allowed. Use POST."})
+
+        summary_type = query.get("summaryType", ["default"])[0]
+        deadline = Deadline('summarize_youtube')
+        try:
+            if not API_KEY or not APIFY_TOKEN:
+                return self._send_json(500, {"error": "Required environment variables (GEMINI, APIFY) are not set."})
+
+            # 실행을 시작한 호출자에게 발급한 jobId만 조회할 수 있습니다.
+            run_id = verify_job(job_id, admission_key(self))
+            if not run_id:
+                return self._send_json(404, {"error": "Unknown jobId."})
+
+            run = get_apify_run(run_id, wait=min(APIFY_POLL_WAIT, deadline.timeout("poll")))
+            if run.get("status") not in APIFY_TERMINAL_STATUSES:
+                return self._send_pending(job_id, run.get("status"), summary_type)
+
+            transcript = transcript_from_run(run)
+            # 캐시 키는 클라이언트가 보낸 값이 아니라 실행에 실제로 넘긴 입력의 영상 URL입니다.
+            url = fetch_apify_run_input(run).get("videoUrl")
+            if url:
+                save_cached_transcript(url, transcript)
+            genai.configure(api_key=API_KEY)
+            result = summarize_text(transcript, summary_type, deadline=deadline)
+            return self._send_json(200, {**result, "mode": "transcript", "sourceUrl": url, "jobId": job_id})
+
+        except (ValueError, TypeError) as e:
+            return self._send_json(400, {"error": str(e)})
+        except requests.HTTPError as e:
+            return self._send_json(e.response.status_code, {"error": f"API call failed: {e.response.text[:200]}"})
+        except CircuitOpen as e:
+            return self._send_circuit_open(e)
+        except TimeoutError as e:
+            return self._send_json(504, {"error": str(e)})
+        except Exception as e:
+            print(f"Unhandled Exception: {e}\n{traceback.format_exc()}")
+            return self._send_json(500, {"error": "An internal server error occurred."})
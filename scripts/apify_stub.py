@@ -0,0 +1,66 @@
+"""Local stand-in for the Apify run/dataset API used by api/summarize_youtube.py.
+
+Runs finish after STUB_RUN_SECONDS and produce a canned transcript, so the
+async start/poll/dataset flow can be exercised without an Apify account:
+
+    python scripts/apify_stub.py 8787
+    APIFY_API_BASE=http://127.0.0.1:8787/v2 APIFY_ACTOR_ID=stub APIFY_TOKEN=x vercel dev
+"""
+import json
+import os
+import sys
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+STUB_RUN_SECONDS = float(os.getenv("STUB_RUN_SECONDS", "3"))
+RUNS = {}
+
+
+def run_view(run_id):
+    run = RUNS[run_id]
+    status = "SUCCEEDED" if time.time() - run["startedAt"] >= STUB_RUN_SECONDS else "RUNNING"
+    return {"id": run_id, "status": status, "defaultDatasetId": run["datasetId"]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def _send(self, status, body):
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts[:2] != ["v2", "acts"] or parts[-1] != "runs":
+            return self._send(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        run_id = uuid.uuid4().hex[:12]
+        RUNS[run_id] = {"startedAt": time.time(), "datasetId": f"ds-{run_id}", "input": body}
+        self._send(201, {"data": run_view(run_id)})
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        parts = parsed.path.strip("/").split("/")
+        query = parse_qs(parsed.query)
+        if parts[:2] == ["v2", "actor-runs"] and parts[2] in RUNS:
+            deadline = time.time() + min(float(query.get("waitForFinish", ["0"])[0]), 60)
+            while run_view(parts[2])["status"] != "SUCCEEDED" and time.time() < deadline:
+                time.sleep(0.2)
+            return self._send(200, {"data": run_view(parts[2])})
+        if parts[:2] == ["v2", "datasets"] and parts[-1] == "items":
+            run_id = parts[2][len("ds-"):]
+            video_url = RUNS.get(run_id, {}).get("input", {}).get("videoUrl", "")
+            segments = [{"text": f"Stub transcript segment {i} for {video_url}."} for i in range(20)]
+            return self._send(200, [{"data": segments}])
+        self._send(404, {"error": "not found"})
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8787
+    print(f"Apify stub listening on http://127.0.0.1:{port}/v2")
+    ThreadingHTTPServer(("127.0.0.1", port), StubHandler).serve_forever()
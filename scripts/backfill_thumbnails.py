@@ -0,0 +1,75 @@
+"""Generates thumbnails for synced_media rows that have none yet.
+
+Usage: python scripts/backfill_thumbnails.py [--limit N] [--page-size N] [--dry-run]
+
+Covers files uploaded before thumbnails existed and jobs that failed or did
+not finish within THUMBNAIL_WAIT_SECONDS. Needs VITE_PUBLICSUPABASE_URL and
+SUPABASE_SERVICE_ROLE_KEY; runs on the same worker pool as add-synced-media.
+
+Rows are walked newest first with a created_at cursor, so rows that keep
+failing do not hide older ones. Files that can never get a preview (video,
+audio, undecodable images) are marked with thumbnails = '{}' and are not
+selected again.
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from _lib import thumbnails
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--limit", type=int, default=200, help="rows to process in this run")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    if not thumbnails.THUMBNAILS_ENABLED:
+        print("THUMBNAILS_ENABLED=0, nothing to do")
+        return
+
+    from supabase import create_client
+    supabase = create_client(os.environ['VITE_PUBLICSUPABASE_URL'], os.environ['SUPABASE_SERVICE_ROLE_KEY'])
+    bucket = supabase.storage.from_(thumbnails.THUMBNAIL_BUCKET)
+
+    cursor = None
+    seen = skipped = 0
+    futures = {}
+    while seen < args.limit:
+        query = (supabase.table('synced_media').select('id, url, created_at').is_('thumbnails', 'null')
+                 .order('created_at', desc=True).limit(min(args.page_size, args.limit - seen)))
+        if cursor is not None:
+            query = query.lt('created_at', cursor)
+        rows = query.execute().data or []
+        for row in rows:
+            path = thumbnails.storage_path_from_url(row['url'])
+            if path is None or thumbnails.media_kind(path) is None:
+                print(f"  skip {row['id']}: {row['url']}")
+                skipped += 1
+                if not args.dry_run:
+                    thumbnails.mark_no_preview(supabase, row['url'])
+                continue
+            if args.dry_run:
+                print(f"  would process {path}")
+                continue
+            futures[path] = thumbnails.schedule(supabase, path, row['url'], lambda path=path: bucket.download(path))
+        seen += len(rows)
+        if len(rows) < args.page_size:
+            break
+        cursor = rows[-1]['created_at']
+    print(f"rows without thumbnails: {seen} ({skipped} without preview)")
+
+    failed = 0
+    for path, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            failed += 1
+            print(f"  failed {path}: {e}")
+    print(f"done: {len(futures) - failed} ok, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Bytes-on-wire for the negotiated encodings on representative generation outputs.
+
+Usage: python scripts/bench_compression.py [path/to/response.json ...]
+Without arguments a synthetic textbook/review-note payload and a chat SSE stream are used.
+"""
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from _lib.compression import StreamCompressor, available_encodings, compress
+
+SECTION = """## {n}. 열전달의 기본 개념
+
+<dfn title="매질 없이 열이 직접 전달되는 현상">복사</dfn>와 전도, 대류는 열전달의 세 가지 방식입니다.
+푸리에 법칙은 $q''_x = -k \\frac{{dT}}{{dx}}$ 로 표현되며, 정상 상태에서는
+
+$$T(x) = T_s + \\frac{{q'''}}{{2k}}(Lx - x^2)$$
+
+```mermaid
+graph TD
+    A["열원
+(고온)"] -- "전도" --> B["벽면"]
+    B -- "대류" --> C["유체"]
+```
+
+```visual
+{{"type": "box", "props": {{"style": {{"padding": "12px", "border": "1px solid #ccc"}}}},
+ "children": [{{"type": "text", "props": {{"content": "전도: 고체 내부의 분자 진동"}}}}]}}
+```
+"""
+
+
+def synthetic_payloads():
+    content = "\n".join(SECTION.format(n=i) for i in range(1, 41))
+    textbook = {"title": "열전달 - 3주차 참고서", "content": content, "subjectId": "s1"}
+    review = {
+        "title": "열전달 복습노트", "content": content[: len(content) // 2],
+        "key_insights": ["푸리에 법칙은 온도 기울기에 비례한다."] * 5,
+        "quiz": {"questions": [{"question": f"질문 {i}", "options": ["가", "나", "다", "라"], "answer": "가"} for i in range(10)]},
+        "subjectName": "열전달",
+    }
+    return {"textbook": textbook, "review_note": review}
+
+
+def bench_json(name, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    print(f"{name}: identity {len(body):9d} B")
+    for encoding in available_encodings():
+        start = time.perf_counter()
+        size = len(compress(body, encoding))
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{'':>{len(name)}}  {encoding:>8} {size:9d} B  ({100 - size * 100 / len(body):5.1f}% smaller, {elapsed:6.1f} ms)")
+
+
+def bench_sse(text, frame_chars=40):
+    frames = [f"data: {json.dumps({'type': 'token', 'content': text[i:i + frame_chars]})}\n\n".encode('utf-8')
+              for i in range(0, len(text), frame_chars)]
+    identity = sum(len(f) for f in frames)
+    print(f"chat SSE ({len(frames)} frames): identity {identity:9d} B")
+    for encoding in available_encodings():
+        sink = io.BytesIO()
+        stream = StreamCompressor(sink, encoding)
+        for frame in frames:
+            stream.write(frame)
+            stream.flush()
+        stream.finish()
+        size = len(sink.getvalue())
+        print(f"{'':>22}{encoding:>8} {size:9d} B  ({100 - size * 100 / identity:5.1f}% smaller)")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, encoding='utf-8') as f:
+                bench_json(os.path.basename(path), json.load(f))
+    else:
+        payloads = synthetic_payloads()
+        for name, payload in payloads.items():
+            bench_json(name, payload)
+        bench_sse(payloads["textbook"]["content"][:20000])
@@ -0,0 +1,190 @@
+"""Peak memory of building a multimodal request from large uploads, old pipeline vs spooled.
+
+Usage: python scripts/bench_materials_memory.py [--photos N] [--side PX] [--ceiling-mb MB]
+(the legacy run takes a few minutes at the default size)
+
+Generates N large phone-style photos plus a PNG screenshot, serves them over a
+local HTTP server and builds request contents the way create_textbook does:
+download, decode, dedup, then serialize as generate_content would. Each pipeline
+runs in its own process and reports its tracemalloc peak and max RSS above
+the RSS the process had once its libraries were imported.
+
+'legacy' keeps response.content, a PIL image per file and the SDK's lossless
+WebP re-encode. 'spooled' uses _lib.materials. Exits non-zero if the spooled
+pipeline's tracemalloc peak or its RSS growth is above the ceiling; tracemalloc
+alone does not see Pillow's pixel buffers, RSS does.
+"""
+import argparse
+import functools
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+
+def make_fixture(directory, photos, side):
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    height = side * 3 // 4
+    names = []
+    for index in range(photos):
+        # 부드러운 그라데이션에 잡음을 얹어 실제 사진 정도의 JPEG 크기가 나오게 합니다.
+        y, x = np.mgrid[0:height, 0:side]
+        base = ((x * (index + 1) + y) % 256).astype(np.uint8)
+        noise = rng.integers(0, 40, size=(height, side), dtype=np.uint8)
+        pixels = np.stack([base, base // 2 + noise, 255 - base], axis=-1)
+        name = f"photo_{index}.jpg"
+        Image.fromarray(pixels, 'RGB').save(os.path.join(directory, name), quality=92)
+        names.append(name)
+    screenshot = Image.new('RGBA', (1290, 2796), (250, 250, 250, 255))
+    screenshot.save(os.path.join(directory, "screenshot.png"))
+    names.append("screenshot.png")
+    return names
+
+
+def serve(directory):
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serialize(contents):
+    # generate_content가 하는 것처럼 파트를 Content 메시지로 바꾸고 전송 바이트로 직렬화합니다.
+    import google.ai.generativelanguage as glm
+    from google.generativeai.types import content_types
+    content = content_types.to_content(contents)
+    return len(glm.Content.serialize(content))
+
+
+def run_legacy(urls):
+    import requests
+    from PIL import Image
+    from _lib.dedup import dedup_materials
+    contents = ["prompt"]
+    for url in urls:
+        response = requests.get(url, stream=True, timeout=30)
+        response.raise_for_status()
+        file_content = response.content
+        contents.append(Image.open(io.BytesIO(file_content)))
+    contents, _ = dedup_materials(contents)
+    return serialize(contents)
+
+
+def run_spooled(urls):
+    from _lib.dedup import dedup_materials
+    from _lib.materials import MemoryCeiling, decode_material, download_material
+    memory = MemoryCeiling()
+    contents = ["prompt"]
+    for url in urls:
+        spool, content_type, _ = download_material(url, 30)
+        with spool:
+            _, parts = decode_material(spool, content_type, memory, label=os.path.basename(url))
+        contents.extend(parts)
+    contents, _ = dedup_materials(contents)
+    return serialize(contents)
+
+
+def _proc_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def max_rss():
+    # ru_maxrss는 execve 뒤에도 부모(픽스처 생성)의 최고치를 이어받으므로 VmHWM을 우선 읽습니다.
+    return _proc_status("VmHWM") or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def child(mode, urls):
+    # 두 파이프라인이 쓰는 라이브러리를 먼저 올려, 인터프리터와 모듈 몫을 RSS 기준선으로 뺍니다.
+    import requests  # noqa: F401
+    from PIL import Image  # noqa: F401
+    from google.generativeai.types import content_types  # noqa: F401
+    from _lib import dedup, materials  # noqa: F401
+    baseline_rss = _proc_status("VmRSS") or max_rss()
+    tracemalloc.start()
+    started = time.perf_counter()
+    sent_bytes = (run_legacy if mode == "legacy" else run_spooled)(urls)
+    _, peak = tracemalloc.get_traced_memory()
+    print(json.dumps({
+        "mode": mode,
+        "seconds": round(time.perf_counter() - started, 2),
+        "tracemalloc_peak": peak,
+        "max_rss": max_rss(),
+        "baseline_rss": baseline_rss,
+        "request_bytes": sent_bytes,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--photos", type=int, default=8)
+    parser.add_argument("--side", type=int, default=6000, help="long side of each photo in px")
+    parser.add_argument("--ceiling-mb", type=float, default=float(os.getenv("MATERIALS_MEMORY_CEILING_MB", "384")))
+    parser.add_argument("--child", choices=["legacy", "spooled"], help=argparse.SUPPRESS)
+    parser.add_argument("--urls", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, json.loads(args.urls))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        names = make_fixture(directory, args.photos, args.side)
+        total = sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+        print(f"fixture: {len(names)} files, {total / 1e6:.1f}MB on disk")
+        server = serve(directory)
+        urls = [f"http://127.0.0.1:{server.server_address[1]}/{name}" for name in names]
+        env = dict(os.environ, MATERIALS_MEMORY_CEILING_MB=str(args.ceiling_mb))
+        results = []
+        for mode in ("legacy", "spooled"):
+            output = subprocess.run([sys.executable, __file__, "--child", mode, "--urls", json.dumps(urls)],
+                                    env=env, capture_output=True, text=True)
+            if output.returncode != 0:
+                print(f"{mode}: failed\n{output.stderr[-2000:]}")
+                continue
+            results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        server.shutdown()
+
+    print(f"{'mode':<8} {'seconds':>8} {'traced peak':>12} {'max RSS':>10} {'RSS growth':>11} {'request':>10}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['seconds']:>8.2f} {r['tracemalloc_peak'] / 1e6:>10.1f}MB "
+              f"{r['max_rss'] / 1e6:>8.1f}MB {(r['max_rss'] - r['baseline_rss']) / 1e6:>9.1f}MB "
+              f"{r['request_bytes'] / 1e6:>8.1f}MB")
+
+    spooled = next((r for r in results if r["mode"] == "spooled"), None)
+    ceiling = args.ceiling_mb * 1024 * 1024
+    if spooled is None:
+        print("FAIL: spooled pipeline did not finish")
+        sys.exit(1)
+    failures = []
+    if spooled["tracemalloc_peak"] > ceiling:
+        failures.append(f"traced peak {spooled['tracemalloc_peak'] / 1e6:.1f}MB")
+    if spooled["max_rss"] - spooled["baseline_rss"] > ceiling:
+        failures.append(f"RSS growth {(spooled['max_rss'] - spooled['baseline_rss']) / 1e6:.1f}MB")
+    if failures:
+        print(f"FAIL: spooled pipeline above the {args.ceiling_mb:.0f}MB ceiling: {', '.join(failures)}")
+        sys.exit(1)
+    print(f"OK: spooled pipeline traced peak and RSS growth within the {args.ceiling_mb:.0f}MB ceiling")
+
+
+if __name__ == "__main__":
+    main()
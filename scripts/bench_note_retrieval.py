@@ -0,0 +1,120 @@
+"""Recall and prompt size of the chat note retrieval layer versus sending the full note.
+
+Usage: python scripts/bench_note_retrieval.py [--note note.md --questions questions.jsonl] [--top-k 6] [--live]
+
+questions.jsonl holds one {"question": ..., "evidence": ...} per line, where evidence is a
+passage of the note that a correct answer needs. Without --note a synthetic multi-section
+note is used. Recall is the share of questions whose evidence is inside the retrieved
+context. With --live (needs GEMINI_API_KEY) each question is also answered by Gemini with
+the full note and with the retrieved context, and the answers are compared by token F1.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from _lib import retrieval
+from _lib.retrieval import select_context, tokenize
+
+TOPICS = [
+    ("전도", "푸리에 법칙에 따르면 열유속은 온도 기울기에 비례하고 그 비례 상수가 열전도율 $k$ 입니다."),
+    ("대류", "뉴턴의 냉각 법칙 $q'' = h(T_s - T_\\infty)$ 에서 $h$ 는 대류 열전달 계수입니다."),
+    ("복사", "스테판-볼츠만 법칙에 따라 흑체의 방사력은 절대온도의 네제곱에 비례합니다."),
+    ("열저항", "평판 벽의 전도 열저항은 $L/(kA)$ 이고 직렬 저항은 단순히 더합니다."),
+    ("핀", "핀 효율은 핀 전체가 바닥 온도일 때의 열전달량 대비 실제 열전달량의 비율입니다."),
+    ("비정상 전도", "비오 수가 0.1보다 작으면 집중 용량법으로 물체 내부 온도를 균일하다고 봅니다."),
+    ("열교환기", "대수평균온도차 LMTD 는 대향류 열교환기에서 병류보다 항상 크게 나옵니다."),
+    ("자연대류", "그라스호프 수는 부력과 점성력의 비로 자연대류의 세기를 나타냅니다."),
+    ("비등", "핵비등 영역을 지나 임계 열유속에 도달하면 막비등으로 전이되어 벽면 온도가 급상승합니다."),
+    ("응축", "막응축에서는 액막이 열저항으로 작용하므로 적상응축보다 열전달 계수가 작습니다."),
+    ("무차원수", "누셀 수는 대류 열전달과 순수 전도 열전달의 비로 정의됩니다."),
+    ("경계층", "프란틀 수가 1보다 크면 속도 경계층이 열 경계층보다 두껍게 발달합니다."),
+]
+FILLER = ("이 절에서는 개념의 정의와 가정, 그리고 대표적인 예제를 함께 살펴봅니다. "
+          "실제 공학 문제에서는 경계 조건과 물성치의 온도 의존성을 함께 고려해야 하며, "
+          "단위 환산과 유효 숫자 처리에도 주의가 필요합니다. ")
+QUESTION_TEMPLATES = ["{topic}에서 가장 중요한 관계식이 뭐야?", "{topic} 부분을 다시 설명해줘", "{topic}의 핵심 개념은?"]
+
+
+def synthetic_note():
+    sections, questions = [], []
+    for n, (topic, evidence) in enumerate(TOPICS, start=1):
+        # 실제 긴 노트처럼 절마다 여러 문단이 있고, 근거 문장은 그중 한 문단에만 있습니다.
+        paragraphs = [f"{topic} 예제 {i}. " + FILLER * 3 for i in range(1, 9)]
+        paragraphs.insert(n % len(paragraphs), evidence)
+        sections.append(f"## {n}. {topic}\n\n" + "\n\n".join(paragraphs))
+        questions.append({"question": QUESTION_TEMPLATES[n % len(QUESTION_TEMPLATES)].format(topic=topic), "evidence": evidence})
+    return "# 열전달 복습 노트\n\n" + "\n\n".join(sections), questions
+
+
+def token_f1(a, b):
+    ta, tb = Counter(tokenize(a)), Counter(tokenize(b))
+    overlap = sum((ta & tb).values())
+    if not overlap:
+        return 0.0
+    precision, recall = overlap / sum(tb.values()), overlap / sum(ta.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def answer(model, context, question):
+    prompt = f"# 참고 자료\n{context}\n\n# 질문\n{question}\n\n참고 자료만 근거로 3문장 이내로 답하세요."
+    return model.generate_content(prompt).text
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--note")
+    parser.add_argument("--questions")
+    parser.add_argument("--top-k", type=int, default=retrieval.RETRIEVAL_TOP_K)
+    parser.add_argument("--live", action="store_true")
+    args = parser.parse_args()
+
+    if args.note:
+        with open(args.note, encoding='utf-8') as f:
+            note = f.read()
+        with open(args.questions, encoding='utf-8') as f:
+            questions = [json.loads(line) for line in f if line.strip()]
+    else:
+        note, questions = synthetic_note()
+    # 벤치마크에서는 노트 길이와 관계없이 항상 검색을 사용합니다.
+    retrieval.RETRIEVAL_MIN_NOTE_TOKENS = 0
+
+    model = None
+    if args.live:
+        import google.generativeai as genai
+        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        model = genai.GenerativeModel("gemini-2.5-flash")
+
+    hits, context_tokens, elapsed_ms, f1_scores = 0, [], [], []
+    note_tokens = 0
+    for item in questions:
+        start = time.perf_counter()
+        context, report = select_context(note, item["question"], args.top_k)
+        elapsed_ms.append((time.perf_counter() - start) * 1000)
+        note_tokens = report["note_tokens"]
+        context_tokens.append(report["context_tokens"])
+        hit = item["evidence"] in context
+        hits += hit
+        line = f"{'HIT ' if hit else 'MISS'} {report['context_tokens']:6d} tok  {item['question']}"
+        if model is not None:
+            f1 = token_f1(answer(model, note, item["question"]), answer(model, context, item["question"]))
+            f1_scores.append(f1)
+            line += f"  (answer F1 vs full {f1:.2f})"
+        print(line)
+
+    count = len(questions)
+    average_tokens = sum(context_tokens) / count
+    print(f"\nchunks: {len(retrieval.get_index(note).chunks)}, top-k: {args.top_k}")
+    print(f"recall@{args.top_k}: {hits}/{count} ({hits * 100 / count:.1f}%)")
+    print(f"prompt context: full {note_tokens} tok -> retrieved {average_tokens:.0f} tok avg "
+          f"({note_tokens / max(average_tokens, 1):.1f}x smaller)")
+    print(f"selection latency: first {elapsed_ms[0]:.2f} ms (index build), then {sum(elapsed_ms[1:]) / max(count - 1, 1):.2f} ms avg")
+    if f1_scores:
+        print(f"answer agreement with full-context answers: mean token F1 {sum(f1_scores) / len(f1_scores):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Micro-benchmark: per-token SSE frames vs. the coalesced SSEWriter.
+
+Usage: python scripts/bench_sse_writer.py [token_count] [tokens_per_second]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from _lib.sse import SSEWriter
+
+
+class CountingSink:
+    def __init__(self):
+        self.writes = 0
+        self.flushes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+    def flush(self):
+        self.flushes += 1
+
+
+def per_token(tokens, delay):
+    sink = CountingSink()
+    for token in tokens:
+        frame = json.dumps({"type": "token", "content": token})
+        sink.write(f"data: {frame}\n\n".encode('utf-8'))
+        sink.flush()
+        if delay:
+            time.sleep(delay)
+    return sink
+
+
+def coalesced(tokens, delay):
+    sink = CountingSink()
+    writer = SSEWriter(sink, lambda text: {"type": "token", "content": text})
+    for token in tokens:
+        writer.send_token(token)
+        if delay:
+            time.sleep(delay)
+    writer.close()
+    return sink
+
+
+def run(name, fn, tokens, delay):
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    sink = fn(tokens, delay)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    print(f"{name:>10}: frames={sink.writes:6d} flushes={sink.flushes:6d} bytes={sink.bytes:8d} "
+          f"frames/s={sink.writes / wall:10.0f} cpu={cpu * 1000:8.1f}ms wall={wall * 1000:8.1f}ms")
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    tokens = [f"토큰{i % 10} " for i in range(count)]
+    delay = 1 / rate if rate else 0
+    run("per-token", per_token, tokens, delay)
+    run("coalesced", coalesced, tokens, delay)
@@ -0,0 +1,148 @@
+"""Image bytes, tokens, latency and extraction accuracy of timetable preprocessing.
+
+Usage: python scripts/bench_timetable_preprocess.py [fixtures_dir] [--live]
+
+A fixture is an image (png/jpg) with a sibling .json holding the expected events
+([{"subjectName", "dayOfWeek", "startTime", "endTime"}, ...]). Without a directory,
+synthetic phone screenshots (status bar, app chrome, margins) are generated.
+With --live (needs GEMINI_API_KEY) both the original and the preprocessed image are
+sent to Gemini with the process_calendar prompt and scored against the expected events.
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from _lib.timetable import preprocess_timetable
+
+DAYS = ['월', '화', '수', '목', '금']
+SYNTHETIC_EVENTS = [
+    [("열전달", 0, "09:00", "10:30"), ("유체역학", 2, "13:00", "15:00"), ("공업수학", 4, "10:00", "11:00")],
+    [("인지과학 개론", 1, "10:30", "12:00"), ("자료구조", 3, "15:00", "16:30"), ("영어회화", 0, "17:00", "18:00"),
+     ("기계설계", 2, "09:00", "10:00")],
+]
+
+
+def _minutes(hhmm):
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def _font(size):
+    # 한글 과목명을 그리려면 BENCH_FONT에 한글 TrueType 글꼴 경로를 지정하세요.
+    if os.getenv("BENCH_FONT"):
+        return ImageFont.truetype(os.environ["BENCH_FONT"], size)
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def synthetic_screenshot(events, width=1170, height=2532):
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.font = _font(34)
+    draw.rectangle([0, 0, width, 140], fill=(20, 20, 20))                 # 상태 표시줄
+    draw.text((40, 50), "9:41   LTE  87%", fill='white')
+    draw.rectangle([0, 140, width, 360], fill=(248, 248, 248))            # 앱 헤더
+    draw.text((60, 230), "2025년 2학기 시간표", fill='black')
+    draw.rectangle([0, height - 250, width, height], fill=(245, 245, 245))  # 하단 탭 바
+
+    left, top, col_width, row_height = 90, 460, 205, 58                   # 09:00~19:00, 30분 단위
+    rows = 20
+    right, bottom = left + col_width * len(DAYS), top + row_height * rows
+    for day, name in enumerate(DAYS):
+        draw.text((left + day * col_width + col_width // 2, top - 40), name, fill='black')
+    for row in range(rows + 1):
+        y = top + row * row_height
+        draw.line([left - 60, y, right, y], fill=(200, 200, 200), width=2)
+        if row % 2 == 0 and row < rows:
+            draw.text((left - 50, y + 6), str(9 + row // 2), fill='black')
+    for col in range(len(DAYS) + 1):
+        x = left + col * col_width
+        draw.line([x, top - 60, x, bottom], fill=(200, 200, 200), width=2)
+
+    colors = [(255, 196, 196), (196, 220, 255), (200, 240, 200), (255, 230, 180)]
+    for index, (subject, day, start, end) in enumerate(events):
+        y0 = top + (_minutes(start) - 540) * row_height // 30
+        y1 = top + (_minutes(end) - 540) * row_height // 30
+        x0 = left + day * col_width
+        draw.rectangle([x0 + 2, y0 + 2, x0 + col_width - 2, y1 - 2], fill=colors[index % len(colors)])
+        draw.text((x0 + 10, y0 + 10), subject, fill='black')
+    expected = [{"subjectName": s, "dayOfWeek": DAYS[d], "startTime": a, "endTime": b} for s, d, a, b in events]
+    return img, expected
+
+
+def load_fixtures(directory):
+    if not directory:
+        fixtures = []
+        for i, events in enumerate(SYNTHETIC_EVENTS):
+            img, expected = synthetic_screenshot(events)
+            fixtures.append((f"synthetic-{i}-png", img, expected))
+            # 메신저 등으로 공유된 스크린샷처럼 JPEG 압축 잡음이 있는 경우
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=85)
+            fixtures.append((f"synthetic-{i}-jpeg", Image.open(io.BytesIO(buffer.getvalue())), expected))
+        return fixtures
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        stem, ext = os.path.splitext(path)
+        if ext.lower() in ('.png', '.jpg', '.jpeg') and os.path.exists(stem + '.json'):
+            with open(stem + '.json', encoding='utf-8') as f:
+                fixtures.append((os.path.basename(stem), Image.open(path), json.load(f)))
+    return fixtures
+
+
+def webp_bytes(img):
+    # genai는 PIL 이미지를 무손실 WebP로 보냅니다.
+    buffer = io.BytesIO()
+    img.save(buffer, format='webp', lossless=True)
+    return buffer.tell()
+
+
+def score(expected, extracted):
+    key = lambda e: (str(e.get("subjectName", "")).replace(" ", ""), e.get("dayOfWeek"), e.get("startTime"), e.get("endTime"))
+    wanted, got = {key(e) for e in expected}, {key(e) for e in extracted}
+    return len(wanted & got) / len(wanted) if wanted else 1.0
+
+
+def extract_live(model, img):
+    import process_calendar
+    started = time.perf_counter()
+    response = model.generate_content([process_calendar.TIMETABLE_PROMPT, img])
+    return process_calendar.extract_first_json(response.text), (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fixtures", nargs="?")
+    parser.add_argument("--live", action="store_true")
+    args = parser.parse_args()
+
+    model = None
+    if args.live:
+        import google.generativeai as genai
+        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        model = genai.GenerativeModel(os.getenv("GENAI_MODEL", "gemini-2.5-flash"))
+
+    for name, img, expected in load_fixtures(args.fixtures):
+        original_bytes = webp_bytes(img)
+        processed, report = preprocess_timetable(img)
+        processed_bytes = webp_bytes(processed)
+        print(f"{name}: {report['mode']} {report['original_size']} -> {report['size']} in {report['ms']} ms")
+        print(f"    bytes  {original_bytes:9d} -> {processed_bytes:9d} ({100 - processed_bytes * 100 / original_bytes:5.1f}% smaller)")
+        print(f"    tokens {report['original_tokens']:9d} -> {report['tokens']:9d}")
+        if model is not None:
+            for label, candidate in (("original", img), ("processed", processed)):
+                extracted, elapsed = extract_live(model, candidate)
+                print(f"    {label:>9}: accuracy {score(expected, extracted) * 100:5.1f}%  latency {elapsed:7.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""Checks that chat falls over to direct Gemini when every OpenRouter breaker is open.
+
+Usage: python scripts/check_chat_failover.py
+
+Opens the upstream and per-key OpenRouter breakers, runs execute_openrouter on
+a handler built without a socket, and asserts that failover_to_gemini is
+reached instead of an error escaping from the key loop. No request goes out.
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from _lib.breaker import get_breaker
+from _lib.deadline import Deadline
+import chat
+
+
+def main():
+    keys = ["sk-or-primary", "sk-or-secondary", "AIza-gemini"]
+    for key in (None, 1, 2):
+        get_breaker('openrouter', key)._open(time.monotonic())
+
+    handler = chat.handler.__new__(chat.handler)
+    handler.deadline = Deadline('chat')
+    calls = []
+    handler.failover_to_gemini = lambda *args: calls.append(args)
+
+    handler.execute_openrouter("openai/gpt-4o-mini", [{"role": "user", "content": "hi"}], "system", keys)
+    assert len(calls) == 1, "failover_to_gemini was not called"
+    print("OK: all OpenRouter breakers open -> failover_to_gemini")
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,12 @@ interface GeminiHistory {
   parts: { text: string }[];
 }
 
+interface SyncedMedia {
+  id: string;
+  url: string;
+  thumbnails?: { small?: string; medium?: string; large?: string } | null;
+}
+
 const createInitialMessage = (): Message => ({
   id: Date.now(),
   type: 'text',
@@ -76,7 +82,7 @@ export const ChatUI: React.FC<ChatUIProps> = ({ noteContext = '무엇이든 물
   const [selectedModel, setSelectedModel] = useState(models[0].id);
   const [isPopoverOpen, setIsPopoverOpen] = useState(false);
   const [isSyncedMediaOpen, setIsSyncedMediaOpen] = useState(false);
-  const [syncedImages, setSyncedImages] = useState<{id: string, url: string}[]>([]);
+  const [syncedImages, setSyncedImages] = useState<SyncedMedia[]>([]);
   const [isSyncLoading, setIsSyncLoading] = useState(false);
   const { getToken } = useAuth();
 
@@ -97,7 +103,7 @@ export const ChatUI: React.FC<ChatUIProps> = ({ noteContext = '무엇이든 물
 
         const { data, error } = await authedSupabase
           .from('synced_media')
-          .select('id, url')
+          .select('id, url, thumbnails')
           .order('created_at', { ascending: false })
           .limit(20);
 
@@ -115,7 +121,12 @@ export const ChatUI: React.FC<ChatUIProps> = ({ noteContext = '무엇이든 물
 
     const channel = supabase.channel('synced_media_changes')
       .on('postgres_changes', { event: 'INSERT', schema: 'public', table: 'synced_media' }, (payload) => {
-        setSyncedImages(prev => [payload.new as {id: string, url: string}, ...prev]);
+        setSyncedImages(prev => [payload.new as SyncedMedia, ...prev]);
+      })
+      // 썸네일은 업로드 응답 뒤에 생성되어 UPDATE로 도착합니다.
+      .on('postgres_changes', { event: 'UPDATE', schema: 'public', table: 'synced_media' }, (payload) => {
+        const updated = payload.new as SyncedMedia;
+        setSyncedImages(prev => prev.map(image => image.id === updated.id ? updated : image));
       })
       .subscribe();
 
@@ -362,9 +373,10 @@ export const ChatUI: React.FC<ChatUIProps> = ({ noteContext = '무엇이든 물
     setMessages(prev => [...prev, botMessage]);
 
     try {
+      const token = await getToken({ template: 'supabase' });
       const response = await fetch('/api/chat', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', ...(token ? { Authorization: `Bearer ${token}` } : {}) },
         body: JSON.stringify({ history, model: selectedModel, noteContext: combinedNoteContext, fileUrls: uploadedBlobUrls }),
         signal: controller.signal,
       });
@@ -561,7 +573,7 @@ export const ChatUI: React.FC<ChatUIProps> = ({ noteContext = '무엇이든 물
                     <div className="grid grid-cols-3 gap-2 h-48 overflow-y-auto border p-2 rounded-lg">
                       {isSyncLoading ? <p className="col-span-3 text-center text-sm text-muted-foreground">불러오는 중...</p> : syncedImages.length === 0 ? <p className="col-span-3 text-center text-sm text-muted-foreground">업로드된 이미지가 없습니다.</p> : syncedImages.map((image) => (
                         <button key={image.id} className="relative aspect-square rounded-md overflow-hidden hover:opacity-80 transition-opacity" onClick={() => handleSyncedImageClick(image.url)}>
-                          <img src={image.url} alt="Synced image" className="w-full h-full object-cover" />
+                          <img src={image.thumbnails?.small ?? image.url} alt="Synced image" loading="lazy" className="w-full h-full object-cover" />
                         </button>
                       ))}
                     </div>
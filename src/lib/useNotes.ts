@@ -227,9 +227,10 @@ export function useNotes(defaultFilters?: Filters) {
           noteDate
         };
 
+        const token = await getToken({ template: 'supabase' });
         const response = await fetch('/api/create_review_note', {
           method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
+          headers: { 'Content-Type': 'application/json', ...(token ? { Authorization: `Bearer ${token}` } : {}) },
           body: JSON.stringify(reviewNoteBody),
         });
 
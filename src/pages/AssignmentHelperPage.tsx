@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from "react";
 import { useNotes, Subject } from "../lib/useNotes";
 import { useNavigate } from "react-router-dom";
+import { useAuth } from '@clerk/clerk-react';
 import { Loader2, UploadCloud, FileText, X, Plus, BrainCircuit, ChevronsUpDown, BookMarked, Check } from "lucide-react";
 import { Button } from "@/components/ui/button";
 import { Note } from '../lib/types';
@@ -88,6 +89,7 @@ const FilePreview = ({ file, onRemove }: { file: File; onRemove: () => void; })
 
 export default function AssignmentHelperPage() {
     const { notes, allSubjects, addNoteFromAssignment } = useNotes();
+    const { getToken } = useAuth();
     const navigate = useNavigate();
 
     const [referenceFiles, setReferenceFiles] = useState<File[]>([]);
@@ -194,9 +196,10 @@ export default function AssignmentHelperPage() {
                 answerFileCount: answerFiles.length,
             };
 
+            const token = await getToken({ template: 'supabase' });
             const assignmentResponse = await fetch('/api/assignment_helper', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: { 'Content-Type': 'application/json', ...(token ? { Authorization: `Bearer ${token}` } : {}) },
                 body: JSON.stringify(assignmentBody)
             });
 